@@ -1,19 +1,69 @@
 from airflow import DAG
 from airflow.operators.python import PythonOperator
+from airflow.exceptions import AirflowSkipException
 from datetime import datetime
 import subprocess
+import json
+import os
 
 
-def run_script(script_name: str):
+SCRIPTS_DIR = '/opt/airflow/scripts'
+SHARD_SIZE = 10     #Assets processed by each mapped task
+MAX_SHARDS = 16     #Upper bound of parallel mapped tasks per stage
+SKIP_EXIT_CODE = 99 #Exit code of scripts whose inputs did not change since their last run, see scripts/run_state.py
+
+
+def run_script(script_name: str, args: list =None, params: dict =None):
     '''Calls a script to run from within an Airflow DAG.'''
 
-    path = f'/opt/airflow/scripts/{script_name}'
-    subprocess.run(['python', path], check=True)
+    path = f'{SCRIPTS_DIR}/{script_name}'
+    args = list(args or [])
+
+    if params and params.get('force'):
+        args.append('--force')
+
+    #Profiling is enabled through the environment, which every script honors
+    env = {**os.environ, 'PROFILE': '1'} if params and params.get('profile') else None
+
+    result = subprocess.run(['python', path] + args, env=env)
+
+    if result.returncode == SKIP_EXIT_CODE:
+        raise AirflowSkipException(f'{script_name} skipped: inputs unchanged since last run')
+    if result.returncode != 0:
+        raise subprocess.CalledProcessError(result.returncode, result.args)
+
+
+def run_shard(shard_arg: str, script_name: str, params: dict =None):
+    '''Calls a script to run on a single shard of assets from within an Airflow DAG.'''
+
+    run_script(script_name, [shard_arg], params)
+
+
+def plan_shards() -> list:
+    '''Split the assets configured in the database into shards for the mapped tasks.'''
+
+    path = f'{SCRIPTS_DIR}/shards.py'
+    result = subprocess.run(['python', path, 'plan', '--shard-size', str(SHARD_SIZE), '--max-shards', str(MAX_SHARDS)],
+                            check=True, capture_output=True, text=True)
+    print(result.stdout)
+
+    shard_args = json.loads(result.stdout.strip().splitlines()[-1])
+
+    #Each element holds the positional arguments of one mapped task
+    return [[shard_arg] for shard_arg in shard_args]
+
+
+def reduce_shards():
+    '''Reports how far every asset got through the sharded stages.'''
+
+    run_script('shards.py', ['reduce'])
 
 
 default_args = {
     'owner': 'airflow',
-    'retries': 0
+    'retries': 0,
+    #Tasks run when no upstream task failed and at least one did work; skipped when all upstream tasks were skipped
+    'trigger_rule': 'none_failed_min_one_success'
 }
 
 with DAG(
@@ -23,15 +73,22 @@ with DAG(
     schedule='@daily',
     start_date=datetime(2025, 1, 1),
     catchup=False,
+    params={'force': False, #Trigger with {"force": true} to run every stage even if its inputs did not change
+            'profile': False}, #Trigger with {"profile": true} to profile every stage, see scripts/profiling.py
 ) as dag:
         
-    asset_price_etl = PythonOperator(
+    shard_plan = PythonOperator(
+        task_id='plan_shards',
+        python_callable=plan_shards
+    )
+
+    asset_price_etl = PythonOperator.partial(
         task_id='asset_price_etl',
-        python_callable=run_script,
+        python_callable=run_shard,
         op_kwargs={
             'script_name': 'asset_price_etl.py'
         }
-    )
+    ).expand(op_args=shard_plan.output)
 
     sentiment_sources_etl = PythonOperator(
         task_id='sentiment_sources_etl',
@@ -41,13 +98,13 @@ with DAG(
         }
     )
 
-    technical_analysis_etl = PythonOperator(
+    technical_analysis_etl = PythonOperator.partial(
         task_id='technical_analysis_etl',
-        python_callable=run_script,
+        python_callable=run_shard,
         op_kwargs={
             'script_name': 'technical_analysis_etl.py'
         }
-    )
+    ).expand(op_args=shard_plan.output)
 
     sentiment_analysis_etl = PythonOperator(
         task_id='sentiment_analysis_etl',
@@ -57,23 +114,37 @@ with DAG(
         }
     )
 
-    feature_matrix_build = PythonOperator(
+    feature_matrix_build = PythonOperator.partial(
         task_id='feature_matrix_build',
-        python_callable=run_script,
+        python_callable=run_shard,
         op_kwargs={
             'script_name': 'feature_matrix_build.py'
         }
+    ).expand(op_args=shard_plan.output)
+
+    shard_reduce = PythonOperator(
+        task_id='reduce_shards',
+        python_callable=reduce_shards
     )
     
     model_training = PythonOperator(
         task_id='model_training',
         python_callable=run_script,
         op_kwargs={
-            'script_name': 'model_training.py'
+            'script_name': 'model_training.py',
+            'args': ['--incremental']
+        }
+    )
+
+    batch_prediction = PythonOperator(
+        task_id='batch_prediction',
+        python_callable=run_script,
+        op_kwargs={
+            'script_name': 'batch_prediction.py'
         }
     )
 
     
-    asset_price_etl >> technical_analysis_etl
+    shard_plan >> asset_price_etl >> technical_analysis_etl
     sentiment_sources_etl >> sentiment_analysis_etl
-    [technical_analysis_etl, sentiment_analysis_etl] >> feature_matrix_build >> model_training
\ No newline at end of file
+    [technical_analysis_etl, sentiment_analysis_etl] >> feature_matrix_build >> shard_reduce >> model_training >> batch_prediction
\ No newline at end of file
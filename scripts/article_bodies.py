@@ -0,0 +1,289 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import requests
+from html.parser import HTMLParser
+from urllib.parse import urlsplit
+from datetime import datetime, timedelta
+
+from raw_archive import compress, decompress, archive_response, get_archived_files
+from instrumentation import count_bytes
+
+
+#Elements whose text is never part of an article's main text
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'nav', 'header', 'footer', 'aside', 'form', 'figure', 'button', 'svg'}
+
+#Paragraphs shorter than this are usually captions, bylines or links rather than article text
+MIN_PARAGRAPH_LENGTH = 40
+
+#Pages larger than this are not read further
+MAX_PAGE_BYTES = 2 * 2**20
+
+#Source under which the bodies used by each run are kept in the raw archive, so replays never touch the network
+ARCHIVE_SOURCE = 'article_bodies'
+
+
+class MainTextParser(HTMLParser):
+    '''Collects the paragraphs of a page, telling apart those inside an article element.'''
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.skip_depth = 0
+        self.article_depth = 0
+        self.paragraph = None
+        self.paragraphs = []
+        self.article_paragraphs = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag == 'article':
+            self.article_depth += 1
+        elif tag == 'p' and self.skip_depth == 0:
+            self.end_paragraph()
+            self.paragraph = []
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag == 'article':
+            self.end_paragraph()
+            self.article_depth = max(self.article_depth - 1, 0)
+        elif tag == 'p':
+            self.end_paragraph()
+
+    def handle_data(self, data):
+        if self.paragraph is not None and self.skip_depth == 0:
+            self.paragraph.append(data)
+
+    def end_paragraph(self):
+        if self.paragraph is None:
+            return
+
+        text = ' '.join(''.join(self.paragraph).split())
+        if len(text) >= MIN_PARAGRAPH_LENGTH:
+            self.paragraphs.append(text)
+            if self.article_depth > 0:
+                self.article_paragraphs.append(text)
+        self.paragraph = None
+
+
+def extract_main_text(html: str) -> str:
+    '''Main text of a news page: its paragraphs within article elements if it has any, otherwise all of them.'''
+
+    parser = MainTextParser()
+    parser.feed(html)
+    parser.close()
+    parser.end_paragraph()
+
+    return '\n'.join(parser.article_paragraphs or parser.paragraphs)
+
+
+def get_cache_dir() -> str:
+    '''Directory of the cache of article bodies.'''
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+    return os.getenv('ARTICLE_CACHE_DIR', os.path.join(os.path.dirname(scripts_dir), 'data', 'articles'))
+
+
+def get_cache_path(url: str) -> str:
+    '''Path of the cached body of a URL without extension, spread over subdirectories by the first bytes of its hash.'''
+
+    digest = hashlib.sha256(url.encode()).hexdigest()
+
+    return os.path.join(get_cache_dir(), digest[:2], digest)
+
+
+def read_cache(url: str, ttl: timedelta =None) -> dict:
+    '''Cached entry of a URL, unless there is none or it is older than the TTL.'''
+
+    path = get_cache_path(url)
+
+    for extension in ('.zst', '.gz'):
+        if os.path.exists(path + extension):
+            entry = json.loads(decompress(path + extension))
+            if ttl is not None and datetime.now() - datetime.fromisoformat(entry['fetched_at']) > ttl:
+                return None
+            return entry
+
+    return None
+
+
+def write_cache(url: str, entry: dict):
+    '''Store the entry of a URL, replacing any previous one atomically.'''
+
+    path = get_cache_path(url)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    data, extension = compress(json.dumps(entry).encode())
+    tmp_path = f'{path}{extension}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path + extension)
+
+
+def new_fetcher(max_per_host: int =4, timeout: float =10, ttl_days: float =7, replay: str =None) -> dict:
+    '''State shared by the threads fetching article bodies: limits per host, HTTP sessions and statistics.
+
+    When replaying a day, bodies are read from the raw archive only, as the run of that day used them, and pages
+    the archive lacks have no body. Otherwise every body used is archived under the day the run started.
+    '''
+
+    return {
+        'max_per_host':     max_per_host,
+        'timeout':          timeout,
+        'ttl':              timedelta(days=ttl_days) if ttl_days is not None else None,
+        'archived_files':   get_archived_files(ARCHIVE_SOURCE, replay) if replay is not None else None,
+        'started_at':       datetime.now(),
+        'host_slots':       {},
+        'sessions':         threading.local(),
+        'lock':             threading.Lock(),
+        'archive_lock':     threading.Lock(),
+        'stats':            {'pages': 0, 'cache_hits': 0, 'fetched': 0, 'failed': 0, 'bytes': 0,
+                             'fetch_seconds': 0.0, 'started_at': time.perf_counter()}
+    }
+
+
+def archive_body(url: str, status_code: int, body: str, fetched_at: datetime =None):
+    '''Keep the body of a page in the raw archive, keyed by its URL.'''
+
+    entry = {'url': url, 'status': status_code, 'body': body}
+    archive_response(ARCHIVE_SOURCE, url, json.dumps(entry).encode(), fetched_at)
+
+
+def read_archived_body(fetcher: dict, url: str) -> str:
+    '''Body of a page as archived by the run being replayed. Pages it lacks count as failed.'''
+
+    stats = fetcher['stats']
+
+    if url not in fetcher['archived_files']:
+        with fetcher['lock']:
+            stats['pages'] += 1
+            stats['failed'] += 1
+        return None
+
+    content = decompress(fetcher['archived_files'][url])
+    count_bytes(len(content))
+    with fetcher['lock']:
+        stats['pages'] += 1
+        stats['cache_hits'] += 1
+
+    return json.loads(content)['body']
+
+
+def get_host_slots(fetcher: dict, url: str) -> threading.BoundedSemaphore:
+    host = urlsplit(url).netloc
+
+    with fetcher['lock']:
+        if host not in fetcher['host_slots']:
+            fetcher['host_slots'][host] = threading.BoundedSemaphore(fetcher['max_per_host'])
+        return fetcher['host_slots'][host]
+
+
+def get_session(fetcher: dict) -> requests.Session:
+    '''HTTP session of the current thread, so connections to a host are reused between its requests.'''
+
+    sessions = fetcher['sessions']
+    if not hasattr(sessions, 'session'):
+        sessions.session = requests.Session()
+        sessions.session.headers['User-Agent'] = 'Mozilla/5.0 (compatible; financial-prediction)'
+
+    return sessions.session
+
+
+def download_page(fetcher: dict, url: str) -> tuple:
+    '''Status code and content of a page, read up to MAX_PAGE_BYTES.'''
+
+    with get_host_slots(fetcher, url):
+        with get_session(fetcher).get(url, timeout=fetcher['timeout'], stream=True) as response:
+            content = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                content += chunk
+                if len(content) >= MAX_PAGE_BYTES:
+                    break
+            #Without a declared charset, requests assumes ISO-8859-1 for HTML, while most pages are UTF-8
+            encoding = response.encoding if 'charset' in response.headers.get('Content-Type', '') else 'utf-8'
+
+    count_bytes(len(content))
+
+    return response.status_code, bytes(content).decode(encoding, errors='replace')
+
+
+def fetch_body(fetcher: dict, url: str) -> str:
+    '''Main text of the page at a URL, from the cache if fetched within the TTL. None if it could not be fetched.
+
+    Pages answered with a client error, e.g. 404, are cached without body, so they are not requested again until the
+    TTL expires. Server errors, timeouts and connection errors are not cached, so the next run retries them. When
+    replaying, bodies come from the raw archive instead and nothing is fetched.
+    '''
+
+    if fetcher['archived_files'] is not None:
+        return read_archived_body(fetcher, url)
+
+    stats = fetcher['stats']
+
+    entry = read_cache(url, fetcher['ttl'])
+    if entry is not None:
+        with fetcher['lock']:
+            stats['pages'] += 1
+            stats['cache_hits'] += 1
+        #Identical bodies are stored once per day, so archiving cached ones again costs a manifest line
+        with fetcher['archive_lock']:
+            archive_body(url, entry['status'], entry['body'], fetcher['started_at'])
+        return entry['body']
+
+    start = time.perf_counter()
+    try:
+        status_code, html = download_page(fetcher, url)
+    except requests.RequestException as e:
+        print(f"Couldn't fetch article {url}: {e}")
+        with fetcher['lock']:
+            stats['pages'] += 1
+            stats['failed'] += 1
+        return None
+    seconds = time.perf_counter() - start
+
+    body = (extract_main_text(html) or None) if status_code == 200 else None
+    if status_code < 500:
+        write_cache(url, {'url': url, 'status': status_code, 'fetched_at': datetime.now().isoformat(), 'body': body})
+        #Written by one thread at a time, as threads fetching the same URL would write the same archive file
+        with fetcher['archive_lock']:
+            archive_body(url, status_code, body, fetcher['started_at'])
+
+    with fetcher['lock']:
+        stats['pages'] += 1
+        stats['fetched'] += 1
+        stats['failed'] += status_code != 200
+        stats['bytes'] += len(html)
+        stats['fetch_seconds'] += seconds
+
+    return body
+
+
+def get_fetch_stats(fetcher: dict) -> dict:
+    '''Throughput and cache hit rate of the pages requested to a fetcher so far.'''
+
+    stats = fetcher['stats']
+    elapsed = time.perf_counter() - stats['started_at']
+
+    return {
+        'pages':            stats['pages'],
+        'cache_hits':       stats['cache_hits'],
+        'fetched':          stats['fetched'],
+        'failed':           stats['failed'],
+        'bytes':            stats['bytes'],
+        'pages_per_sec':    stats['pages'] / elapsed if elapsed > 0 else 0,
+        'cache_hit_rate':   stats['cache_hits'] / stats['pages'] if stats['pages'] else 0,
+        'mean_fetch_ms':    stats['fetch_seconds'] / stats['fetched'] * 1000 if stats['fetched'] else 0
+    }
+
+
+def print_fetch_stats(fetcher: dict):
+    stats = get_fetch_stats(fetcher)
+
+    print(f'Article bodies: {stats["pages"]} pages at {stats["pages_per_sec"]:.1f} pages/s, '
+          f'{stats["cache_hit_rate"]:.0%} from cache, {stats["fetched"]} fetched '
+          f'({stats["mean_fetch_ms"]:.0f} ms on average), {stats["failed"]} failed.')
@@ -6,12 +6,20 @@ from dotenv import load_dotenv
 import os
 import requests
 from io import StringIO
+import argparse
+import sys
+from datetime import date, timedelta
 
 from db import get_db_params
+from shards import add_shard_args, shard_from_args, shard_filter, shard_label
+from raw_archive import add_replay_args, archive_response, get_archived_files, decompress
+from run_state import add_force_args, get_code_version, inputs_unchanged, save_run_state, SKIP_EXIT_CODE
+from instrumentation import instrumented, phase, count_bytes
+from profiling import add_profile_args, profiling_from_args
 
 
 
-def get_tickers() -> list:
+def get_tickers(shard: dict =None) -> list:
     '''Read from DB assets to extract.'''
 
     print('Reading assets whose data extract...')
@@ -20,14 +28,15 @@ def get_tickers() -> list:
     assets_tbl = params['assets']
     db_conn_params = params['db_conn']
 
+    shard_condition, shard_params = shard_filter(shard)
     select_query = f'''SELECT alphavantage_code FROM {assets_tbl}
-                        WHERE ticker = 'SPY'
+                        WHERE {shard_condition}
                     '''
 
     try:
         with psycopg2.connect(**db_conn_params) as conn:
             with conn.cursor() as cur:
-                cur.execute(select_query)
+                cur.execute(select_query, shard_params)
                 conn.commit()
                 records = cur.fetchall()
     except psycopg2.Error as e:
@@ -50,10 +59,32 @@ def get_extraction_period(): #Must return None if same-day data already extracte
     return period
 
 
-def extract_asset_price_data(tickers: list, period='1d') -> pd.DataFrame:
-    '''Download stock data for multiple tickers.'''
+def get_last_trading_day() -> date:
+    '''Last weekday before today, the most recent day whose daily prices can be complete.'''
 
-    print('Downloading asset prices...')
+    day = date.today() - timedelta(days=1)
+    while day.weekday() >= 5: #Saturday or Sunday
+        day -= timedelta(days=1)
+
+    return day
+
+
+def get_stage_inputs(tickers: list) -> dict:
+    '''Describe what a run would fetch, so runs with nothing new to fetch can be skipped, e.g. on weekends.'''
+
+    return {'last_trading_day': get_last_trading_day(),
+            'tickers':          sorted(tickers),
+            'code':             get_code_version(__file__, 'shards.py', 'raw_archive.py')
+    }
+
+
+def extract_asset_price_data(tickers: list, period='1d', replay: str =None) -> pd.DataFrame:
+    '''Download stock data for multiple tickers, or read it from the raw archive if replaying a day.'''
+
+    if replay is None:
+        print('Downloading asset prices...')
+    else:
+        archived_files = get_archived_files('alphavantage', replay)
 
     all_data = []
 
@@ -61,15 +92,28 @@ def extract_asset_price_data(tickers: list, period='1d') -> pd.DataFrame:
     api_key = os.getenv('ALPHAVANTAGE_API_KEY')
 
     for ticker in tickers:
-        print(f'Fetching data for {ticker}...')
-        url = f'https://www.alphavantage.co/query?function=TIME_SERIES_DAILY&symbol={ticker}&outputsize=full&datatype=csv&apikey={api_key}'
-        req = requests.get(url)
-
-        if req.status_code != 200:
-            print(f"Couldn't retrieve data for ticker {ticker}")
-            continue
-
-        df = pd.read_csv(StringIO(req.text))
+        if replay is None:
+            print(f'Fetching data for {ticker}...')
+            url = f'https://www.alphavantage.co/query?function=TIME_SERIES_DAILY&symbol={ticker}&outputsize=full&datatype=csv&apikey={api_key}'
+            req = requests.get(url)
+
+            if req.status_code != 200:
+                print(f"Couldn't retrieve data for ticker {ticker}")
+                continue
+
+            #Keep the raw response so it can be reprocessed without calling the API again
+            archive_response('alphavantage', ticker, req.content)
+            count_bytes(len(req.content))
+            raw_csv = req.text
+        else:
+            if ticker not in archived_files:
+                print(f'No archived data for ticker {ticker}')
+                continue
+
+            raw_csv = decompress(archived_files[ticker]).decode('utf-8')
+            count_bytes(len(raw_csv))
+
+        df = pd.read_csv(StringIO(raw_csv))
         df.reset_index(inplace=True)
         df['ticker'] = ticker
         all_data.append(df)
@@ -95,12 +139,12 @@ def transform_data(df: pd.DataFrame) -> list:
     return rows
 
 
-def load_data(rows: list):
+def load_data(rows: list) -> bool:
     '''Insert rows into the database using bulk insert.'''
 
     if not rows:
         print('No new data to insert.')
-        return
+        return True
     
     print('Loading extracted prices into database...')
     
@@ -120,37 +164,67 @@ def load_data(rows: list):
                 conn.commit()
     except psycopg2.Error as e:
         print(f'Database error: {e}')
-        return
+        return False
         
     print(f'Insertion successful.')
 
+    return True
 
-def run_asset_price_etl():
-    print(f'Starting Asset Price ETL at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+@instrumented('asset_price_etl')
+def run_asset_price_etl(shard: dict =None, replay: str =None, force: bool =False) -> bool:
+    print(f'Starting Asset Price ETL for assets {shard_label(shard)} at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
 
     #Extract
     period = get_extraction_period()
 
     if period is None:
         print('Daily data already extracted. Exiting.')
-        return
+        return False
     
-    tickers = get_tickers()
-    asset_data = extract_asset_price_data(tickers, period=period)
+    tickers = get_tickers(shard)
+
+    #Replays do not depend on the day they are run, so they are always run and never recorded
+    stage_inputs = get_stage_inputs(tickers)
+    if replay is None and inputs_unchanged('asset_price_etl', shard_label(shard), stage_inputs, force):
+        return False
+
+    with phase('extract') as extract_phase:
+        asset_data = extract_asset_price_data(tickers, period=period, replay=replay)
+        extract_phase['rows'] = len(asset_data)
 
     if asset_data.empty:
         print('No asset data fetched. Exiting.')
-        return
+        return True
 
     #Transform
-    rows = transform_data(asset_data)
+    with phase('transform') as transform_phase:
+        rows = transform_data(asset_data)
+        transform_phase['rows'] = len(rows)
 
     #Load
-    load_data(rows)
+    with phase('load') as load_phase:
+        stored = load_data(rows)
+        load_phase['rows'] = len(rows)
+
+    #A run is only complete once every asset was fetched, otherwise it must be retried
+    if replay is None and stored and asset_data['ticker'].nunique() == len(tickers):
+        save_run_state('asset_price_etl', shard_label(shard), stage_inputs)
 
     print(f'ETL process finished at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
 
+    return True
+
 
 
 if __name__ == '__main__':
-    run_asset_price_etl()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Asset Price ETL')
+    add_shard_args(parser)
+    add_replay_args(parser)
+    add_force_args(parser)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    profiling_from_args(args)
+
+    if not run_asset_price_etl(shard_from_args(args), args.replay, args.force):
+        sys.exit(SKIP_EXIT_CODE)
\ No newline at end of file
@@ -0,0 +1,222 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, date, timedelta
+
+import technical_analysis_etl
+import sentiment_analysis_etl
+from shards import add_shard_args, shard_from_args, shard_label, get_all_tickers
+from instrumentation import instrumented, phase
+from profiling import add_profile_args, profiling_from_args
+
+
+STAGES = ['technical_analysis', 'sentiment_analysis']
+
+#Set in each worker process by init_worker
+_db_slots = None
+_sentiment_model = None
+
+
+def init_worker(db_slots: object):
+    '''Share among worker processes the semaphore that bounds open DB connections.'''
+
+    global _db_slots
+    _db_slots = db_slots
+
+
+def plan_partitions(tickers: list, start_date: date, end_date: date, chunk_days: int) -> list:
+    '''Split the backfill into partitions of one ticker and a date range each.'''
+
+    partitions = []
+
+    for ticker in tickers:
+        chunk_start = start_date
+        while chunk_start <= end_date:
+            chunk_end = min(chunk_start + timedelta(days=chunk_days - 1), end_date)
+            partitions.append({'ticker': ticker, 'start': chunk_start.isoformat(), 'end': chunk_end.isoformat()})
+            chunk_start = chunk_end + timedelta(days=1)
+
+    return partitions
+
+
+def partition_key(partition: dict) -> str:
+    return f'{partition["ticker"]}:{partition["start"]}:{partition["end"]}'
+
+
+def backfill_technical_partition(partition: dict, computed_at: datetime) -> dict:
+    '''Recompute technical analysis metrics of a partition, using prior prices as lookback.'''
+
+    start = time.perf_counter()
+    start_date = date.fromisoformat(partition['start'])
+    end_date = date.fromisoformat(partition['end'])
+
+    with _db_slots:
+        asset_df = technical_analysis_etl.get_asset_data_range(partition['ticker'], partition['start'], partition['end'])
+
+    #Metrics are computed over the lookback too, but only those of the partition's own dates are stored
+    metrics_df = technical_analysis_etl.compute_ta_metrics(asset_df, computed_at)
+    in_range_ids = asset_df.loc[(asset_df['date'] >= start_date) & (asset_df['date'] <= end_date), 'price_id']
+    metrics_df = metrics_df[metrics_df['asset_price_id'].isin(in_range_ids)]
+    rows = technical_analysis_etl.transform_data(metrics_df)
+
+    with _db_slots:
+        if not technical_analysis_etl.store_results(rows, overwrite=True):
+            raise RuntimeError(f'Could not store metrics of partition {partition_key(partition)}')
+
+    return {'rows': len(rows), 'seconds': time.perf_counter() - start}
+
+
+def backfill_sentiment_partition(partition: dict, analyzed_at: datetime) -> dict:
+    '''Reanalyze the sentiment of the sources of a partition.'''
+
+    global _sentiment_model
+
+    start = time.perf_counter()
+
+    with _db_slots:
+        sources_df = sentiment_analysis_etl.get_sources({'tickers': [partition['ticker']]}, partition['start'], partition['end'])
+
+    if sources_df.empty:
+        return {'rows': 0, 'seconds': time.perf_counter() - start}
+
+    #Model is loaded once per worker process and reused by all its partitions
+    if _sentiment_model is None:
+        _sentiment_model = sentiment_analysis_etl.load_sentiment_model()
+
+    analysis_df = sentiment_analysis_etl.analyze_sentiment(sources_df, analyzed_at, _sentiment_model)
+    rows = sentiment_analysis_etl.transform_data(analysis_df)
+
+    with _db_slots:
+        if not sentiment_analysis_etl.store_results(rows):
+            raise RuntimeError(f'Could not store sentiment of partition {partition_key(partition)}')
+
+    return {'rows': len(rows), 'seconds': time.perf_counter() - start}
+
+
+PARTITION_RUNNERS = {
+    'technical_analysis': backfill_technical_partition,
+    'sentiment_analysis': backfill_sentiment_partition
+}
+
+
+def get_checkpoint_path(stage: str, shard: dict, start_date: date, end_date: date) -> str:
+    '''Path of the file tracking the completed partitions of a backfill.'''
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = os.path.dirname(scripts_dir)
+    checkpoint_dir = os.path.join(parent_dir, 'logs', 'backfill')
+    os.makedirs(checkpoint_dir, exist_ok=True)
+
+    shard_hash = hashlib.md5(shard_label(shard).encode()).hexdigest()[:8]
+
+    return os.path.join(checkpoint_dir, f'{stage}_{start_date}_{end_date}_{shard_hash}.json')
+
+
+def load_checkpoint(path: str) -> dict:
+    '''Read the completed partitions of a previous run of the same backfill, if any.'''
+
+    if not os.path.exists(path):
+        return {'started_at': datetime.now().isoformat(), 'completed': {}}
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_checkpoint(path: str, checkpoint: dict):
+    '''Write the checkpoint atomically, so an interruption never leaves it half-written.'''
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(checkpoint, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+@instrumented('backfill')
+def run_backfill(stage: str, shard: dict, start_date: date, end_date: date, chunk_days: int =365,
+                 workers: int =4, max_connections: int =4, restart: bool =False) -> int:
+    '''Recompute a stage over a date range in parallel partitions and return the number of them stored.
+
+    Raises RuntimeError if any partition failed, so the run is recorded as failed, after completing all the others.
+    '''
+
+    run_start = datetime.now()
+    print(f'Starting {stage} backfill for assets {shard_label(shard)} from {start_date} to {end_date} '
+          f'at {run_start.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    tickers = get_all_tickers(shard)
+    partitions = plan_partitions(tickers, start_date, end_date, chunk_days)
+
+    checkpoint_path = get_checkpoint_path(stage, shard, start_date, end_date)
+    if restart and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    checkpoint = load_checkpoint(checkpoint_path)
+
+    #All partitions share the timestamp of the first attempt, so resumed results look like a single run
+    started_at = datetime.fromisoformat(checkpoint['started_at'])
+
+    pending = [partition for partition in partitions if partition_key(partition) not in checkpoint['completed']]
+    print(f'{len(partitions) - len(pending)} of {len(partitions)} partitions already completed, {len(pending)} pending.')
+
+    total_rows = 0
+    failed = 0
+    db_slots = multiprocessing.BoundedSemaphore(max_connections)
+
+    #Partitions run in worker processes, whose CPU time and DB round trips are not counted in this one's metrics
+    with phase('partitions') as partitions_phase, \
+         ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(db_slots,)) as executor:
+        futures = {executor.submit(PARTITION_RUNNERS[stage], partition, started_at): partition for partition in pending}
+
+        for future in as_completed(futures):
+            key = partition_key(futures[future])
+
+            try:
+                result = future.result()
+            except Exception as e:
+                print(f'Partition {key} failed: {e}')
+                failed += 1
+                continue
+
+            checkpoint['completed'][key] = result
+            save_checkpoint(checkpoint_path, checkpoint)
+
+            total_rows += result['rows']
+            throughput = result['rows'] / result['seconds'] if result['seconds'] > 0 else 0
+            print(f'Partition {key}: {result["rows"]} rows in {result["seconds"]:.2f}s ({throughput:.0f} rows/s)')
+
+        partitions_phase['rows'] = total_rows
+
+    elapsed = (datetime.now() - run_start).total_seconds()
+    print(f'Backfill finished: {total_rows} rows in {elapsed:.1f}s ({total_rows / elapsed if elapsed else 0:.0f} rows/s), '
+          f'{failed} partitions failed.')
+
+    if failed:
+        raise RuntimeError(f'{failed} of {len(pending)} partitions failed. Run again with the same arguments to retry '
+                           f'them, progress is kept in {checkpoint_path}')
+
+    return len(pending)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recompute historical analytics in parallel partitions')
+    parser.add_argument('stage', choices=STAGES)
+    parser.add_argument('--start', type=date.fromisoformat, required=True, help='First date to recompute, YYYY-MM-DD')
+    parser.add_argument('--end', type=date.fromisoformat, default=date.today(), help='Last date to recompute, YYYY-MM-DD')
+    parser.add_argument('--chunk-days', type=int, default=365, help='Length in days of the date range of each partition')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--max-connections', type=int, default=4, help='Maximum DB connections open at once')
+    parser.add_argument('--restart', action='store_true', help='Ignore completed partitions of a previous run')
+    add_shard_args(parser)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    profiling_from_args(args)
+
+    try:
+        run_backfill(args.stage, shard_from_args(args), args.start, args.end, args.chunk_days,
+                     args.workers, args.max_connections, args.restart)
+    except RuntimeError as e:
+        sys.exit(str(e))
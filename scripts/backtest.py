@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import argparse
+import psycopg2
+import numpy as np
+import pandas as pd
+from datetime import datetime
+
+from db import get_db_params
+from evaluation import safe_divide, save_report
+
+
+TRADING_DAYS = 252
+
+
+def load_predictions(start_date: str =None, end_date: str =None) -> pd.DataFrame:
+    '''Stored predictions of every ticker along with the return they predict.
+
+    A prediction made from the sequence ending on a date is labeled, as in training, with the next day's row of the
+    feature matrix, so it is matched with the next_day_return of that row.
+    '''
+
+    print('Extracting predictions and returns from database...')
+
+    params =                get_db_params()
+    predictions_tbl =       params['predictions']
+    feature_matrix_tbl =    params['feature_matrix']
+    db_conn_params =        params['db_conn']
+
+    select_query = f'''SELECT f.date, p.ticker, p.score, f.next_day_return
+                        FROM {predictions_tbl} p
+                        JOIN (
+                            SELECT ticker, date, next_day_return,
+                                LAG(date) OVER (PARTITION BY ticker ORDER BY date) AS previous_date
+                            FROM {feature_matrix_tbl}
+                        ) f
+                        ON p.ticker = f.ticker
+                        AND p.date = f.previous_date
+                        WHERE f.date >= COALESCE(%s::date, '-infinity'::date)
+                        AND f.date <= COALESCE(%s::date, 'infinity'::date);
+                    '''
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(select_query, (start_date, end_date))
+                records = cur.fetchall()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+        raise
+
+    return pd.DataFrame(records, columns=['date', 'ticker', 'score', 'next_day_return'])
+
+
+def score_feature_matrix(start_date: str =None, end_date: str =None) -> pd.DataFrame:
+    '''Scores of the saved model on every sequence of the feature matrix, along with the return each one predicts.
+
+    Dates the model was trained on are scored too, so results before its training cutoff are optimistic.
+    '''
+
+    #TensorFlow is only needed, and imported, when scoring with the model
+    from model_training import (load_model, load_model_metadata, load_feature_matrix, build_sequences,
+                                get_sequence_dates, get_model_dir)
+    from evaluation import predict_scores
+
+    metadata = load_model_metadata()
+    if metadata is None:
+        raise FileNotFoundError('No trained model to score with')
+
+    sequence_length = metadata['sequence_length']
+    matrix = load_feature_matrix()
+
+    X, _ = build_sequences(matrix, sequence_length)
+    dates = get_sequence_dates(matrix, sequence_length)
+    tickers = np.concatenate([group['m.ticker'].to_numpy()[sequence_length:] for _, group in matrix.groupby('m.ticker')])
+
+    in_range = np.ones(len(dates), dtype=bool)
+    if start_date is not None:
+        in_range &= dates >= datetime.fromisoformat(start_date).date()
+    if end_date is not None:
+        in_range &= dates <= datetime.fromisoformat(end_date).date()
+
+    print(f'Scoring {in_range.sum()} sequences with model version {metadata["version"]}...')
+    model = load_model(os.path.join(get_model_dir(), 'lstm_model.keras'))
+    scores = predict_scores(model, X[in_range].astype(np.float64))
+
+    predictions = pd.DataFrame({'date': dates[in_range], 'ticker': tickers[in_range], 'score': scores})
+
+    return predictions.merge(load_returns(), on=['date', 'ticker'])
+
+
+def load_returns() -> pd.DataFrame:
+    '''Next day return of every ticker and date of the feature matrix.'''
+
+    params =                get_db_params()
+    feature_matrix_tbl =    params['feature_matrix']
+    db_conn_params =        params['db_conn']
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(f'SELECT date, ticker, next_day_return FROM {feature_matrix_tbl};')
+                records = cur.fetchall()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+        raise
+
+    return pd.DataFrame(records, columns=['date', 'ticker', 'next_day_return'])
+
+
+def to_dense(predictions: pd.DataFrame) -> tuple:
+    '''Dates, tickers, and scores and returns as date x ticker arrays, NaN where a ticker has no prediction.'''
+
+    date_codes, dates = pd.factorize(predictions['date'], sort=True)
+    ticker_codes, tickers = pd.factorize(predictions['ticker'], sort=True)
+
+    scores = np.full((len(dates), len(tickers)), np.nan)
+    returns = np.full((len(dates), len(tickers)), np.nan)
+    scores[date_codes, ticker_codes] = predictions['score'].to_numpy(dtype=np.float64)
+    returns[date_codes, ticker_codes] = predictions['next_day_return'].to_numpy(dtype=np.float64)
+
+    return np.asarray(dates), np.asarray(tickers), scores, returns
+
+
+def count_at_least(values: np.ndarray, thresholds: np.ndarray) -> np.ndarray:
+    '''Number of values of each row that are greater than or equal to each threshold, as a rows x thresholds array.
+
+    Rows are sorted once and offset so that, flattened, they form a single sorted array. All rows are then searched
+    for all thresholds in one searchsorted call. Values of -inf are never counted.
+    '''
+
+    num_rows, num_columns = values.shape
+
+    finite = values[np.isfinite(values)]
+    low = min(finite.min() if finite.size else 0, thresholds.min()) - 1
+    span = max(finite.max() if finite.size else 0, thresholds.max()) + 1 - low
+    offsets = np.arange(num_rows)[:, np.newaxis] * span
+
+    sorted_values = np.sort(np.where(np.isfinite(values), values, low), axis=1) + offsets
+    positions = np.searchsorted(sorted_values.ravel(), thresholds[np.newaxis, :] + offsets, side='left')
+
+    return num_columns - (positions - np.arange(num_rows)[:, np.newaxis] * num_columns)
+
+
+def threshold_portfolios(scores: np.ndarray, returns: np.ndarray, thresholds: np.ndarray) -> dict:
+    '''Daily return, turnover and positions of the equal-weight portfolio of tickers scoring at least each threshold.
+
+    Positions are taken at the close of each date and earn the ticker's next day return. For each threshold the
+    portfolio holds the tickers with the highest scores, so its return is a cumulative sum of the returns sorted by
+    score, taken at the number of tickers above the threshold. Turnover is exact, from the number of tickers held on
+    two consecutive days: those whose lower score of the two reaches the threshold. Arrays are dates x thresholds.
+    '''
+
+    #Tickers without a return that day can't be traded
+    tradable = ~np.isnan(scores) & ~np.isnan(returns)
+    scores = np.where(tradable, scores, -np.inf)
+    returns = np.where(tradable, returns, 0)
+
+    order = np.argsort(-scores, axis=1, kind='stable')
+    cumulative_returns = np.cumsum(np.take_along_axis(returns, order, axis=1), axis=1)
+    cumulative_returns = np.hstack([np.zeros((len(scores), 1)), cumulative_returns])
+
+    positions = count_at_least(scores, thresholds)
+    gross = safe_divide(np.take_along_axis(cumulative_returns, positions, axis=1), positions)
+
+    #Portfolio of the previous day, which is empty before the first one
+    previous_scores = np.vstack([np.full((1, scores.shape[1]), -np.inf), scores[:-1]])
+    previous_positions = np.vstack([np.zeros((1, len(thresholds)), dtype=positions.dtype), positions[:-1]])
+    kept = count_at_least(np.minimum(scores, previous_scores), thresholds)
+
+    #Kept tickers change weight from the previous one to the current one, sold ones lose theirs and bought ones gain it
+    weight = safe_divide(np.ones(positions.shape), positions)
+    previous_weight = safe_divide(np.ones(positions.shape), previous_positions)
+    turnover = (kept * np.abs(weight - previous_weight) + (previous_positions - kept) * previous_weight
+                + (positions - kept) * weight)
+
+    return {'gross': gross, 'turnover': turnover, 'positions': positions}
+
+
+def performance_metrics(net: np.ndarray) -> dict:
+    '''Return, volatility, Sharpe ratio and drawdown of each row of daily returns, compounded.'''
+
+    #A loss of the whole capital ends a strategy
+    log_wealth = np.cumsum(np.log(np.maximum(1 + net, 1e-12)), axis=1)
+    wealth = np.exp(log_wealth)
+    peak = np.maximum.accumulate(np.maximum(wealth, 1), axis=1)
+
+    mean = net.mean(axis=1)
+    volatility = net.std(axis=1, ddof=1) if net.shape[1] > 1 else np.zeros(len(net))
+
+    return {
+        'total_return':         wealth[:, -1] - 1,
+        'annual_return':        np.exp(log_wealth[:, -1] * TRADING_DAYS / net.shape[1]) - 1,
+        'annual_volatility':    volatility * np.sqrt(TRADING_DAYS),
+        'sharpe':               safe_divide(mean, volatility) * np.sqrt(TRADING_DAYS),
+        'max_drawdown':         (1 - wealth / peak).max(axis=1)
+    }
+
+
+def run_configurations(scores: np.ndarray, returns: np.ndarray, thresholds: list, leverages: list, costs_bps: list) -> pd.DataFrame:
+    '''Metrics of every combination of threshold, leverage and transaction cost.
+
+    Portfolios are computed once per threshold. Leverage scales returns and turnover, and costs are charged on
+    turnover, so each of their combinations is a broadcast over all thresholds and days at once.
+    '''
+
+    thresholds = np.asarray(sorted(thresholds), dtype=np.float64)
+    portfolios = threshold_portfolios(scores, returns, thresholds)
+
+    #Thresholds x dates
+    gross = portfolios['gross'].T
+    turnover = portfolios['turnover'].T
+
+    results = []
+    for leverage in leverages:
+        for cost_bps in costs_bps:
+            net = leverage * (gross - cost_bps / 1e4 * turnover)
+            metrics = performance_metrics(net)
+
+            results.append(pd.DataFrame({
+                'threshold':        thresholds,
+                'leverage':         leverage,
+                'cost_bps':         cost_bps,
+                **metrics,
+                'mean_turnover':    leverage * turnover.mean(axis=1),
+                'mean_positions':   portfolios['positions'].mean(axis=0),
+                'invested_days':    (portfolios['positions'] > 0).mean(axis=0)
+            }))
+
+    return pd.concat(results, ignore_index=True)
+
+
+def get_report_path() -> str:
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    model_dir = os.getenv('MODEL_DIR', os.path.join(os.path.dirname(scripts_dir), 'models'))
+
+    return os.path.join(model_dir, 'backtest_report.json')
+
+
+def run_backtest(source: str ='predictions', start_date: str =None, end_date: str =None, thresholds: list =None,
+                 leverages: list =None, costs_bps: list =None, top: int =10) -> pd.DataFrame:
+    start_time = datetime.now()
+    print(f'Starting backtest at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    if source == 'predictions':
+        predictions = load_predictions(start_date, end_date)
+    else:
+        predictions = score_feature_matrix(start_date, end_date)
+
+    if predictions.empty:
+        print('No predictions to backtest.')
+        return pd.DataFrame()
+
+    dates, tickers, scores, returns = to_dense(predictions)
+
+    thresholds = thresholds if thresholds is not None else list(np.round(np.arange(0.3, 0.7 + 1e-9, 0.01), 2))
+    leverages = leverages or [1.0]
+    costs_bps = costs_bps if costs_bps is not None else [0.0, 5.0, 10.0]
+
+    num_configurations = len(thresholds) * len(leverages) * len(costs_bps)
+    print(f'Backtesting {num_configurations} configurations on {len(dates)} days x {len(tickers)} tickers...')
+
+    results = run_configurations(scores, returns, thresholds, leverages, costs_bps)
+    results = results.sort_values('sharpe', ascending=False, ignore_index=True)
+
+    #Reference: every tradable ticker held in equal weights, with no costs
+    tradable = ~np.isnan(scores) & ~np.isnan(returns)
+    equal_weight = safe_divide(np.where(tradable, returns, 0).sum(axis=1), tradable.sum(axis=1))
+    benchmark = {name: float(value[0]) for name, value in performance_metrics(equal_weight[np.newaxis, :]).items()}
+
+    print(f'Top {top} configurations by Sharpe ratio:')
+    print(results.head(top).to_string(index=False, float_format=lambda value: f'{value:.4f}'))
+    print(f'Equal weight of all tickers: {json.dumps({name: round(value, 4) for name, value in benchmark.items()})}')
+
+    report = {
+        'source':           source,
+        'start_date':       str(dates[0]),
+        'end_date':         str(dates[-1]),
+        'days':             len(dates),
+        'tickers':          len(tickers),
+        'benchmark':        benchmark,
+        'configurations':   results.to_dict(orient='records'),
+        'computed_at':      start_time.isoformat()
+    }
+
+    save_report(report, get_report_path())
+    print(f'Report written to {get_report_path()}')
+
+    end_time = datetime.now()
+    print(f'Backtest finished at {end_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Backtest trading on the model predictions')
+    parser.add_argument('--source', choices=['predictions', 'model'], default='predictions',
+                        help='Stored daily predictions, or scores of the saved model on the whole feature matrix')
+    parser.add_argument('--start', type=str, default=None, help='First date to trade, YYYY-MM-DD')
+    parser.add_argument('--end', type=str, default=None, help='Last date to trade, YYYY-MM-DD')
+    parser.add_argument('--thresholds', type=float, nargs='+', default=None,
+                        help='Scores from which a ticker is bought, 0.30 to 0.70 in steps of 0.01 by default')
+    parser.add_argument('--leverages', type=float, nargs='+', default=[1.0], help='Exposure as a multiple of capital')
+    parser.add_argument('--costs-bps', type=float, nargs='+', default=[0.0, 5.0, 10.0],
+                        help='Transaction costs in basis points of the value traded')
+    parser.add_argument('--top', type=int, default=10, help='Configurations to print')
+    args = parser.parse_args()
+
+    results = run_backtest(args.source, args.start, args.end, args.thresholds, args.leverages, args.costs_bps, args.top)
+    if results.empty:
+        sys.exit(1)
@@ -0,0 +1,131 @@
+import os
+import sys
+import argparse
+import psycopg2
+import numpy as np
+from psycopg2.extras import execute_values
+from datetime import datetime
+
+from db import get_db_params
+from model_training import load_model, load_model_metadata, load_latest_sequences, get_model_dir
+from run_state import add_force_args, get_code_version, query_inputs, inputs_unchanged, save_run_state, SKIP_EXIT_CODE
+from instrumentation import instrumented, phase
+from profiling import add_profile_args, profiling_from_args
+
+
+def get_stage_inputs(metadata: dict) -> dict:
+    '''Latest feature matrix rows and version of the model, predictions only change if either does.'''
+
+    feature_matrix_tbl = get_db_params()['feature_matrix']
+
+    inputs = query_inputs({
+        'feature_matrix': (f'SELECT COUNT(*), MAX(id), MAX(date) FROM {feature_matrix_tbl}', [])
+    })
+    inputs['model'] = [metadata.get('version'), metadata.get('trained_at')]
+    inputs['code'] = get_code_version(__file__, 'model_training.py')
+
+    return inputs
+
+
+def predict_latest(model: object, sequence_length: int) -> tuple:
+    '''Score the last sequence of every ticker in a single batch.'''
+
+    print('Extracting latest sequences...')
+    tickers, dates, X = load_latest_sequences(sequence_length)
+
+    if len(X) == 0:
+        return tickers, dates, np.empty(0)
+
+    print(f'Scoring {len(X)} tickers...')
+    scores = np.asarray(model.predict_on_batch(X)).flatten()
+
+    return tickers, dates, scores
+
+
+def transform_data(tickers: np.ndarray, dates: np.ndarray, scores: np.ndarray, threshold: float, model_version: int,
+                   predicted_at: datetime) -> list:
+    return [(ticker, date, float(score), bool(score >= threshold), threshold, model_version, predicted_at)
+            for ticker, date, score in zip(tickers, dates, scores)]
+
+
+def store_results(rows: list) -> bool:
+    '''Upsert predictions, so a new model's prediction for a day replaces the previous one.'''
+
+    if not rows:
+        print('No predictions to insert.')
+        return True
+
+    print('Loading predictions into database...')
+
+    params =            get_db_params()
+    predictions_tbl =   params['predictions']
+    db_conn_params =    params['db_conn']
+
+    insert_query = f'''INSERT INTO {predictions_tbl}
+                        (ticker, date, score, predicted_up, threshold, model_version, predicted_at)
+                        VALUES %s
+                        ON CONFLICT (ticker, date) DO UPDATE
+                        SET score = EXCLUDED.score, predicted_up = EXCLUDED.predicted_up, threshold = EXCLUDED.threshold,
+                            model_version = EXCLUDED.model_version, predicted_at = EXCLUDED.predicted_at;
+    '''
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, insert_query, rows, page_size=1000)
+                conn.commit()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+        return False
+
+    print(f'Insertion successful.')
+
+    return True
+
+
+@instrumented('batch_prediction')
+def run_batch_prediction(force: bool =False) -> bool:
+    start_time = datetime.now()
+    print(f'Starting batch prediction at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    metadata = load_model_metadata()
+    if metadata is None:
+        raise FileNotFoundError('No trained model to predict with')
+
+    stage_inputs = get_stage_inputs(metadata)
+    if inputs_unchanged('batch_prediction', 'all', stage_inputs, force):
+        return False
+
+    with phase('load_model'):
+        model = load_model(os.path.join(get_model_dir(), 'lstm_model.keras'))
+    threshold = metadata.get('best_threshold', 0.5)
+
+    with phase('predict') as predict_phase:
+        tickers, dates, scores = predict_latest(model, metadata['sequence_length'])
+        rows = transform_data(tickers, dates, scores, threshold, metadata['version'], start_time)
+        predict_phase['rows'] = len(rows)
+
+    with phase('load') as load_phase:
+        stored = store_results(rows)
+        load_phase['rows'] = len(rows)
+
+    if stored:
+        save_run_state('batch_prediction', 'all', stage_inputs)
+
+    end_time = datetime.now()
+    print(f'Batch prediction finished at {end_time.strftime("%Y-%m-%d %H:%M:%S")}')
+    elapsed_time = end_time - start_time
+    print(f'Elapsed time: {elapsed_time.seconds // 60} minutes and {elapsed_time.seconds % 60} seconds')
+
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch Prediction')
+    add_force_args(parser)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    profiling_from_args(args)
+
+    if not run_batch_prediction(args.force):
+        sys.exit(SKIP_EXIT_CODE)
@@ -1,5 +1,49 @@
 from dotenv import load_dotenv
+from psycopg2.extensions import cursor
 import os
+import threading
+
+
+#Queries sent and rows received by the cursors of this process, measured by instrumentation.py
+DB_STATS = {'round_trips': 0, 'rows_fetched': 0}
+stats_lock = threading.Lock()
+
+
+def count_db_stats(round_trips: int =0, rows_fetched: int =0):
+    '''Add to the counters of this process. Cursors of worker threads count concurrently, so updates are locked.'''
+
+    with stats_lock:
+        DB_STATS['round_trips'] += round_trips
+        DB_STATS['rows_fetched'] += rows_fetched
+
+
+class CountingCursor(cursor):
+    '''Cursor that counts its round trips to the database and the rows it fetches.'''
+
+    def execute(self, query, vars=None):
+        count_db_stats(round_trips=1)
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        vars_list = list(vars_list)
+        count_db_stats(round_trips=len(vars_list)) #One statement is sent per set of parameters
+        return super().executemany(query, vars_list)
+
+    def fetchone(self):
+        record = super().fetchone()
+        count_db_stats(rows_fetched=int(record is not None))
+        return record
+
+    def fetchmany(self, size=None):
+        records = super().fetchmany(size) if size is not None else super().fetchmany()
+        count_db_stats(rows_fetched=len(records))
+        return records
+
+    def fetchall(self):
+        records = super().fetchall()
+        count_db_stats(rows_fetched=len(records))
+        return records
+
 
 def get_db_params():
     '''Loads parameters to access DB.'''
@@ -11,7 +55,8 @@ def get_db_params():
         'port':     os.getenv('FINANCIAL_DB_PORT'),
         'database': os.getenv('FINANCIAL_DB_NAME'),
         'user':     os.getenv('FINANCIAL_DB_USER'),
-        'password': os.getenv('FINANCIAL_DB_PASSWORD')
+        'password': os.getenv('FINANCIAL_DB_PASSWORD'),
+        'cursor_factory': CountingCursor
     }
 
     params = {'db_conn':            DB_CONN_PARAMS,
@@ -20,7 +65,11 @@ def get_db_params():
               'sentiment_sources':  os.getenv('SENTIMENT_SOURCES_TABLE'),
               'sentiment_analysis': os.getenv('SENTIMENT_ANALYSIS_TABLE'),
               'technical_analysis': os.getenv('TECHNICAL_ANALYSIS_TABLE'),
-              'feature_matrix':     os.getenv('FEATURE_MATRIX_TABLE')
+              'feature_matrix':     os.getenv('FEATURE_MATRIX_TABLE'),
+              'run_state':          os.getenv('RUN_STATE_TABLE'),
+              'predictions':        os.getenv('PREDICTIONS_TABLE'),
+              'intraday_bars':      os.getenv('INTRADAY_BARS_TABLE'),
+              'run_metrics':        os.getenv('RUN_METRICS_TABLE')
     }
 
     return params
\ No newline at end of file
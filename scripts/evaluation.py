@@ -0,0 +1,134 @@
+import os
+import json
+import numpy as np
+
+
+def predict_scores(model: object, X: np.ndarray) -> np.ndarray:
+    '''Score a set once, so every metric computed on it reuses the same predictions.'''
+
+    return model.predict(X, verbose=0).flatten()
+
+
+def safe_divide(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    '''Element-wise division returning 0 where the denominator is 0, as scikit-learn does by default.'''
+
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator != 0)
+
+
+def threshold_curve(y_true: np.ndarray, scores: np.ndarray) -> dict:
+    '''Classification metrics at every distinct threshold, in a single pass over the scores sorted once.
+
+    A sample is predicted positive when its score is greater than or equal to the threshold. Thresholds are
+    returned in decreasing order, preceded by +inf, at which every sample is predicted negative.
+    '''
+
+    y_true = np.asarray(y_true).astype(bool)
+    scores = np.asarray(scores)
+
+    #Sorting in the scores' own precision is cheaper, and ties need no stable order as they are cut together
+    order = np.argsort(scores)[::-1]
+    sorted_scores = scores[order]
+    sorted_labels = y_true[order]
+
+    #Lowering the threshold past each sorted score turns that sample positive, so counts are cumulative sums
+    true_positives = np.cumsum(sorted_labels)
+    false_positives = np.cumsum(~sorted_labels)
+
+    #Only the last sample of each run of tied scores is a valid cut
+    cuts = np.r_[np.flatnonzero(np.diff(sorted_scores)), len(sorted_scores) - 1] if len(sorted_scores) else np.array([], dtype=int)
+
+    thresholds = np.r_[np.inf, sorted_scores[cuts]]
+    tp = np.r_[0, true_positives[cuts]]
+    fp = np.r_[0, false_positives[cuts]]
+
+    positives = y_true.sum()
+    negatives = len(y_true) - positives
+    fn = positives - tp
+    tn = negatives - fp
+
+    return {
+        'thresholds':   thresholds,
+        'tp':           tp,
+        'fp':           fp,
+        'tn':           tn,
+        'fn':           fn,
+        'accuracy':     safe_divide(tp + tn, len(y_true)),
+        'precision':    safe_divide(tp, tp + fp),
+        'recall':       safe_divide(tp, positives),
+        'f1':           safe_divide(2 * tp, 2 * tp + fp + fn),
+        'fpr':          safe_divide(fp, negatives)
+    }
+
+
+def roc_auc(curve: dict) -> float:
+    '''Area under the ROC curve, by the trapezoidal rule over the points of a threshold curve.'''
+
+    if curve['tp'][-1] == 0 or curve['fp'][-1] == 0:
+        return None #Undefined with a single class
+
+    return float(np.trapz(curve['recall'], curve['fpr']))
+
+
+def metrics_at_threshold(y_true: np.ndarray, scores: np.ndarray, threshold: float) -> dict:
+    '''Classification metrics of the predictions obtained with a given threshold.'''
+
+    y_true = np.asarray(y_true).astype(bool)
+    predicted = np.asarray(scores) >= threshold
+
+    tp = int(np.sum(predicted & y_true))
+    fp = int(np.sum(predicted & ~y_true))
+    fn = int(np.sum(~predicted & y_true))
+    tn = int(np.sum(~predicted & ~y_true))
+
+    return {
+        'threshold':        float(threshold),
+        'samples':          int(len(y_true)),
+        'accuracy':         float(safe_divide(tp + tn, len(y_true))),
+        'precision':        float(safe_divide(tp, tp + fp)),
+        'recall':           float(safe_divide(tp, tp + fn)),
+        'f1':               float(safe_divide(2 * tp, 2 * tp + fp + fn)),
+        'confusion_matrix': [[tn, fp], [fn, tp]]
+    }
+
+
+def best_threshold(curve: dict, metric: str ='accuracy') -> tuple:
+    '''Threshold maximizing a metric of a threshold curve, and the value reached.'''
+
+    #+inf only predicts negatives and is not a usable cut
+    best_index = int(np.argmax(curve[metric][1:])) + 1
+
+    return float(curve['thresholds'][best_index]), float(curve[metric][best_index])
+
+
+def build_evaluation_report(y_val: np.ndarray, val_scores: np.ndarray, y_test: np.ndarray, test_scores: np.ndarray,
+                            default_threshold: float =0.5) -> dict:
+    '''Evaluate validation and test predictions at the default threshold and at the best one for the validation set.'''
+
+    val_curve = threshold_curve(y_val, val_scores)
+    threshold, _ = best_threshold(val_curve, 'accuracy')
+
+    return {
+        'validation': {
+            'default_threshold':    metrics_at_threshold(y_val, val_scores, default_threshold),
+            'best_threshold':       metrics_at_threshold(y_val, val_scores, threshold),
+            'auc':                  roc_auc(val_curve),
+            'distinct_thresholds':  int(len(val_curve['thresholds']) - 1)
+        },
+        'test': {
+            'default_threshold':    metrics_at_threshold(y_test, test_scores, default_threshold),
+            'best_threshold':       metrics_at_threshold(y_test, test_scores, threshold),
+            'auc':                  roc_auc(threshold_curve(y_test, test_scores))
+        },
+        'best_threshold': threshold
+    }
+
+
+def save_report(report: dict, path: str):
+    '''Write a metrics report as JSON.'''
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
@@ -2,11 +2,44 @@ import pandas as pd
 import psycopg2
 from psycopg2.extras import execute_values
 from datetime import datetime
+import argparse
+import sys
 
 from db import get_db_params
+from shards import add_shard_args, shard_from_args, shard_filter, shard_label
+from run_state import add_force_args, get_code_version, query_inputs, inputs_unchanged, save_run_state, SKIP_EXIT_CODE
+from instrumentation import instrumented, phase
+from profiling import add_profile_args, profiling_from_args
 
 
-def get_data() -> dict:
+def get_stage_inputs(shard: dict =None) -> dict:
+    '''Cheap summary of the technical and sentiment analysis results joined, to detect when there is nothing new.'''
+
+    params =                    get_db_params()
+    asset_price_tbl =           params['assets_price']
+    technical_analysis_tbl =    params['technical_analysis']
+    sentiment_analysis_tbl =    params['sentiment_analysis']
+    sentiment_sources_tbl =     params['sentiment_sources']
+
+    prices_condition, prices_params = shard_filter(shard, 'a.ticker')
+    sentiment_condition, sentiment_params = shard_filter(shard, 's.ticker')
+
+    inputs = query_inputs({
+        'technical_analysis': (f'''SELECT COUNT(*), MAX(t.id), MAX(t.computed_at)
+                                  FROM {technical_analysis_tbl} t
+                                  JOIN {asset_price_tbl} a ON a.price_id = t.asset_price_id
+                                  WHERE {prices_condition}''', prices_params),
+        'sentiment_analysis': (f'''SELECT COUNT(*), MAX(a.id), MAX(a.analyzed_at)
+                                  FROM {sentiment_analysis_tbl} a
+                                  JOIN {sentiment_sources_tbl} s ON a.source_id = s.content_id
+                                  WHERE {sentiment_condition}''', sentiment_params)
+    })
+    inputs['code'] = get_code_version(__file__, 'shards.py')
+
+    return inputs
+
+
+def get_data(shard: dict =None) -> dict:
     '''Retrieve prices, technical analysis metrics and sentiment data.'''
 
     print('Extracting prices, metrics and sentiment data from database...')
@@ -23,32 +56,34 @@ def get_data() -> dict:
     ]
     sentiment_columns = ['a.source_id', 'a.sentiment_score', 'a.score_confidence', 's.published_date', 's.ticker']
 
+    prices_condition, prices_params = shard_filter(shard, 'a.ticker')
+    sentiment_condition, sentiment_params = shard_filter(shard, 's.ticker')
+
     prices_query = f'''SELECT {", ".join(prices_columns)}
                         FROM {asset_price_tbl} a
                         LEFT JOIN {technical_analysis_tbl} t
                         ON a.price_id = t.asset_price_id
-                        WHERE a.ticker = 'SPY'
-                        AND t.asset_price_id IS NOT NULL; --technical metrics have been computed
+                        WHERE {prices_condition}
+                        AND t.asset_price_id IS NOT NULL --technical metrics have been computed
+                        ORDER BY a.ticker, a.date;
     '''
-    sentiment_query = f'''SELECT {", ".join(sentiment_columns)}
+    #Latest analysis of each source, as a backfill reanalyzes only the sources of its date range
+    sentiment_query = f'''SELECT DISTINCT ON (a.source_id) {", ".join(sentiment_columns)}
                             FROM {sentiment_analysis_tbl} a
                             LEFT JOIN {sentiment_sources_tbl} s
                             ON a.source_id = s.content_id
-                            WHERE a.analyzed_at = (
-                                SELECT MAX(analyzed_at)
-                                FROM analytics.sentiment_analysis
-                            )
-                            AND s.ticker = 'SPY';
+                            WHERE {sentiment_condition}
+                            ORDER BY a.source_id, a.analyzed_at DESC;
     '''
     
     try:
         with psycopg2.connect(**db_conn_params) as conn:
             with conn.cursor() as cur:
-                cur.execute(prices_query)
+                cur.execute(prices_query, prices_params)
                 conn.commit()
                 prices = cur.fetchall()
 
-                cur.execute(sentiment_query)
+                cur.execute(sentiment_query, sentiment_params)
                 conn.commit()
                 sentiments = cur.fetchall()
     except psycopg2.Error as e:
@@ -94,7 +129,12 @@ def compute_final_matrix(data: dict) -> pd.DataFrame:
     columns_to_drop = ['a.source_id', 'a.sentiment_score', 'a.score_confidence', 's.published_date', 's.ticker']
     prices_df = prices_df.drop(columns_to_drop, axis=1)
 
-    #Compute target columns
+    #The join repeats a date once per source, all with the same aggregated score, so each date is kept once to
+    #compute its label against the next date rather than against itself
+    prices_df = prices_df.drop_duplicates(['a.ticker', 'a.date'])
+
+    #Compute target columns. Rows of several tickers come back from the database in no particular order
+    prices_df = prices_df.sort_values(['a.ticker', 'a.date'], kind='stable').reset_index(drop=True)
     prices_df['next_close'] = prices_df.groupby('a.ticker')['a.close'].shift(-1)
     prices_df['next_day_return'] = (prices_df['next_close'] - prices_df['a.close']) / prices_df['a.close']
     prices_df['next_day_up'] = prices_df['next_day_return'] > 0
@@ -121,12 +161,12 @@ def transform_data(df: pd.DataFrame) -> list:
     return rows
 
 
-def store_results(rows: list):
+def store_results(rows: list) -> bool:
     '''Insert rows into the database using bulk insert.'''
 
     if not rows:
         print('No new data to insert.')
-        return
+        return True
     
     print('Loading feature matrix into database...')
     
@@ -148,27 +188,53 @@ def store_results(rows: list):
                 conn.commit()
     except psycopg2.Error as e:
         print(f'Database error: {e}')
-        return
+        return False
         
     print(f'Insertion successful.')
 
+    return True
 
-def run_feature_matrix_etl():
+
+@instrumented('feature_matrix_build')
+def run_feature_matrix_etl(shard: dict =None, force: bool =False) -> bool:
     start_time = datetime.now()
-    print(f'Starting Feature Matrix Build at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+    print(f'Starting Feature Matrix Build for assets {shard_label(shard)} at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    stage_inputs = get_stage_inputs(shard)
+    if inputs_unchanged('feature_matrix_build', shard_label(shard), stage_inputs, force):
+        return False
 
     #Extract
-    base_data = get_data()
+    with phase('extract') as extract_phase:
+        base_data = get_data(shard)
+        extract_phase['rows'] = len(base_data['prices']) + len(base_data['sentiments'])
 
     #Transform
-    matrix = compute_final_matrix(base_data)
-    rows = transform_data(matrix)
+    with phase('transform') as transform_phase:
+        matrix = compute_final_matrix(base_data)
+        rows = transform_data(matrix)
+        transform_phase['rows'] = len(rows)
 
     #Load
-    store_results(rows)
+    with phase('load') as load_phase:
+        stored = store_results(rows)
+        load_phase['rows'] = len(rows)
+
+    if stored:
+        save_run_state('feature_matrix_build', shard_label(shard), stage_inputs)
 
     print(f'Feature Matrix Build finished at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
 
+    return True
+
 
 if __name__ == '__main__':
-    run_feature_matrix_etl()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Feature Matrix Build')
+    add_shard_args(parser)
+    add_force_args(parser)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    profiling_from_args(args)
+
+    if not run_feature_matrix_etl(shard_from_args(args), args.force):
+        sys.exit(SKIP_EXIT_CODE)
\ No newline at end of file
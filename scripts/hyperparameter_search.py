@@ -0,0 +1,247 @@
+import os
+import json
+import math
+import random
+import argparse
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+
+from model_training import (load_feature_matrix, get_sequence_dates, build_time_ordered_sequences, rolling_window_split,
+                            build_LSTM, configure_tf_threads, get_model_dir, load_model)
+
+
+SEARCH_SPACE = {
+    'units':            [32, 64, 90, 128],
+    'dropout':          [0.0, 0.1, 0.2, 0.3],
+    'learning_rate':    (1e-4, 1e-2), #Sampled log-uniformly
+    'sequence_length':  [5, 10, 20, 30],
+    'batch_size':       [32, 64, 128, 256]
+}
+
+#Set in each worker process by init_trial_worker
+_matrix = None
+_split_dates = None
+_splits = {}
+
+
+def sample_trials(num_trials: int, seed: int =0) -> list:
+    '''Draw trial configurations from the search space. The same seed always gives the same trials.'''
+
+    rng = random.Random(seed)
+    low, high = SEARCH_SPACE['learning_rate']
+
+    trials = []
+    for trial_id in range(num_trials):
+        trials.append({
+            'trial_id':         trial_id,
+            'units':            rng.choice(SEARCH_SPACE['units']),
+            'dropout':          rng.choice(SEARCH_SPACE['dropout']),
+            'learning_rate':    10 ** rng.uniform(math.log10(low), math.log10(high)),
+            'sequence_length':  rng.choice(SEARCH_SPACE['sequence_length']),
+            'batch_size':       rng.choice(SEARCH_SPACE['batch_size'])
+        })
+
+    return trials
+
+
+def get_rung_epochs(min_epochs: int, max_epochs: int, eta: int) -> list:
+    '''Cumulative epochs trained by the survivors of each rung: min_epochs, min_epochs*eta... up to max_epochs.'''
+
+    rungs = [min_epochs]
+    while rungs[-1] * eta < max_epochs:
+        rungs.append(rungs[-1] * eta)
+    if rungs[-1] < max_epochs:
+        rungs.append(max_epochs)
+
+    return rungs
+
+
+def get_split_dates(matrix: object) -> tuple:
+    '''First validation and first test date, those of the split of the longest sequences, shared by every trial.'''
+
+    dates = np.sort(np.asarray(get_sequence_dates(matrix, max(SEARCH_SPACE['sequence_length'])), dtype='datetime64[D]'))
+    _, val_dates, test_dates, _, _, _ = rolling_window_split(dates, dates, dates=dates)
+
+    #Without test sequences, validation runs to the last date
+    return val_dates[0], test_dates[0] if len(test_dates) else dates[-1] + 1
+
+
+def init_trial_worker(matrix: object, split_dates: tuple, tf_threads: int):
+    '''Keep the feature matrix in the worker process; windowed sets are built once per sequence length.'''
+
+    global _matrix, _split_dates
+    _matrix = matrix
+    _split_dates = split_dates
+
+    configure_tf_threads(tf_threads)
+
+
+def get_split(sequence_length: int) -> tuple:
+    '''Training and validation sets for a sequence length, cached in the worker. The test set is left untouched.
+
+    Trials are ranked by validation loss, so every sequence length is split at the same dates and keeps only the
+    sequences labeled on rows that the longest sequences label too: all trials validate on the same rows.
+    '''
+
+    if sequence_length not in _splits:
+        X, y, dates = build_time_ordered_sequences(_matrix, sequence_length)
+
+        skipped = max(SEARCH_SPACE['sequence_length']) - sequence_length
+        labeled = np.concatenate([np.arange(max(len(group) - sequence_length, 0)) >= skipped
+                                  for _, group in _matrix.groupby('m.ticker')])
+        #Same order as build_time_ordered_sequences gives the sequences
+        order = np.argsort(np.asarray(get_sequence_dates(_matrix, sequence_length), dtype='datetime64[D]'), kind='stable')
+        keep = labeled[order]
+        X, y, dates = X[keep].astype(np.float64), y[keep], dates[keep]
+
+        val_start, test_start = _split_dates
+        train = dates < val_start
+        val = (dates >= val_start) & (dates < test_start)
+        _splits[sequence_length] = (X[train], y[train], X[val], y[val])
+
+    return _splits[sequence_length]
+
+
+def train_trial(trial: dict, rung: int, epochs: int, previous_epochs: int, models_dir: str) -> dict:
+    '''Train a trial up to a number of epochs, continuing from its model of the previous rung.
+
+    The full model is saved, not only its weights, so a trial continues with its optimizer state as if it had
+    never stopped.
+    '''
+
+    start = datetime.now()
+    X_train, y_train, X_val, y_val = get_split(trial['sequence_length'])
+
+    model_path = os.path.join(models_dir, f'trial_{trial["trial_id"]}.keras')
+    if previous_epochs and os.path.exists(model_path):
+        model = load_model(model_path)
+    else:
+        model = build_LSTM(trial['sequence_length'], X_train.shape[2], trial['units'], trial['dropout'], trial['learning_rate'])
+        previous_epochs = 0
+
+    history = model.fit(X_train, y_train,
+                        validation_data=(X_val, y_val),
+                        initial_epoch=previous_epochs,
+                        epochs=epochs,
+                        batch_size=trial['batch_size'],
+                        shuffle=False,  #Time series mustn't be shuffled
+                        verbose=0
+    )
+
+    #Renamed into place once complete, so an interruption never leaves a partial model to continue from
+    tmp_path = os.path.join(models_dir, f'trial_{trial["trial_id"]}.tmp.keras')
+    model.save(tmp_path)
+    os.replace(tmp_path, model_path)
+
+    return {
+        'trial_id':     trial['trial_id'],
+        'rung':         rung,
+        'epochs':       epochs,
+        'val_loss':     float(min(history.history['val_loss'])),
+        'val_accuracy': float(max(history.history['val_accuracy'])),
+        'seconds':      (datetime.now() - start).total_seconds()
+    }
+
+
+def load_results(path: str) -> dict:
+    '''Results of the trials already evaluated, by trial and rung.'''
+
+    results = {}
+
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                result = json.loads(line)
+                results[(result['trial_id'], result['rung'])] = result
+
+    return results
+
+
+def append_result(path: str, result: dict):
+    with open(path, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+
+
+def run_search(name: str ='default', num_trials: int =27, min_epochs: int =4, max_epochs: int =108, eta: int =3,
+               workers: int =None, seed: int =0) -> dict:
+    '''Successive halving: all trials train a few epochs, only the best 1/eta continue to the next rung.'''
+
+    start_time = datetime.now()
+    print(f'Starting hyperparameter search {name} at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    search_dir = os.path.join(get_model_dir(), 'search', name)
+    models_dir = os.path.join(search_dir, 'models')
+    os.makedirs(models_dir, exist_ok=True)
+
+    #A search resumes only with the same settings, otherwise its stored results would not be comparable
+    settings = {'num_trials': num_trials, 'min_epochs': min_epochs, 'max_epochs': max_epochs, 'eta': eta,
+                'seed': seed, 'search_space': SEARCH_SPACE}
+    settings_path = os.path.join(search_dir, 'search.json')
+    if os.path.exists(settings_path):
+        with open(settings_path) as f:
+            if json.load(f) != json.loads(json.dumps(settings)):
+                raise ValueError(f'Search {name} exists with other settings, use another name')
+    else:
+        with open(settings_path, 'w') as f:
+            json.dump(settings, f, indent=2)
+
+    results_path = os.path.join(search_dir, 'trials.jsonl')
+    results = load_results(results_path)
+    if results:
+        print(f'Resuming search with {len(results)} trial results already stored.')
+
+    trials = sample_trials(num_trials, seed)
+    rungs = get_rung_epochs(min_epochs, max_epochs, eta)
+
+    matrix = load_feature_matrix()
+    split_dates = get_split_dates(matrix)
+    print(f'Validating every trial from {split_dates[0]} to {split_dates[1]}, excluded.')
+    workers = workers or os.cpu_count()
+    tf_threads = max(1, os.cpu_count() // workers)
+
+    survivors = trials
+    #TensorFlow is not fork-safe, so workers are spawned
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_trial_worker, initargs=(matrix, split_dates, tf_threads)) as executor:
+        for rung, epochs in enumerate(rungs):
+            previous_epochs = rungs[rung - 1] if rung > 0 else 0
+            pending = [trial for trial in survivors if (trial['trial_id'], rung) not in results]
+            print(f'Rung {rung}: {len(survivors)} trials up to {epochs} epochs, {len(pending)} to train...')
+
+            futures = [executor.submit(train_trial, trial, rung, epochs, previous_epochs, models_dir) for trial in pending]
+            for future in as_completed(futures):
+                result = future.result()
+                results[(result['trial_id'], rung)] = result
+                append_result(results_path, result)
+                print(f'Trial {result["trial_id"]}: val loss {result["val_loss"]:.4f} after {epochs} epochs ({result["seconds"]:.0f}s)')
+
+            #Prune: only the best trials of this rung keep training
+            ranked = sorted(survivors, key=lambda trial: results[(trial['trial_id'], rung)]['val_loss'])
+            if rung < len(rungs) - 1:
+                survivors = ranked[:max(1, len(ranked) // eta)]
+
+    best_trial = ranked[0]
+    best = {'trial': best_trial, 'result': results[(best_trial['trial_id'], len(rungs) - 1)]}
+    with open(os.path.join(search_dir, 'best.json'), 'w') as f:
+        json.dump(best, f, indent=2)
+
+    print(f'Best trial: {json.dumps(best, indent=2)}')
+    print(f'Hyperparameter search finished at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Hyperparameter search for the LSTM model with successive halving')
+    parser.add_argument('--name', type=str, default='default', help='Search to create or resume')
+    parser.add_argument('--trials', type=int, default=27)
+    parser.add_argument('--min-epochs', type=int, default=4, help='Epochs of every trial before the first pruning')
+    parser.add_argument('--max-epochs', type=int, default=108, help='Epochs of the trials surviving all prunings')
+    parser.add_argument('--eta', type=int, default=3, help='Only 1 in eta trials survives each pruning')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run_search(args.name, args.trials, args.min_epochs, args.max_epochs, args.eta, args.workers, args.seed)
@@ -0,0 +1,211 @@
+import math
+import argparse
+import numpy as np
+import pandas as pd
+
+
+#Weight below which the prices left out of an exponentially weighted average are considered negligible
+EWM_TOLERANCE = 1e-12
+
+
+def sma_lookback(length: int) -> int:
+    return length - 1
+
+
+def ewm_lookback(alpha: float) -> int:
+    '''Past rows an exponentially weighted average needs for the weight of the rest to be negligible.'''
+
+    return math.ceil(math.log(EWM_TOLERANCE) / math.log(1 - alpha))
+
+
+def span_alpha(span: int) -> float:
+    return 2 / (span + 1)
+
+
+def rolling_mean(cumsum: np.ndarray, length: int) -> np.ndarray:
+    '''Mean of the last length values at each row, from the cumulative sum of the values.'''
+
+    mean = np.full(len(cumsum), np.nan)
+    if len(cumsum) >= length:
+        mean[length - 1:] = (cumsum[length - 1:] - np.r_[0, cumsum[:-length]]) / length
+
+    return mean
+
+
+def ewm_mean(values: np.ndarray, alpha: float, min_periods: int =0) -> np.ndarray:
+    return pd.Series(values).ewm(alpha=alpha, min_periods=min_periods).mean().to_numpy()
+
+
+#Series shared by several indicators, computed at most once per ticker. Each one declares the series it is
+#computed from, either other intermediates or the price columns
+INTERMEDIATES = {
+    'close_diff':       {'inputs': ['close'], 'function': lambda close: np.r_[np.nan, np.diff(close)]},
+    'gains':            {'inputs': ['close_diff'], 'function': lambda diff: np.where(diff > 0, diff, np.where(np.isnan(diff), np.nan, 0))},
+    'losses':           {'inputs': ['close_diff'], 'function': lambda diff: np.where(diff < 0, -diff, np.where(np.isnan(diff), np.nan, 0))},
+    'prev_close':       {'inputs': ['close'], 'function': lambda close: np.r_[np.nan, close[:-1]]},
+    #Prices are centered on the first one so that sums of squares keep their precision
+    'close_centered':   {'inputs': ['close'], 'function': lambda close: close - close[0] if len(close) else close},
+    'close_cumsum':     {'inputs': ['close_centered'], 'function': np.cumsum},
+    'close_sq_cumsum':  {'inputs': ['close_centered'], 'function': lambda centered: np.cumsum(centered ** 2)},
+    'volume_cumsum':    {'inputs': ['volume'], 'function': np.cumsum},
+    'true_range':       {'inputs': ['high', 'low', 'prev_close'],
+                         'function': lambda high, low, prev_close: np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))},
+    'avg_gain_14':      {'inputs': ['gains'], 'function': lambda gains: ewm_mean(gains, 1 / 14, min_periods=14)},
+    'avg_loss_14':      {'inputs': ['losses'], 'function': lambda losses: ewm_mean(losses, 1 / 14, min_periods=14)},
+    'sma_20_centered':  {'inputs': ['close_cumsum'], 'function': lambda cumsum: rolling_mean(cumsum, 20)},
+    'std_20':           {'inputs': ['close_cumsum', 'close_sq_cumsum'],
+                         'function': lambda cumsum, sq_cumsum: np.sqrt(np.maximum(rolling_mean(sq_cumsum, 20) - rolling_mean(cumsum, 20) ** 2, 0))},
+    'ema_12':           {'inputs': ['close'], 'function': lambda close: ewm_mean(close, span_alpha(12))},
+    'ema_26':           {'inputs': ['close'], 'function': lambda close: ewm_mean(close, span_alpha(26))},
+    'macd_line':        {'inputs': ['ema_12', 'ema_26'], 'function': lambda fast, slow: fast - slow},
+    'macd_signal_line': {'inputs': ['macd_line'], 'function': lambda macd: ewm_mean(macd, span_alpha(9))}
+}
+
+#Indicators stored in the technical analysis table, in column order. Lookback is the number of past rows an
+#indicator depends on, so metrics of new dates can be computed exactly from that many rows of history
+INDICATORS = [
+    {'name': 'sma_10', 'inputs': ['close', 'close_cumsum'], 'lookback': sma_lookback(10),
+     'function': lambda close, cumsum: rolling_mean(cumsum, 10) + close[0],
+     'description': 'simple moving average of price of 10 past data points'},
+    {'name': 'sma_20', 'inputs': ['close', 'sma_20_centered'], 'lookback': sma_lookback(20),
+     'function': lambda close, centered: centered + close[0],
+     'description': 'simple moving average of price of 20 past data points'},
+    {'name': 'ema_10', 'inputs': ['close'], 'lookback': ewm_lookback(span_alpha(10)),
+     'function': lambda close: ewm_mean(close, span_alpha(10)),
+     'description': 'exponential moving average of price of 10 past data points'},
+    {'name': 'ema_20', 'inputs': ['close'], 'lookback': ewm_lookback(span_alpha(20)),
+     'function': lambda close: ewm_mean(close, span_alpha(20)),
+     'description': 'exponential moving average of price of 20 past data points'},
+    {'name': 'rsi_14', 'inputs': ['avg_gain_14', 'avg_loss_14'], 'lookback': ewm_lookback(1 / 14) + 1,
+     'function': lambda avg_gain, avg_loss: 100 * avg_gain / (avg_gain + avg_loss),
+     'description': 'relative strength index of 14 past data points'},
+    {'name': 'daily_return', 'inputs': ['close_diff', 'prev_close'], 'lookback': 1,
+     'function': lambda diff, prev_close: diff / prev_close,
+     'description': 'percentage change in asset price'},
+    {'name': 'volume_sma_10', 'inputs': ['volume_cumsum'], 'lookback': sma_lookback(10),
+     'function': lambda cumsum: rolling_mean(cumsum, 10),
+     'description': 'simple moving average of trading volume of 10 past data points'},
+    {'name': 'macd', 'inputs': ['macd_line'], 'lookback': ewm_lookback(span_alpha(26)),
+     'function': lambda macd: macd,
+     'description': 'moving average convergence divergence, EMA of 12 minus EMA of 26 data points'},
+    {'name': 'macd_signal', 'inputs': ['macd_signal_line'], 'lookback': ewm_lookback(span_alpha(26)) + ewm_lookback(span_alpha(9)),
+     'function': lambda signal: signal,
+     'description': 'exponential moving average of 9 data points of the MACD'},
+    {'name': 'macd_histogram', 'inputs': ['macd_line', 'macd_signal_line'], 'lookback': ewm_lookback(span_alpha(26)) + ewm_lookback(span_alpha(9)),
+     'function': lambda macd, signal: macd - signal,
+     'description': 'MACD minus its signal line'},
+    {'name': 'bollinger_upper_20', 'inputs': ['close', 'sma_20_centered', 'std_20'], 'lookback': sma_lookback(20),
+     'function': lambda close, centered, std: centered + close[0] + 2 * std,
+     'description': 'simple moving average of 20 data points plus 2 standard deviations'},
+    {'name': 'bollinger_lower_20', 'inputs': ['close', 'sma_20_centered', 'std_20'], 'lookback': sma_lookback(20),
+     'function': lambda close, centered, std: centered + close[0] - 2 * std,
+     'description': 'simple moving average of 20 data points minus 2 standard deviations'},
+    {'name': 'atr_14', 'inputs': ['true_range'], 'lookback': ewm_lookback(1 / 14) + 1,
+     'function': lambda true_range: ewm_mean(true_range, 1 / 14, min_periods=14),
+     'description': 'average true range of 14 past data points'}
+]
+
+PRICE_COLUMNS = ['open', 'close', 'high', 'low', 'volume']
+
+
+def get_indicator_names() -> list:
+    return [indicator['name'] for indicator in INDICATORS]
+
+
+def get_lookback_rows() -> int:
+    '''Rows of history needed before a date for all its indicators to be exact.'''
+
+    return max(indicator['lookback'] for indicator in INDICATORS)
+
+
+def resolve(name: str, series: dict) -> np.ndarray:
+    '''Compute an intermediate series, and the ones it depends on, unless already in the series computed.'''
+
+    if name not in series:
+        intermediate = INTERMEDIATES[name]
+        series[name] = intermediate['function'](*(resolve(input_name, series) for input_name in intermediate['inputs']))
+
+    return series[name]
+
+
+def compute_indicators(prices: pd.DataFrame) -> pd.DataFrame:
+    '''Compute every indicator of the registry for the prices of a single ticker, sorted by date.'''
+
+    series = {column: prices[column].to_numpy(dtype=np.float64) for column in PRICE_COLUMNS if column in prices}
+
+    indicators = {}
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for indicator in INDICATORS:
+            inputs = [resolve(input_name, series) for input_name in indicator['inputs']]
+            indicators[indicator['name']] = indicator['function'](*inputs)
+
+    return pd.DataFrame(indicators, index=prices.index)
+
+
+def get_columns_ddl() -> list:
+    '''Column definitions of the indicators for the technical analysis table.'''
+
+    return [f'{indicator["name"]} real,' for indicator in INDICATORS]
+
+
+def get_table_ddl(table: str ='analytics.technical_analysis') -> str:
+    '''DDL of the technical analysis table, with a column per indicator of the registry.'''
+
+    def column(definition: str, description: str) -> str:
+        return f'    {definition:<44}-- {description}'
+
+    constraint_name = table.split('.')[-1]
+    lines = [
+        f'-- Table: {table}',
+        '',
+        '-- Stores technical analysis metrics of the asset prices. Metrics are calculated with the closing price.',
+        '-- Generated from the indicator registry in scripts/indicators.py with: python indicators.py ddl',
+        '',
+        f'-- DROP TABLE IF EXISTS {table};',
+        '',
+        f'CREATE TABLE IF NOT EXISTS {table}',
+        '(',
+        column('id serial NOT NULL,', 'id'),
+        column('asset_price_id integer NOT NULL,', 'id in table inputs.asset_prices from which the metrics are calculated')
+    ]
+    lines += [column(definition, indicator['description']) for definition, indicator in zip(get_columns_ddl(), INDICATORS)]
+    lines += [
+        column('computed_at timestamp without time zone,', 'time when the metric was computed'),
+        f'    CONSTRAINT {constraint_name}_pkey PRIMARY KEY (id),',
+        f'    CONSTRAINT {constraint_name}_asset_price_id_key UNIQUE (asset_price_id),',
+        '    CONSTRAINT fk_asset_price_id FOREIGN KEY (asset_price_id)',
+        '        REFERENCES inputs.asset_prices (price_id) MATCH SIMPLE',
+        '        ON UPDATE NO ACTION',
+        '        ON DELETE CASCADE',
+        ')',
+        '',
+        'TABLESPACE pg_default;',
+        '',
+        f'ALTER TABLE IF EXISTS {table}',
+        '    OWNER to postgres;'
+    ]
+
+    return '\n'.join(lines)
+
+
+def get_alter_ddl(table: str ='analytics.technical_analysis') -> str:
+    '''Statements adding the columns of indicators missing from an existing technical analysis table.'''
+
+    return '\n'.join(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {definition.rstrip(",")};' for definition in get_columns_ddl())
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Technical analysis indicator registry')
+    parser.add_argument('command', choices=['ddl', 'alter', 'list'],
+                        help='Print the table DDL, the statements to add new indicator columns, or the indicators')
+    parser.add_argument('--table', type=str, default='analytics.technical_analysis')
+    args = parser.parse_args()
+
+    if args.command == 'ddl':
+        print(get_table_ddl(args.table))
+    elif args.command == 'alter':
+        print(get_alter_ddl(args.table))
+    else:
+        for indicator in INDICATORS:
+            print(f'{indicator["name"]:<20} lookback {indicator["lookback"]:>4}  {indicator["description"]}')
+        print(f'Lookback rows needed: {get_lookback_rows()}')
@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import resource
+import threading
+import functools
+import inspect
+import psycopg2
+from psycopg2.extras import execute_values
+from contextlib import contextmanager
+from datetime import datetime
+
+from db import get_db_params, DB_STATS
+from shards import shard_label
+import profiling
+
+
+#Measures of every phase, in the order they are stored and exported
+PHASE_METRICS = ['seconds', 'cpu_seconds', 'rows', 'db_round_trips', 'db_rows_fetched', 'bytes_fetched',
+                 'process_peak_memory_mb']
+
+#Run being measured in this process, and the last one finished
+state = {'run': None, 'last_run': None, 'bytes_fetched': 0}
+bytes_lock = threading.Lock()
+
+
+def get_metrics_dir() -> str:
+    '''Directory of the Prometheus textfiles and of the JSON lines history of runs.'''
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+    return os.getenv('METRICS_DIR', os.path.join(os.path.dirname(scripts_dir), 'logs', 'metrics'))
+
+
+def count_bytes(num_bytes: int):
+    '''Add the size of a response fetched from an external source to the current run.'''
+
+    with bytes_lock:
+        state['bytes_fetched'] += num_bytes
+
+
+def get_process_peak_memory_mb() -> float:
+    '''Peak resident memory of the process since it started, not of the current phase.'''
+
+    #ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def take_snapshot() -> dict:
+    '''Process-wide counters, whose differences between two snapshots measure what happened in between.'''
+
+    return {
+        'seconds':          time.perf_counter(),
+        'cpu_seconds':      time.process_time(),
+        'db_round_trips':   DB_STATS['round_trips'],
+        'db_rows_fetched':  DB_STATS['rows_fetched'],
+        'bytes_fetched':    state['bytes_fetched']
+    }
+
+
+def measure(start: dict, rows: int =None) -> dict:
+    end = take_snapshot()
+
+    metrics = {name: end[name] - start[name] for name in start}
+    metrics['rows'] = rows
+    metrics['process_peak_memory_mb'] = get_process_peak_memory_mb()
+
+    return metrics
+
+
+@contextmanager
+def phase(name: str):
+    '''Measure a phase of the current run, e.g. extract, transform or load.
+
+    Yields a dict where the phase sets the number of rows it produced under 'rows'. Outside a run nothing is measured.
+    '''
+
+    run = state['run']
+    phase_info = {'rows': None}
+
+    if run is None:
+        yield phase_info
+        return
+
+    start = take_snapshot()
+    started_at = datetime.now()
+    profiling.start_phase()
+    try:
+        yield phase_info
+    finally:
+        metrics = measure(start, phase_info['rows'])
+        run['phases'].append({'phase': name, 'started_at': started_at, **metrics})
+        profiling.snapshot_phase(name)
+
+
+def instrumented(stage: str):
+    '''Decorator of the run_* function of a stage, which measures it as a whole along with the phases within.
+
+    A run returning False is recorded as skipped and one raising an exception as failed. Metrics are printed, stored
+    in the run metrics table and written as a Prometheus textfile and a JSON line. If profiling is enabled, the run is
+    profiled too, see profiling.py.
+    '''
+
+    def decorator(run_function):
+        signature = inspect.signature(run_function)
+
+        @functools.wraps(run_function)
+        def wrapper(*args, **kwargs):
+            #Runs called from another run are measured as part of it
+            if state['run'] is not None:
+                return run_function(*args, **kwargs)
+
+            arguments = signature.bind(*args, **kwargs).arguments
+            run = {
+                'run_id':       uuid.uuid4().hex,
+                'stage':        stage,
+                'shard':        shard_label(arguments.get('shard')),
+                'started_at':   datetime.now(),
+                'status':       'failed',
+                'phases':       []
+            }
+            state['run'] = run
+            profile = profiling.start_profile(stage, run['shard']) if profiling.is_enabled() else None
+            start = take_snapshot()
+
+            try:
+                result = run_function(*args, **kwargs)
+                run['status'] = 'skipped' if result is False else 'succeeded'
+                return result
+            finally:
+                #Rows of a run are those of its last phase reporting any, usually the rows loaded
+                rows = [phase_info['rows'] for phase_info in run['phases'] if phase_info['rows'] is not None]
+                run['total'] = measure(start, rows[-1] if rows else None)
+                state['run'] = None
+                state['last_run'] = run
+                if profile is not None:
+                    profiling.stop_profile(profile)
+                export_run(run)
+
+        return wrapper
+
+    return decorator
+
+
+def print_run_metrics(run: dict):
+    print(f'Metrics of {run["stage"]} for assets {run["shard"]} ({run["status"]}):')
+    print(f'{"Phase":<12}{"Seconds":>10}{"CPU (s)":>10}{"Rows":>10}{"DB trips":>10}{"DB rows":>10}{"Bytes":>12}{"Proc peak MB":>14}')
+
+    for phase_info in run['phases'] + [{'phase': 'total', **run['total']}]:
+        rows = '' if phase_info['rows'] is None else phase_info['rows']
+        print(f'{phase_info["phase"]:<12}{phase_info["seconds"]:>10.2f}{phase_info["cpu_seconds"]:>10.2f}{rows:>10}'
+              f'{phase_info["db_round_trips"]:>10}{phase_info["db_rows_fetched"]:>10}{phase_info["bytes_fetched"]:>12}'
+              f'{phase_info["process_peak_memory_mb"]:>14.0f}')
+
+
+def get_phase_rows(run: dict) -> list:
+    '''Metrics of each phase of a run plus the whole run as phase 'total', as rows of the run metrics table.'''
+
+    phases = run['phases'] + [{'phase': 'total', 'started_at': run['started_at'], **run['total']}]
+
+    return [(run['run_id'], run['stage'], run['shard'], phase_info['phase'], run['status'], phase_info['started_at'],
+             *[phase_info[name] for name in PHASE_METRICS])
+            for phase_info in phases]
+
+
+def store_run_metrics(run: dict):
+    '''Insert the metrics of every phase of a run into the database.'''
+
+    params =            get_db_params()
+    run_metrics_tbl =   params['run_metrics']
+    db_conn_params =    params['db_conn']
+
+    if run_metrics_tbl is None:
+        return
+
+    insert_query = f'''INSERT INTO {run_metrics_tbl}
+                        (run_id, stage, shard, phase, status, started_at, {", ".join(PHASE_METRICS)})
+                        VALUES %s;
+    '''
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, insert_query, get_phase_rows(run))
+                conn.commit()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+
+
+def format_textfile(run: dict) -> str:
+    '''Metrics of the last run of a stage in the Prometheus text format, for the node exporter's textfile collector.'''
+
+    labels = f'stage="{run["stage"]}",shard="{run["shard"]}"'
+    phases = run['phases'] + [{'phase': 'total', **run['total']}]
+
+    lines = []
+    for name in PHASE_METRICS:
+        metric = f'pipeline_phase_{name}'
+        samples = [f'{metric}{{{labels},phase="{phase_info["phase"]}"}} {phase_info[name]}'
+                   for phase_info in phases if phase_info[name] is not None]
+        if samples:
+            lines += [f'# TYPE {metric} gauge'] + samples
+
+    lines.append('# TYPE pipeline_run_success gauge')
+    lines.append(f'pipeline_run_success{{{labels}}} {int(run["status"] != "failed")}')
+    lines.append('# TYPE pipeline_run_timestamp_seconds gauge')
+    lines.append(f'pipeline_run_timestamp_seconds{{{labels}}} {run["started_at"].timestamp()}')
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_metrics_files(run: dict):
+    '''Replace the Prometheus textfile of the stage and shard, and append the run to the JSON lines history.'''
+
+    metrics_dir = get_metrics_dir()
+    os.makedirs(metrics_dir, exist_ok=True)
+
+    shard_hash = hashlib.md5(run['shard'].encode()).hexdigest()[:8]
+    path = os.path.join(metrics_dir, f'{run["stage"]}_{shard_hash}.prom')
+
+    #Written atomically, as the collector may read it at any time
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(format_textfile(run))
+    os.replace(tmp_path, path)
+
+    with open(os.path.join(metrics_dir, 'runs.jsonl'), 'a') as f:
+        f.write(json.dumps(run, default=str) + '\n')
+
+
+def export_run(run: dict):
+    '''Print the metrics of a finished run and export them. Failures to export never fail the run.'''
+
+    print_run_metrics(run)
+
+    try:
+        store_run_metrics(run)
+        write_metrics_files(run)
+    except Exception as e:
+        print(f'Could not export run metrics: {e}')
@@ -0,0 +1,314 @@
+import os
+import json
+import time
+import argparse
+import psycopg2
+import numpy as np
+import pandas as pd
+import requests
+from io import StringIO
+from collections import deque
+from datetime import datetime
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+from db import get_db_params
+from shards import add_shard_args, shard_from_args, shard_label
+from asset_price_etl import get_tickers
+from raw_archive import add_replay_args, archive_response, get_archived_files, decompress
+from instrumentation import instrumented, phase, count_bytes
+from profiling import add_profile_args, profiling_from_args
+
+
+SMA_LENGTH = 20
+EMA_SPAN = 20
+RSI_LENGTH = 14
+
+BAR_COLUMNS = ['ticker', 'timestamp', 'open', 'high', 'low', 'close', 'volume']
+
+
+def get_state_path(ticker: str, interval: str) -> str:
+    '''File where the streaming indicator state of a ticker is kept between runs.
+
+    Each ticker has its own file, so runs on different shards at the same time never overwrite each other's state.
+    '''
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    state_dir = os.getenv('INTRADAY_STATE_DIR', os.path.join(os.path.dirname(scripts_dir), 'data', 'intraday'))
+
+    return os.path.join(state_dir, interval, f'{ticker}.json')
+
+
+def load_state(tickers: list, interval: str) -> dict:
+    '''State of each of the tickers that has one.'''
+
+    states = {}
+    for ticker in tickers:
+        path = get_state_path(ticker, interval)
+        if os.path.exists(path):
+            with open(path) as f:
+                states[ticker] = json.load(f)
+
+    return states
+
+
+def save_state(states: dict, interval: str):
+    '''Write the state of every ticker given, replacing its previous file atomically.'''
+
+    for ticker, state in states.items():
+        path = get_state_path(ticker, interval)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f)
+        os.replace(tmp_path, path)
+
+
+def new_ticker_state() -> dict:
+    '''Running sums from which SMA, EMA and RSI of the next bar are updated in constant time.
+
+    EMA is kept as a weighted sum and the sum of its weights, which is how pandas computes ewm(adjust=True),
+    so results match the daily indicators computed over the whole history. RSI is a ratio of the weighted sums
+    of gains and losses, whose weights cancel out.
+    '''
+
+    return {
+        'last_timestamp':   None,
+        'window':           deque(),    #Last SMA_LENGTH closes
+        'window_sum':       0.0,
+        'ema_sum':          0.0,
+        'ema_weight':       0.0,
+        'prev_close':       None,
+        'gain_sum':         0.0,
+        'loss_sum':         0.0,
+        'diffs':            0
+    }
+
+
+def update_ticker_state(state: dict, close: float) -> tuple:
+    '''Add a bar's close to a ticker state and return SMA, EMA and RSI including it (None until available).'''
+
+    window = state['window']
+    window.append(close)
+    state['window_sum'] += close
+    if len(window) > SMA_LENGTH:
+        state['window_sum'] -= window.popleft()
+    sma = state['window_sum'] / SMA_LENGTH if len(window) == SMA_LENGTH else None
+
+    decay = 1 - 2 / (EMA_SPAN + 1)
+    state['ema_sum'] = close + decay * state['ema_sum']
+    state['ema_weight'] = 1 + decay * state['ema_weight']
+    ema = state['ema_sum'] / state['ema_weight']
+
+    rsi = None
+    if state['prev_close'] is not None:
+        diff = close - state['prev_close']
+        decay = 1 - 1 / RSI_LENGTH
+        state['gain_sum'] = max(diff, 0) + decay * state['gain_sum']
+        state['loss_sum'] = max(-diff, 0) + decay * state['loss_sum']
+        state['diffs'] += 1
+
+        total = state['gain_sum'] + state['loss_sum']
+        if state['diffs'] >= RSI_LENGTH and total > 0:
+            rsi = 100 * state['gain_sum'] / total
+    state['prev_close'] = close
+
+    return sma, ema, rsi
+
+
+def extract_intraday_bars(tickers: list, interval: str ='5min', replay: str =None) -> pd.DataFrame:
+    '''Download the latest intraday bars of each ticker, or read them from the raw archive if replaying a day.'''
+
+    source = f'alphavantage_intraday_{interval}'
+
+    if replay is None:
+        print('Downloading intraday bars...')
+    else:
+        archived_files = get_archived_files(source, replay)
+
+    all_data = []
+
+    load_dotenv()
+    api_key = os.getenv('ALPHAVANTAGE_API_KEY')
+
+    for ticker in tickers:
+        if replay is None:
+            url = f'https://www.alphavantage.co/query?function=TIME_SERIES_INTRADAY&symbol={ticker}&interval={interval}&outputsize=compact&datatype=csv&apikey={api_key}'
+            req = requests.get(url, timeout=30)
+
+            if req.status_code != 200:
+                print(f"Couldn't retrieve intraday bars for ticker {ticker}")
+                continue
+
+            archive_response(source, ticker, req.content)
+            count_bytes(len(req.content))
+            raw_csv = req.text
+        else:
+            if ticker not in archived_files:
+                print(f'No archived intraday bars for ticker {ticker}')
+                continue
+
+            raw_csv = decompress(archived_files[ticker]).decode('utf-8')
+            count_bytes(len(raw_csv))
+
+        df = pd.read_csv(StringIO(raw_csv))
+        df['ticker'] = ticker
+        all_data.append(df)
+
+    if not all_data:
+        return pd.DataFrame(columns=BAR_COLUMNS)
+
+    return pd.concat(all_data, ignore_index=True)[BAR_COLUMNS]
+
+
+def read_bars_file(path: str) -> pd.DataFrame:
+    '''Read recorded bars of one or several tickers from a CSV file with the columns of BAR_COLUMNS.'''
+
+    print(f'Reading recorded bars from {path}...')
+
+    return pd.read_csv(path)[BAR_COLUMNS]
+
+
+def process_bars(bars: pd.DataFrame, states: dict, interval_minutes: int) -> tuple:
+    '''Apply bars in time order to the state of their tickers and return the rows to store and update latencies.
+
+    Bars not newer than the last one applied to a ticker are skipped, so overlapping fetches are harmless.
+    '''
+
+    bars = bars.assign(timestamp=pd.to_datetime(bars['timestamp'])).sort_values(['timestamp', 'ticker'], kind='stable')
+
+    #Windows are stored as lists in JSON but updated as deques
+    for state in states.values():
+        state['window'] = deque(state['window'])
+
+    rows = []
+    latencies = []
+    for ticker, timestamp, open_, high, low, close, volume in bars.itertuples(index=False, name=None):
+        state = states.setdefault(ticker, new_ticker_state())
+        if state['last_timestamp'] is not None and timestamp.isoformat() <= state['last_timestamp']:
+            continue
+
+        start = time.perf_counter()
+        sma, ema, rsi = update_ticker_state(state, float(close))
+        state['last_timestamp'] = timestamp.isoformat()
+        latencies.append(time.perf_counter() - start)
+
+        rows.append((ticker, timestamp.to_pydatetime(), interval_minutes, float(open_), float(high), float(low),
+                     float(close), int(volume), sma, ema, rsi))
+
+    for state in states.values():
+        state['window'] = list(state['window'])
+
+    return rows, np.array(latencies)
+
+
+def ensure_partitions(rows: list):
+    '''Create the monthly partitions of the intraday bars table that the rows fall in.'''
+
+    params =                get_db_params()
+    intraday_bars_tbl =     params['intraday_bars']
+    db_conn_params =        params['db_conn']
+
+    months = sorted({row[1].replace(day=1, hour=0, minute=0, second=0, microsecond=0) for row in rows})
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                for month in months:
+                    next_month = (month + pd.DateOffset(months=1)).to_pydatetime()
+                    cur.execute(f'''CREATE TABLE IF NOT EXISTS {intraday_bars_tbl}_{month.strftime("%Y_%m")}
+                                    PARTITION OF {intraday_bars_tbl}
+                                    FOR VALUES FROM (%s) TO (%s);
+                                ''', (month, next_month))
+                conn.commit()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+        raise
+
+
+def load_data(rows: list) -> bool:
+    '''Insert rows into the database using bulk insert.'''
+
+    if not rows:
+        print('No new bars to insert.')
+        return True
+
+    print(f'Loading {len(rows)} intraday bars into database...')
+
+    params =                get_db_params()
+    intraday_bars_tbl =     params['intraday_bars']
+    db_conn_params =        params['db_conn']
+
+    ensure_partitions(rows)
+
+    insert_query = f'''INSERT INTO {intraday_bars_tbl}
+                        (ticker, bar_time, interval_minutes, open, high, low, close, volume, sma_20, ema_20, rsi_14)
+                        VALUES %s
+                        ON CONFLICT (ticker, interval_minutes, bar_time) DO NOTHING;
+    '''
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                execute_values(cur, insert_query, rows, page_size=1000)
+                conn.commit()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+        return False
+
+    print(f'Insertion successful.')
+
+    return True
+
+
+@instrumented('intraday_etl')
+def run_intraday_etl(shard: dict =None, interval: str ='5min', replay: str =None, bars_file: str =None,
+                     store: bool =True) -> dict:
+    start_time = datetime.now()
+    print(f'Starting Intraday ETL ({interval}) for assets {shard_label(shard)} at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    #Extract
+    with phase('extract') as extract_phase:
+        if bars_file is not None:
+            bars = read_bars_file(bars_file)
+        else:
+            bars = extract_intraday_bars(get_tickers(shard), interval, replay)
+        extract_phase['rows'] = len(bars)
+
+    #Transform
+    with phase('transform') as transform_phase:
+        states = load_state(sorted(bars['ticker'].unique()), interval)
+        rows, latencies = process_bars(bars, states, int(interval.removesuffix('min')))
+        transform_phase['rows'] = len(rows)
+
+    stats = {'bars': len(bars), 'new_bars': len(rows)}
+    if len(latencies):
+        stats['update_p50_us'] = float(np.percentile(latencies, 50) * 1e6)
+        stats['update_p99_us'] = float(np.percentile(latencies, 99) * 1e6)
+    print(f'Indicator updates: {json.dumps(stats)}')
+
+    #Load. The state is only saved once its bars are stored, so a failed load is retried from the same state. Runs
+    #that don't store their bars don't save it either, so replaying bars never moves the state of live runs forward
+    with phase('load') as load_phase:
+        if store and load_data(rows):
+            save_state(states, interval)
+        load_phase['rows'] = len(rows) if store else 0
+
+    print(f'ETL process finished at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+    return stats
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Intraday Bars ETL')
+    add_shard_args(parser)
+    add_replay_args(parser)
+    parser.add_argument('--interval', choices=['1min', '5min', '15min', '30min', '60min'], default='5min')
+    parser.add_argument('--bars-file', type=str, default=None, help='Replay recorded bars from a CSV file')
+    parser.add_argument('--no-store', action='store_true', help='Compute the indicators without writing them to the database or saving the indicator state')
+    add_profile_args(parser)
+    args = parser.parse_args()
+    profiling_from_args(args)
+
+    run_intraday_etl(shard_from_args(args), args.interval, args.replay, args.bars_file, not args.no_store)
@@ -0,0 +1,76 @@
+import time
+import random
+import argparse
+import numpy as np
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+
+def run_client(url: str, tickers: list, deadline: float, latencies: list, errors: list, seed: int):
+    '''Send requests one after another until the deadline, recording the latency of each one.'''
+
+    rng = random.Random(seed)
+    session = requests.Session()
+
+    while time.perf_counter() < deadline:
+        ticker = rng.choice(tickers)
+        start = time.perf_counter()
+        try:
+            response = session.get(f'{url}/predict/{ticker}', timeout=10)
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        except requests.RequestException as e:
+            errors.append(str(e))
+
+
+def run_load_test(url: str ='http://localhost:8000', concurrency: int =32, duration: float =30) -> dict:
+    '''Load the prediction service from concurrent clients and report latency percentiles and throughput.'''
+
+    tickers = requests.get(f'{url}/tickers', timeout=10).json()
+    if not tickers:
+        raise ValueError('The service has no tickers to predict')
+
+    print(f'Sending requests for {len(tickers)} tickers from {concurrency} clients during {duration}s...')
+
+    deadline = time.perf_counter() + duration
+    start = time.perf_counter()
+
+    client_latencies = [[] for _ in range(concurrency)]
+    client_errors = [[] for _ in range(concurrency)]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for i in range(concurrency):
+            executor.submit(run_client, url, tickers, deadline, client_latencies[i], client_errors[i], i)
+
+    elapsed = time.perf_counter() - start
+    latencies = [latency for client in client_latencies for latency in client]
+    errors = [error for client in client_errors for error in client]
+
+    latencies = np.array(latencies) * 1000
+    results = {
+        'requests':         int(len(latencies)),
+        'errors':           len(errors),
+        'requests_per_sec': len(latencies) / elapsed,
+        'p50_ms':           float(np.percentile(latencies, 50)) if len(latencies) else None,
+        'p90_ms':           float(np.percentile(latencies, 90)) if len(latencies) else None,
+        'p99_ms':           float(np.percentile(latencies, 99)) if len(latencies) else None,
+        'max_ms':           float(latencies.max()) if len(latencies) else None
+    }
+
+    print(f'{results["requests"]} requests, {results["errors"]} errors, {results["requests_per_sec"]:.1f} requests/sec')
+    if len(latencies):
+        print(f'Latency p50 {results["p50_ms"]:.2f} ms, p90 {results["p90_ms"]:.2f} ms, '
+              f'p99 {results["p99_ms"]:.2f} ms, max {results["max_ms"]:.2f} ms')
+    if errors:
+        print(f'First error: {errors[0]}')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load test of the prediction service')
+    parser.add_argument('--url', type=str, default='http://localhost:8000')
+    parser.add_argument('--concurrency', type=int, default=32, help='Clients sending requests at once')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds the test lasts')
+    args = parser.parse_args()
+
+    run_load_test(args.url, args.concurrency, args.duration)
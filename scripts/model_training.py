@@ -1,18 +1,50 @@
 import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
 import pandas as pd
 import psycopg2
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from datetime import datetime
-from tensorflow.keras.models import Sequential
+import tensorflow as tf
+from tensorflow.keras.models import Sequential, load_model
 from tensorflow.keras.layers import LSTM, Dense, InputLayer, Dropout
-from tensorflow.keras.callbacks import EarlyStopping
+from tensorflow.keras.callbacks import Callback, EarlyStopping
 from tensorflow.keras.optimizers import Adam
 from sklearn.model_selection import train_test_split
-from sklearn.metrics import classification_report, confusion_matrix
-from sklearn.metrics import accuracy_score, precision_score, recall_score, f1_score, roc_auc_score
 from sklearn.preprocessing import MinMaxScaler
 
 from db import get_db_params
+from evaluation import predict_scores, build_evaluation_report, save_report
+from run_state import add_force_args, get_code_version, query_inputs, inputs_unchanged, save_run_state, SKIP_EXIT_CODE
+from instrumentation import instrumented, phase
+from profiling import add_profile_args, profiling_from_args
+
+
+def get_stage_inputs() -> dict:
+    '''Cheap summary of the feature matrix and of the training code, to avoid retraining on the same data.'''
+
+    feature_matrix_tbl = get_db_params()['feature_matrix']
+
+    inputs = query_inputs({
+        'feature_matrix': (f'SELECT COUNT(*), MAX(id), MAX(date) FROM {feature_matrix_tbl}', [])
+    })
+    inputs['code'] = get_code_version(__file__, 'evaluation.py')
+
+    return inputs
+
+
+FEATURES_OF_PRICES = ['p.open', 'p.close', 'p.high', 'p.low', 'p.volume']
+FEATURES_OF_MATRIX = ['m.sma_10', 'm.sma_20', 'm.ema_10', 'm.ema_20', 'm.rsi_14',
+                      'm.daily_return', 'm.volume_sma_10', 'm.sentiment_score'
+]
+FEATURES = FEATURES_OF_PRICES + FEATURES_OF_MATRIX
+
+#Epochs between checkpoints of a training. Each writes the full model, so an interruption loses at most this many
+CHECKPOINT_EVERY = 10
 
 
 def load_feature_matrix() -> pd.DataFrame:
@@ -35,7 +67,6 @@ def load_feature_matrix() -> pd.DataFrame:
                         LEFT JOIN {assets_price_tbl} p
                         ON m.ticker = p.ticker
                         AND m.date = p.date
-                        WHERE m.ticker = 'SPY'
                         ORDER BY ticker, date;
     '''
 
@@ -53,27 +84,103 @@ def load_feature_matrix() -> pd.DataFrame:
     return matrix
 
 
-def get_train_test_split(matrix: pd.DataFrame, sequence_length: int =10) -> tuple:
-    '''Create sequences and splits into train/val/test sets.'''
+def load_latest_sequences(sequence_length: int =10) -> tuple:
+    '''Last sequence of every ticker, the one to predict its next day from, read straight from DB.
 
-    print('Computing train/test split...')
+    Returns the tickers, the date each sequence ends at and the sequences. Tickers with fewer rows than the
+    sequence length are left out.
+    '''
+
+    params =                get_db_params()
+    feature_matrix_tbl =    params['feature_matrix']
+    assets_price_tbl =      params['assets_price']
+    db_conn_params =        params['db_conn']
+
+    columns = [feature.split('.')[1] for feature in FEATURES]
+
+    select_query = f'''SELECT ticker, date, {', '.join(columns)}
+                        FROM (
+                            SELECT m.ticker, m.date, {', '.join(FEATURES)},
+                                ROW_NUMBER() OVER (PARTITION BY m.ticker ORDER BY m.date DESC) AS row_number
+                            FROM {feature_matrix_tbl} m
+                            LEFT JOIN {assets_price_tbl} p
+                            ON m.ticker = p.ticker
+                            AND m.date = p.date
+                        ) latest
+                        WHERE row_number <= %s
+                        ORDER BY ticker, date;
+    '''
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(select_query, (sequence_length,))
+                records = cur.fetchall()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+        raise
+
+    rows = pd.DataFrame(records, columns=['m.ticker', 'm.date'] + FEATURES)
+
+    #Rows come sorted by ticker and date, so complete tickers are consecutive blocks of sequence_length rows
+    counts = rows.groupby('m.ticker', sort=False).size()
+    rows = rows[rows['m.ticker'].map(counts).to_numpy() == sequence_length]
+
+    X = rows[FEATURES].to_numpy(dtype=np.float64).reshape(-1, sequence_length, len(FEATURES))
+    tickers = rows['m.ticker'].to_numpy()[sequence_length - 1::sequence_length]
+    dates = rows['m.date'].to_numpy()[sequence_length - 1::sequence_length]
+
+    return tickers, dates, X
 
-    features_of_prices = ['p.open', 'p.close', 'p.high', 'p.low', 'p.volume']
-    features_of_matrix = ['m.sma_10', 'm.sma_20', 'm.ema_10', 'm.ema_20', 'm.rsi_14',
-                          'm.daily_return', 'm.volume_sma_10', 'm.sentiment_score'
-    ]
+
+def build_sequences(matrix: pd.DataFrame, sequence_length: int =10) -> tuple:
+    '''Create the time-series sequences of every ticker and return inputs and classes of all of them.'''
 
     X_all, y_all = [], []
 
     for _, group in matrix.groupby('m.ticker'):
-        X_seq, y_seq = create_sequences(group, features_of_prices + features_of_matrix, sequence_length)
+        X_seq, y_seq = create_sequences(group, FEATURES, sequence_length)
         X_all.append(X_seq)
         y_all.append(y_seq)
 
     X = np.concatenate(X_all)
     y = np.concatenate(y_all)
 
-    X_train, X_val, X_test, y_train, y_val, y_test = rolling_window_split(X, y)
+    return X, y
+
+
+def get_sequence_dates(matrix: pd.DataFrame, sequence_length: int =10) -> np.ndarray:
+    '''Date of the row labeling each sequence, in the same order as build_sequences returns them.'''
+
+    dates = [group['m.date'].to_numpy()[sequence_length:] for _, group in matrix.groupby('m.ticker')]
+
+    return np.concatenate(dates)
+
+
+def build_time_ordered_sequences(matrix: pd.DataFrame, sequence_length: int =10) -> tuple:
+    '''Sequences of all tickers ordered by the date labeling them, along with those dates.
+
+    build_sequences returns the sequences of one ticker after another, so splitting them by position would train on
+    the later dates of the first tickers and validate on the earlier dates of the last ones. Sequences labeled on the
+    same date keep the order of their tickers.
+    '''
+
+    X, y = build_sequences(matrix, sequence_length)
+    dates = np.asarray(get_sequence_dates(matrix, sequence_length), dtype='datetime64[D]')
+
+    order = np.argsort(dates, kind='stable')
+
+    return X[order], y[order], dates[order]
+
+
+def get_train_test_split(matrix: pd.DataFrame, sequence_length: int =10) -> tuple:
+    '''Create sequences and splits into train/val/test sets.'''
+
+    print('Computing train/test split...')
+
+    X, y, dates = build_time_ordered_sequences(matrix, sequence_length)
+
+    X_train, X_val, X_test, y_train, y_val, y_test = rolling_window_split(X, y, dates=dates)
 
     #Scale test set and return scaler for production #!
     '''scaler = MinMaxScaler(feature_range=(0, 1))
@@ -87,24 +194,38 @@ def get_train_test_split(matrix: pd.DataFrame, sequence_length: int =10) -> tupl
 def create_sequences(group: object, features: list, sequence_length: int =10) -> tuple:
     '''Break down the matrix in time-series sequences and return inputs and class.'''
 
-    X, y = [], []
+    num_sequences = len(group) - sequence_length
 
-    for i in range(len(group) - sequence_length):
-        seq = group[features].iloc[i:i+sequence_length].values
-        label = group['m.next_day_up'].iloc[i+sequence_length]
-        X.append(seq)
-        y.append(label)
+    if num_sequences <= 0:
+        return np.empty((0, sequence_length, len(features))), np.empty((0,), dtype=bool)
 
-    return np.array(X), np.array(y)
+    values = group[features].to_numpy(dtype=np.float64)
+    labels = group['m.next_day_up'].to_numpy()
 
+    #Sequence i spans rows i to i+sequence_length-1 and is labeled with row i+sequence_length
+    windows = sliding_window_view(values, sequence_length, axis=0)[:num_sequences]
+    X = windows.transpose(0, 2, 1)
+    y = labels[sequence_length:]
 
-def rolling_window_split(X: np.ndarray, y: np.ndarray, train_ratio: float =0.7, val_ratio: float =0.15) -> tuple:
-    '''Split X and y into train, validation, and test using time-series order.'''
+    return X, y
+
+
+def rolling_window_split(X: np.ndarray, y: np.ndarray, train_ratio: float =0.7, val_ratio: float =0.15,
+                         dates: np.ndarray =None) -> tuple:
+    '''Split X and y into train, validation, and test using time-series order.
+
+    X and y must be sorted by date, as build_time_ordered_sequences returns them. Given their dates, each boundary is
+    moved back to the first sequence of its date, so that no date is split between two sets.
+    '''
 
     n = len(X)
     train_end = int(n * train_ratio)
     val_end = int(n * (train_ratio + val_ratio))
 
+    if dates is not None:
+        train_end, val_end = [int(np.searchsorted(dates, dates[end], side='left')) if end < n else end
+                              for end in (train_end, val_end)]
+
     X_train = X[:train_end]
     y_train = y[:train_end]
 
@@ -117,20 +238,28 @@ def rolling_window_split(X: np.ndarray, y: np.ndarray, train_ratio: float =0.7,
     return X_train, X_val, X_test, y_train, y_val, y_test
 
 
-def build_LSTM(sequence_length: int, num_features: int) -> object:
+def configure_tf_threads(threads: int):
+    '''Limit the CPU threads TensorFlow uses, so that several training processes can share the machine.'''
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def build_LSTM(sequence_length: int, num_features: int, units: int =90, dropout: float =0.1,
+               learning_rate: float =10e-3) -> object:
     '''Define and build neural network.'''
 
     print('Setting up LSTM model...')
 
     model = Sequential([
         InputLayer(input_shape=(sequence_length, num_features)),
-        LSTM(90),
-        Dropout(0.1),
-        Dense(90, activation='relu'),
+        LSTM(units),
+        Dropout(dropout),
+        Dense(units, activation='relu'),
         Dense(1, activation='sigmoid')
     ])
 
-    adam = Adam(learning_rate=10e-3)
+    adam = Adam(learning_rate=learning_rate)
 
     model.compile(
         optimizer=adam,
@@ -141,106 +270,466 @@ def build_LSTM(sequence_length: int, num_features: int) -> object:
     return model
 
 
-def train_model(model: object, X_train: np.ndarray, y_train: np.ndarray, X_val: np.ndarray, y_val: np.ndarray) -> object:
-    '''Train LSTM network on matrix data.'''
+def get_checkpoint_dir() -> str:
+    return os.path.join(get_model_dir(), 'checkpoints')
+
+
+def get_run_key(model: object, X_train: np.ndarray, y_train: np.ndarray, X_val: np.ndarray, epochs: int) -> str:
+    '''Identify a training run by its architecture and data, so a checkpoint is only resumed by the same run.'''
+
+    digest = hashlib.sha256()
+    digest.update(model.to_json().encode())
+    digest.update(str((X_train.shape, X_val.shape, epochs)).encode())
+    #The edges of the sets are enough to tell new data apart without hashing all of it
+    digest.update(np.ascontiguousarray(X_train[-1:]).tobytes())
+    digest.update(np.ascontiguousarray(X_val[-1:]).tobytes())
+    digest.update(np.ascontiguousarray(y_train).tobytes())
+
+    return digest.hexdigest()[:16]
+
+
+def load_checkpoint_state(checkpoint_dir: str) -> dict:
+    path = os.path.join(checkpoint_dir, 'state.json')
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def clear_checkpoints(checkpoint_dir: str =None):
+    '''Remove the checkpoints of a finished training run.'''
+
+    checkpoint_dir = checkpoint_dir or get_checkpoint_dir()
+    if os.path.exists(checkpoint_dir):
+        shutil.rmtree(checkpoint_dir)
+
+
+class CheckpointedEarlyStopping(Callback):
+    '''Early stopping on validation loss whose state is saved along with the model every few epochs.
+
+    Each checkpoint is a full model file, so the optimizer state is kept too, and state.json records the epoch
+    reached, the early stopping counters, the checkpoint to resume from and the file of the best weights. Only the
+    latest checkpoints are kept. Writing a full model costs about as much as a short epoch, so checkpoints are
+    saved every few epochs and when training stops, while the weights of a new best epoch are saved as it happens.
+
+    Every file is complete before state.json points to it: the weights of each new best epoch go to their own file,
+    and state.json is replaced atomically once both its checkpoint and those weights are written.
+    '''
+
+    def __init__(self, checkpoint_dir: str, run_key: str, patience: int, state: dict =None, every: int =CHECKPOINT_EVERY,
+                 keep: int =2):
+        super().__init__()
+        self.checkpoint_dir = checkpoint_dir
+        self.run_key = run_key
+        self.patience = patience
+        self.every = every
+        self.keep = keep
+
+        state = state or {}
+        self.best = state.get('best', np.inf)
+        self.best_epoch = state.get('best_epoch')
+        self.wait = state.get('wait', 0)
+        self.best_weights_path = os.path.join(checkpoint_dir, state['best_weights']) if state.get('best_weights') else None
+
+    def on_epoch_end(self, epoch: int, logs: dict =None):
+        val_loss = (logs or {}).get('val_loss')
+
+        if val_loss is not None and val_loss < self.best:
+            self.best, self.best_epoch, self.wait = float(val_loss), epoch + 1, 0
+            self.best_weights_path = self.save_best_weights(epoch + 1)
+        else:
+            self.wait += 1
+
+        if self.wait >= self.patience:
+            self.model.stop_training = True
+
+        if (epoch + 1) % self.every == 0 or self.model.stop_training:
+            self.save_checkpoint(epoch + 1)
+
+    def on_train_end(self, logs: dict =None):
+        if self.best_weights_path is not None and os.path.exists(self.best_weights_path):
+            print(f'Restoring weights of epoch {self.best_epoch}.')
+            self.model.load_weights(self.best_weights_path)
+
+    def save_best_weights(self, epoch: int) -> str:
+        '''Write the weights of a best epoch to a new file, renamed into place once complete.'''
+
+        path = os.path.join(self.checkpoint_dir, f'best_{epoch:04d}.weights.h5')
+        tmp_path = os.path.join(self.checkpoint_dir, 'tmp_best.weights.h5')
+        self.model.save_weights(tmp_path)
+        os.replace(tmp_path, path)
+
+        return path
+
+    def save_checkpoint(self, epoch: int):
+        checkpoint_path = os.path.join(self.checkpoint_dir, f'epoch_{epoch:04d}.keras')
+        self.model.save(checkpoint_path)
+
+        state = {
+            'run_key':      self.run_key,
+            'epoch':        epoch,
+            'checkpoint':   os.path.basename(checkpoint_path),
+            'best':         self.best,
+            'best_epoch':   self.best_epoch,
+            'best_weights': os.path.basename(self.best_weights_path) if self.best_weights_path else None,
+            'wait':         self.wait,
+            'saved_at':     datetime.now().isoformat()
+        }
+
+        #The state is replaced atomically and only once its checkpoint is complete, so it never points to a partial file
+        tmp_path = os.path.join(self.checkpoint_dir, 'state.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp_path, os.path.join(self.checkpoint_dir, 'state.json'))
+
+        checkpoints = sorted(name for name in os.listdir(self.checkpoint_dir) if name.startswith('epoch_'))
+        for name in checkpoints[:-self.keep]:
+            os.remove(os.path.join(self.checkpoint_dir, name))
+
+        #Only the best weights the state points to are needed from now on
+        for name in os.listdir(self.checkpoint_dir):
+            if name.startswith('best_') and name != state['best_weights']:
+                os.remove(os.path.join(self.checkpoint_dir, name))
+
+
+def train_model(model: object, X_train: np.ndarray, y_train: np.ndarray, X_val: np.ndarray, y_val: np.ndarray,
+                epochs: int =300, verbose: object ='auto', checkpoint_dir: str =None,
+                checkpoint_every: int =CHECKPOINT_EVERY, keep_checkpoints: int =2) -> object:
+    '''Train LSTM network on matrix data. With a checkpoint directory, an interrupted run resumes where it left off.'''
 
     print('Training model...')
 
-    epochs = 300
-    early_stopping_callback = EarlyStopping(patience=epochs / 3, restore_best_weights=True)
+    initial_epoch = 0
+    state = None
+    patience = epochs / 3
+
+    if checkpoint_dir is None:
+        early_stopping_callback = EarlyStopping(patience=patience, restore_best_weights=True)
+    else:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        run_key = get_run_key(model, X_train, y_train, X_val, epochs)
+
+        state = load_checkpoint_state(checkpoint_dir)
+        if state is not None and state['run_key'] != run_key:
+            print('Discarding checkpoints of a different training run.')
+            clear_checkpoints(checkpoint_dir)
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            state = None
+
+        if state is not None:
+            print(f'Resuming training from checkpoint at epoch {state["epoch"]}...')
+            model = load_model(os.path.join(checkpoint_dir, state['checkpoint']))
+            initial_epoch = state['epoch']
+
+        early_stopping_callback = CheckpointedEarlyStopping(checkpoint_dir, run_key, patience, state,
+                                                            checkpoint_every, keep_checkpoints)
+
+        if state is not None and early_stopping_callback.wait >= patience:
+            print('Checkpointed run had already stopped early.')
+            early_stopping_callback.model = model
+            early_stopping_callback.on_train_end()
+            return model
 
     model.fit(X_train, y_train, 
               validation_data=(X_val, y_val),
+              initial_epoch=initial_epoch,
               epochs=epochs,
               batch_size=64,
               validation_split=0.2,
               callbacks=early_stopping_callback,
-              shuffle=False  #Time series mustn't be shuffled
+              shuffle=False,  #Time series mustn't be shuffled
+              verbose=verbose
     )
 
     return model
 
 
-def evaluate_model(model: object, X_val: np.ndarray, y_val: np.ndarray, X_test: np.ndarray, y_test: np.ndarray):
+def evaluate_model(model: object, X_val: np.ndarray, y_val: np.ndarray, X_test: np.ndarray, y_test: np.ndarray) -> dict:
     '''Evaluate model performance.'''
 
-    #Assess performance with validation set
-    y_val_pred = model.predict(X_val).flatten()
-    y_val_pred_class = (y_val_pred > 0.5).astype(int)
-    print('\nConfusion matrix on validation data\n', confusion_matrix(y_val, y_val_pred_class))
-    print('\nClassification report on validation data\n', classification_report(y_val, y_val_pred_class))
-
-    #Further assess model performance with validation set
-    accuracy = accuracy_score(y_val, y_val_pred_class)
-    precision = precision_score(y_val, y_val_pred_class)
-    recall = recall_score(y_val, y_val_pred_class)
-    f1 = f1_score(y_val, y_val_pred_class)
-    auc = roc_auc_score(y_val, y_val_pred)
-    print('\nMetrics on validation data:')
-    print('\nAccuracy: ', accuracy, 'Precision: ', precision, 'Recall: ', recall, 'F1: ', f1, 'AUC: ', auc, '\n')
-
-    #Assess model performance with test set
-    y_test_pred = model.predict(X_test).flatten()
-    y_test_pred_class = (y_test_pred > 0.5).astype(int)
-    test_set_accuracy = accuracy_score(y_test, y_test_pred_class)
-    print('\nAccuracy on test set: ', test_set_accuracy, '\n')
-
-    #Calculate optimal threshold using validation set
-    thresholds = np.linspace(0, 1, 100)
-    accuracies = []
-
-    for thresh in thresholds:
-        preds = (y_val_pred > thresh).astype(int)
-        acc = accuracy_score(y_val, preds)
-        accuracies.append(acc)
-
-    best_index = np.argmax(accuracies)
-    best_threshold = thresholds[best_index]
-    best_accuracy = accuracies[best_index]
-
-    print(f'\nBest threshold: {best_threshold:.3f}', '\n')
-    print(f'\nBest accuracy: {best_accuracy:.4f}', '\n')
-
-    #Assess model performance with test set using optimal threshold for validation set
-    y_test_pred = model.predict(X_test).flatten()
-    y_test_pred_class = (y_test_pred > best_threshold).astype(int)
-    final_accuracy = accuracy_score(y_test, y_test_pred_class)
-    print('\nAccuracy on test set using best threshold for validation set: ', final_accuracy, '\n')
-
-
-def save_model(model: object):
-    '''Save ML model so it can be used later.'''
+    print('Evaluating model...')
 
-    print('Saving model...')
+    #Each set is scored once and every metric reuses the scores
+    val_scores = predict_scores(model, X_val)
+    test_scores = predict_scores(model, X_test)
+
+    #Threshold is chosen on the validation set and then assessed on the test set
+    report = build_evaluation_report(y_val, val_scores, y_test, test_scores)
+
+    print(f'Validation AUC: {report["validation"]["auc"]}, best threshold: {report["best_threshold"]:.3f}, '
+          f'test accuracy with it: {report["test"]["best_threshold"]["accuracy"]:.4f}')
+
+    return report
+
+
+def get_model_dir() -> str:
+    '''Directory where models and their related files are stored.'''
 
     scripts_dir = os.path.dirname(os.path.abspath(__file__))
     parent_dir = os.path.dirname(scripts_dir)
-    model_dir = os.path.join(parent_dir, 'models')
+
+    return os.getenv('MODEL_DIR', os.path.join(parent_dir, 'models'))
+
+
+def export_tflite(model: object, path: str, quantization: str =None):
+    '''Export the model to TensorFlow Lite, a compact format that can be scored without Keras.
+
+    With 'float16' weights are stored in half precision, and with 'int8' they are quantized to 8-bit integers
+    (dynamic range quantization, activations stay in float). The converter can't lower the loop of an LSTM over
+    sequences of any batch size, so a copy of the model with its LSTM layers unrolled over the sequence length is
+    converted instead, from its inference function with the weights frozen as constants.
+    '''
+
+    config = model.get_config()
+    for layer in config['layers']:
+        if layer['class_name'] == 'LSTM':
+            layer['config']['unroll'] = True
+    unrolled = model.__class__.from_config(config)
+    unrolled.set_weights(model.get_weights())
+
+    serve = tf.function(lambda X: unrolled(X, training=False),
+                        input_signature=[tf.TensorSpec([None, *model.input_shape[1:]], tf.float32)])
+    converter = tf.lite.TFLiteConverter.from_concrete_functions([serve.get_concrete_function()])
+
+    if quantization == 'float16':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == 'int8':
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    elif quantization is not None:
+        raise ValueError(f'Unknown quantization: {quantization}')
+
+    with open(path, 'wb') as f:
+        f.write(converter.convert())
+
+
+def save_model(model: object, report: dict =None, quantization: str =None):
+    '''Save ML model so it can be used later, along with its evaluation report and a TensorFlow Lite export.'''
+
+    print('Saving model...')
+
+    model_dir = get_model_dir()
+    tflite_path = model_dir + '/lstm_model.tflite'
+    os.makedirs(model_dir, exist_ok=True)
+
+    #Exported first, so a failed export fails the training before any saved file is replaced
+    export_tflite(model, tflite_path + '.tmp', quantization)
 
     model.save(model_dir + '/lstm_model.keras')
+    os.replace(tflite_path + '.tmp', tflite_path)
+
+    if report is not None:
+        save_report(report, model_dir + '/lstm_model_metrics.json')
+
+
+def get_metadata_path() -> str:
+    return os.path.join(get_model_dir(), 'lstm_model_metadata.json')
+
+
+def load_model_metadata() -> dict:
+    '''Training cutoff, mode and baseline metrics of the saved model, or None if there is no saved model.'''
+
+    path = get_metadata_path()
+    if not os.path.exists(path) or not os.path.exists(os.path.join(get_model_dir(), 'lstm_model.keras')):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_model_metadata(metadata: dict):
+    save_report(metadata, get_metadata_path())
+
+
+def needs_full_training(metadata: dict, full_training_days: int) -> bool:
+    '''Whether the saved model can't be fine-tuned and a full training is due instead.'''
+
+    if metadata is None:
+        print('No saved model to fine-tune.')
+        return True
+
+    days_since_full = (datetime.now() - datetime.fromisoformat(metadata['last_full_training'])).days
+    if days_since_full >= full_training_days:
+        print(f'Last full training was {days_since_full} days ago, a full training is due.')
+        return True
+
+    return False
 
 
-def run_model_training():
+def fine_tune_model(model: object, X: np.ndarray, y: np.ndarray, epochs: int =10, batch_size: int =64) -> object:
+    '''Continue training a model on a small set of windows.'''
+
+    print(f'Fine-tuning model on {len(X)} sequences...')
+
+    model.fit(X, y,
+              epochs=epochs,
+              batch_size=batch_size,
+              shuffle=False,  #Time series mustn't be shuffled
+    )
+
+    return model
+
+
+def run_incremental_training(matrix: pd.DataFrame, metadata: dict, replay_ratio: float =1.0,
+                             degradation_tolerance: float =0.1, min_new_sequences: int =100, epochs: int =10,
+                             quantization: str =None, holdout_ratio: float =0.2) -> bool:
+    '''Fine-tune the saved model on the sequences labeled after its training cutoff, plus a sample of older ones.
+
+    Before fine-tuning, the saved model is scored on the new sequences, which it has never seen. If its loss on them
+    is worse than its validation loss at the last full training by more than the tolerance, the model is considered
+    degraded and False is returned so that a full training is run instead.
+
+    The sequences of the newest dates, a share of holdout_ratio of the new ones, are held out of the fine-tuning. The
+    fine-tuned model is only saved if its loss on them is lower than that of the saved model. Otherwise the saved
+    model is kept, and its cutoff too, so that the next run tries again with more data.
+    '''
+
+    sequence_length = metadata['sequence_length']
+
+    X, y = build_sequences(matrix, sequence_length)
+    X = X.astype(np.float64)
+    dates = get_sequence_dates(matrix, sequence_length)
+
+    cutoff = datetime.fromisoformat(metadata['training_cutoff']).date()
+    is_new = np.array([date > cutoff for date in dates], dtype=bool)
+    num_new = int(is_new.sum())
+
+    if num_new == 0:
+        print(f'No new sequences since training cutoff {cutoff}, keeping the saved model.')
+        return True
+
+    print(f'{num_new} new sequences since training cutoff {cutoff}.')
+    model = load_model(os.path.join(get_model_dir(), 'lstm_model.keras'))
+
+    X_new, y_new = X[is_new], y[is_new]
+    new_loss, new_accuracy = model.evaluate(X_new, y_new, verbose=0)
+    print(f'Saved model on new sequences: loss {new_loss:.4f}, accuracy {new_accuracy:.4f} '
+          f'(validation loss at last full training {metadata["validation_loss"]:.4f}).')
+
+    if num_new >= min_new_sequences and new_loss > metadata['validation_loss'] * (1 + degradation_tolerance):
+        print('Model degraded on new data.')
+        return False
+
+    new_dates = np.unique(dates[is_new])
+    if len(new_dates) < 2:
+        print('New sequences are all labeled on the same date, none can be held out to validate a fine-tuning. '
+              'Keeping the saved model.')
+        return True
+
+    holdout_start = new_dates[min(max(int(len(new_dates) * (1 - holdout_ratio)), 1), len(new_dates) - 1)]
+    is_holdout = is_new & (dates >= holdout_start)
+    is_tuned = is_new & ~is_holdout
+    holdout_loss_before, _ = model.evaluate(X[is_holdout], y[is_holdout], verbose=0)
+
+    #Replaying a sample of older sequences keeps the model from forgetting them
+    old_indices = np.flatnonzero(~is_new)
+    replay_size = min(len(old_indices), int(is_tuned.sum() * replay_ratio))
+    replay_indices = np.sort(np.random.default_rng(0).choice(old_indices, replay_size, replace=False))
+    indices = np.concatenate([replay_indices, np.flatnonzero(is_tuned)])
+
+    model = fine_tune_model(model, X[indices], y[indices], epochs)
+
+    holdout_loss_after, _ = model.evaluate(X[is_holdout], y[is_holdout], verbose=0)
+    print(f'Loss on {is_holdout.sum()} held-out sequences from {holdout_start}: {holdout_loss_before:.4f} before '
+          f'fine-tuning, {holdout_loss_after:.4f} after.')
+
+    if holdout_loss_after >= holdout_loss_before:
+        print('Fine-tuning did not improve the model on held-out data. Keeping the saved model.')
+        return True
+
+    save_model(model, quantization=quantization)
+    save_model_metadata({
+        **metadata,
+        'mode':             'incremental',
+        'trained_at':       datetime.now().isoformat(),
+        #Held-out dates were not trained on, so they are new data again for the next run
+        'training_cutoff':  str(max(dates[is_tuned])),
+        'version':          metadata['version'] + 1,
+        'new_data_metrics': {'sequences': num_new, 'loss': float(new_loss), 'accuracy': float(new_accuracy)},
+        'holdout_metrics':  {'sequences': int(is_holdout.sum()), 'loss_before': float(holdout_loss_before),
+                             'loss_after': float(holdout_loss_after)}
+    })
+
+    return True
+
+
+@instrumented('model_training')
+def run_model_training(force: bool =False, incremental: bool =False, full_training_days: int =7,
+                       quantization: str =None, epochs: int =300) -> bool:
     start_time = datetime.now()
     print(f'Starting training process at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
 
-    SEQUENCE_LENGTH = 10
+    stage_inputs = get_stage_inputs()
+    if inputs_unchanged('model_training', 'all', stage_inputs, force):
+        return False
 
-    matrix = load_feature_matrix()
-    X_train, X_val, X_test, y_train, y_val, y_test = get_train_test_split(matrix, SEQUENCE_LENGTH)
+    SEQUENCE_LENGTH = 10
 
-    num_features = X_train.shape[2]
-    lstm = build_LSTM(sequence_length=SEQUENCE_LENGTH, num_features=num_features)
-    lstm = train_model(lstm, X_train, y_train, X_val, y_val)
-    evaluate_model(lstm, X_val, y_val, X_test, y_test)
-    
-    save_model(lstm)
+    with phase('extract') as extract_phase:
+        matrix = load_feature_matrix()
+        extract_phase['rows'] = len(matrix)
+
+    metadata = load_model_metadata()
+    trained = False
+    if incremental and not needs_full_training(metadata, full_training_days):
+        with phase('incremental'):
+            trained = run_incremental_training(matrix, metadata, quantization=quantization)
+
+    if not trained:
+        print('Running full training...')
+
+        with phase('transform') as transform_phase:
+            X_train, X_val, X_test, y_train, y_val, y_test = get_train_test_split(matrix, SEQUENCE_LENGTH)
+            transform_phase['rows'] = len(X_train) + len(X_val) + len(X_test)
+
+        with phase('train') as train_phase:
+            num_features = X_train.shape[2]
+            lstm = build_LSTM(sequence_length=SEQUENCE_LENGTH, num_features=num_features)
+            lstm = train_model(lstm, X_train, y_train, X_val, y_val, epochs=epochs, checkpoint_dir=get_checkpoint_dir())
+            train_phase['rows'] = len(X_train)
+
+        with phase('evaluate'):
+            report = evaluate_model(lstm, X_val, y_val, X_test, y_test)
+            validation_loss, _ = lstm.evaluate(X_val, y_val, verbose=0)
+
+        with phase('save'):
+            save_model(lstm, report, quantization)
+        clear_checkpoints()
+        save_model_metadata({
+            'mode':                 'full',
+            'trained_at':           start_time.isoformat(),
+            'last_full_training':   start_time.isoformat(),
+            'training_cutoff':      str(max(get_sequence_dates(matrix, SEQUENCE_LENGTH))),
+            'version':              (metadata or {}).get('version', 0) + 1,
+            'sequence_length':      SEQUENCE_LENGTH,
+            'validation_loss':      float(validation_loss),
+            'best_threshold':       report['best_threshold']
+        })
+
+    save_run_state('model_training', 'all', stage_inputs)
 
     end_time = datetime.now()
     print(f'Model Training finished at {end_time.strftime("%Y-%m-%d %H:%M:%S")}')
     elapsed_time = end_time - start_time
     print(f'Elapsed time: {elapsed_time.seconds // 60} minutes and {elapsed_time.seconds % 60} seconds')
 
+    return True
+
 
 if __name__ == '__main__':
-    run_model_training()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Model Training')
+    add_force_args(parser)
+    parser.add_argument('--incremental', action='store_true',
+                        help='Fine-tune the saved model on the data added since its training instead of training from scratch')
+    parser.add_argument('--full-training-days', type=int, default=7,
+                        help='Days after which an incremental run does a full training anyway')
+    parser.add_argument('--quantization', choices=['float16', 'int8'], default=None,
+                        help='Weight precision of the TensorFlow Lite export, float32 by default')
+    parser.add_argument('--epochs', type=int, default=300, help='Most epochs of a full training')
+    add_profile_args(parser)
+    args = parser.parse_args()
+    profiling_from_args(args)
+
+    if not run_model_training(args.force, args.incremental, args.full_training_days, args.quantization, args.epochs):
+        sys.exit(SKIP_EXIT_CODE)
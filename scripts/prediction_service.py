@@ -0,0 +1,226 @@
+import os
+import time
+import asyncio
+import argparse
+import numpy as np
+from contextlib import asynccontextmanager
+from datetime import datetime
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+import uvicorn
+
+from model_training import load_model, load_model_metadata, load_latest_sequences, get_model_dir
+
+
+#Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5]
+BATCH_SIZE_BUCKETS = [1, 2, 4, 8, 16, 32, 64, 128, 256]
+
+config = {
+    'max_batch_size':   64,
+    'max_wait_ms':      5,
+    'cache_seconds':    3600
+}
+
+state = {}
+
+
+class PredictionRequest(BaseModel):
+    tickers: list[str]
+
+
+def new_histogram(buckets: list) -> dict:
+    return {'buckets': buckets, 'counts': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+
+
+def observe(histogram: dict, value: float):
+    '''Add an observation to a histogram. Counts are per bucket and accumulated when exported.'''
+
+    for i, bound in enumerate(histogram['buckets']):
+        if value <= bound:
+            histogram['counts'][i] += 1
+            break
+    histogram['sum'] += value
+    histogram['count'] += 1
+
+
+def format_histogram(name: str, histogram: dict) -> list:
+    '''Lines of a histogram in Prometheus text format.'''
+
+    lines = [f'# TYPE {name} histogram']
+    cumulative = 0
+    for bound, count in zip(histogram['buckets'], histogram['counts']):
+        cumulative += count
+        lines.append(f'{name}_bucket{{le="{bound}"}} {cumulative}')
+    lines.append(f'{name}_bucket{{le="+Inf"}} {histogram["count"]}')
+    lines.append(f'{name}_sum {histogram["sum"]}')
+    lines.append(f'{name}_count {histogram["count"]}')
+
+    return lines
+
+
+def load_sequences():
+    '''Cache in memory the last sequence of every ticker, so requests don't reach the database.'''
+
+    tickers, dates, X = load_latest_sequences(state['sequence_length'])
+
+    state['sequences'] = {ticker: (date, X[i]) for i, (ticker, date) in enumerate(zip(tickers, dates))}
+    state['sequences_loaded_at'] = time.monotonic()
+
+    print(f'Cached last sequences of {len(tickers)} tickers.')
+
+
+async def refresh_sequences():
+    '''Reload the cached sequences periodically, so new feature matrix rows are picked up.'''
+
+    while True:
+        await asyncio.sleep(config['cache_seconds'])
+        try:
+            await asyncio.to_thread(load_sequences)
+        except Exception as e:
+            print(f'Could not refresh cached sequences: {e}')
+
+
+async def batch_predictions():
+    '''Coalesce concurrent requests into batches scored by a single model call.
+
+    A batch is scored when it reaches the maximum size or when its first request has waited the maximum time.
+    '''
+
+    queue = state['queue']
+    max_wait = config['max_wait_ms'] / 1000
+
+    while True:
+        batch = [await queue.get()]
+        deadline = time.monotonic() + max_wait
+
+        while len(batch) < config['max_batch_size']:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        X = np.stack([sequence for sequence, _ in batch])
+        try:
+            #Scoring runs in a thread so the event loop keeps accepting requests meanwhile
+            scores = await asyncio.to_thread(lambda: np.asarray(state['model'](X, training=False)).flatten())
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            continue
+
+        observe(state['metrics']['batch_size'], len(batch))
+        for (_, future), score in zip(batch, scores):
+            if not future.done():
+                future.set_result(float(score))
+
+
+async def predict_ticker(ticker: str) -> dict:
+    if ticker not in state['sequences']:
+        raise HTTPException(status_code=404, detail=f'No sequence for ticker {ticker}')
+
+    date, sequence = state['sequences'][ticker]
+
+    future = asyncio.get_running_loop().create_future()
+    await state['queue'].put((sequence, future))
+    score = await future
+
+    return {
+        'ticker':       ticker,
+        'date':         str(date),
+        'score':        score,
+        'next_day_up':  score >= state['threshold'],
+        'threshold':    state['threshold']
+    }
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    print('Loading model...')
+
+    metadata = load_model_metadata() or {}
+    state['model'] = load_model(os.path.join(get_model_dir(), 'lstm_model.keras'))
+    state['model_version'] = metadata.get('version')
+    state['sequence_length'] = metadata.get('sequence_length', 10)
+    state['threshold'] = metadata.get('best_threshold', 0.5)
+    state['queue'] = asyncio.Queue()
+    state['metrics'] = {
+        'latency':      new_histogram(LATENCY_BUCKETS),
+        'batch_size':   new_histogram(BATCH_SIZE_BUCKETS)
+    }
+    state['started_at'] = datetime.now()
+
+    load_sequences()
+
+    tasks = [asyncio.create_task(batch_predictions()), asyncio.create_task(refresh_sequences())]
+    yield
+    for task in tasks:
+        task.cancel()
+
+
+app = FastAPI(title='Financial prediction service', lifespan=lifespan)
+
+
+@app.middleware('http')
+async def measure_latency(request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    if request.url.path.startswith('/predict'):
+        observe(state['metrics']['latency'], time.perf_counter() - start)
+
+    return response
+
+
+@app.get('/health')
+async def health() -> dict:
+    return {
+        'status':           'ok',
+        'model_version':    state['model_version'],
+        'tickers':          len(state['sequences']),
+        'started_at':       state['started_at'].isoformat()
+    }
+
+
+@app.get('/tickers')
+async def tickers() -> list:
+    return sorted(state['sequences'])
+
+
+@app.get('/predict/{ticker}')
+async def predict(ticker: str) -> dict:
+    return await predict_ticker(ticker)
+
+
+@app.post('/predict')
+async def predict_many(request: PredictionRequest) -> list:
+    return await asyncio.gather(*(predict_ticker(ticker) for ticker in request.tickers))
+
+
+@app.get('/metrics', response_class=PlainTextResponse)
+async def metrics() -> str:
+    lines = format_histogram('prediction_request_seconds', state['metrics']['latency'])
+    lines += format_histogram('prediction_batch_size', state['metrics']['batch_size'])
+    lines.append(f'prediction_queue_depth {state["queue"].qsize()}')
+
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='HTTP prediction service for the LSTM model')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--max-batch-size', type=int, default=64, help='Most requests scored in a single model call')
+    parser.add_argument('--max-wait-ms', type=float, default=5, help='Longest a request waits for others to batch with')
+    parser.add_argument('--cache-seconds', type=int, default=3600, help='Time between reloads of the cached sequences')
+    args = parser.parse_args()
+
+    config['max_batch_size'] = args.max_batch_size
+    config['max_wait_ms'] = args.max_wait_ms
+    config['cache_seconds'] = args.cache_seconds
+
+    uvicorn.run(app, host=args.host, port=args.port)
@@ -0,0 +1,157 @@
+import os
+import hashlib
+import cProfile
+import pstats
+import argparse
+import threading
+import tracemalloc
+from datetime import datetime
+
+
+#Entries listed in the summary of a profile, for each ranking of functions and for the allocations of each phase
+TOP_N = 30
+
+#Run being profiled in this process
+state = {'profile': None}
+
+
+def add_profile_args(parser: argparse.ArgumentParser):
+    '''Add the command-line option that profiles a run.'''
+
+    parser.add_argument('--profile', action='store_true',
+                        help='Profile the run with cProfile and tracemalloc, writing the results to logs/profiles')
+
+
+def profiling_from_args(args: argparse.Namespace):
+    '''Enable profiling if requested on the command line, through the environment so that child processes inherit it.'''
+
+    if args.profile:
+        os.environ['PROFILE'] = '1'
+
+
+def is_enabled() -> bool:
+    return os.getenv('PROFILE', '0').lower() not in ('', '0', 'false')
+
+
+def get_profile_dir(stage: str, shard: str, started_at: datetime) -> str:
+    '''Directory of the profile of a run. Shards of a stage start at the same second, so their label hash and the
+    process id are part of the name.'''
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    shard_hash = hashlib.md5(shard.encode()).hexdigest()[:8]
+    run_name = f'{started_at.strftime("%Y%m%d_%H%M%S")}_{shard_hash}_{os.getpid()}'
+
+    return os.path.join(os.path.dirname(scripts_dir), 'logs', 'profiles', stage, run_name)
+
+
+def start_profile(stage: str, shard: str) -> dict:
+    '''Start tracing the function calls and memory allocations of a run on the assets of a shard label.'''
+
+    profile = {
+        'stage':            stage,
+        'shard':            shard,
+        'started_at':       datetime.now(),
+        'profiler':         cProfile.Profile(),
+        'thread_profilers': [],
+        'phases':           [],
+        'snapshot':         None,
+        'lock':             threading.Lock()
+    }
+    state['profile'] = profile
+
+    tracemalloc.start()
+    profile['snapshot'] = tracemalloc.take_snapshot()
+    profile['profiler'].enable()
+
+    return profile
+
+
+def start_phase():
+    '''Reset the peak of traced memory, so the peak read at the end of a phase is its own.'''
+
+    if state['profile'] is not None:
+        tracemalloc.reset_peak()
+
+
+def snapshot_phase(name: str):
+    '''Record the peak traced memory of a phase and the lines whose allocations grew the most during it.'''
+
+    profile = state['profile']
+    if profile is None:
+        return
+
+    _, peak = tracemalloc.get_traced_memory()
+
+    #Comparing snapshots loops over every allocation in Python, which must not be profiled as part of the run
+    profile['profiler'].disable()
+    snapshot = tracemalloc.take_snapshot()
+    growth = [stat for stat in snapshot.compare_to(profile['snapshot'], 'lineno')
+              if not stat.traceback[0].filename.startswith('<frozen importlib')
+              and stat.traceback[0].filename != tracemalloc.__file__][:TOP_N]
+    profile['profiler'].enable()
+
+    profile['phases'].append({'phase': name, 'peak_mb': peak / 2**20, 'growth': growth})
+    profile['snapshot'] = snapshot
+
+
+def profile_thread(function: object) -> object:
+    '''Wrap the target of a worker thread so that its calls are profiled too, as cProfile follows a single thread.'''
+
+    profile = state['profile']
+    if profile is None:
+        return function
+
+    def profiled_function(*args, **kwargs):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError: #From Python 3.12 on, the profiler of the run already follows every thread
+            return function(*args, **kwargs)
+
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profiler.disable()
+            with profile['lock']:
+                profile['thread_profilers'].append(profiler)
+
+    return profiled_function
+
+
+def write_summary(path: str, profile: dict, stats: pstats.Stats):
+    '''Human-readable summary of a profile: slowest functions and memory allocated by each phase.'''
+
+    with open(path, 'w') as f:
+        f.write(f'Profile of {profile["stage"]} for assets {profile["shard"]} started at {profile["started_at"].strftime("%Y-%m-%d %H:%M:%S")}\n\n')
+
+        stats.stream = f
+        for sort_key, title in [('cumulative', 'including the functions they call'), ('tottime', 'excluding the functions they call')]:
+            f.write(f'Top {TOP_N} functions by time {title}:\n')
+            stats.sort_stats(sort_key).print_stats(TOP_N)
+
+        for phase_info in profile['phases']:
+            f.write(f'Phase {phase_info["phase"]}: peak traced memory {phase_info["peak_mb"]:.1f} MB. '
+                    f'Top {TOP_N} lines by memory allocated during the phase and not freed:\n')
+            for stat in phase_info['growth']:
+                f.write(f'    {stat}\n')
+            f.write('\n')
+
+
+def stop_profile(profile: dict):
+    '''Stop tracing and write the profile of the run, loadable with pstats or snakeviz, along with its summary.'''
+
+    profile['profiler'].disable()
+    tracemalloc.stop()
+    state['profile'] = None
+
+    profile_dir = get_profile_dir(profile['stage'], profile['shard'], profile['started_at'])
+    os.makedirs(profile_dir, exist_ok=True)
+
+    stats = pstats.Stats(profile['profiler'])
+    for profiler in profile['thread_profilers']:
+        stats.add(profiler)
+    stats.dump_stats(os.path.join(profile_dir, 'run.prof'))
+
+    write_summary(os.path.join(profile_dir, 'summary.txt'), profile, stats)
+
+    print(f'Profile written to {profile_dir}')
@@ -0,0 +1,120 @@
+import os
+import gzip
+import json
+import hashlib
+import argparse
+from datetime import datetime, date
+
+try:
+    import zstandard
+except ImportError: #Optional, gzip is used when not installed
+    zstandard = None
+
+
+def add_replay_args(parser: argparse.ArgumentParser):
+    '''Add the command-line option that makes a script read raw responses from the archive instead of the network.'''
+
+    parser.add_argument('--replay', nargs='?', const='latest', default=None, metavar='YYYY-MM-DD',
+                        help='Replay archived raw responses of the given day, or of the latest archived day if omitted')
+
+
+def get_archive_dir() -> str:
+    '''Root directory of the raw response archive.'''
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    parent_dir = os.path.dirname(scripts_dir)
+
+    return os.getenv('RAW_ARCHIVE_DIR', os.path.join(parent_dir, 'data', 'raw'))
+
+
+def compress(content: bytes) -> tuple:
+    '''Compress content with zstd if available, otherwise gzip. Returns the data and its file extension.'''
+
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(content), '.zst'
+
+    return gzip.compress(content, compresslevel=6), '.gz'
+
+
+def decompress(path: str) -> bytes:
+    '''Read an archived file, whichever the compression used to write it.'''
+
+    with open(path, 'rb') as f:
+        data = f.read()
+
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f'zstandard is required to read {path}')
+        return zstandard.ZstdDecompressor().decompress(data)
+
+    return gzip.decompress(data)
+
+
+def archive_response(source: str, key: str, content: bytes, fetched_at: datetime =None) -> str:
+    '''Persist a raw response in the archive, partitioned by source and date and named by its content hash.'''
+
+    fetched_at = fetched_at or datetime.now()
+    digest = hashlib.sha256(content).hexdigest()
+
+    partition_dir = os.path.join(get_archive_dir(), source, fetched_at.date().isoformat())
+    os.makedirs(partition_dir, exist_ok=True)
+
+    #Identical content is stored only once per partition
+    existing = [digest + extension for extension in ('.zst', '.gz')
+                if os.path.exists(os.path.join(partition_dir, digest + extension))]
+    if existing:
+        file_name = existing[0]
+    else:
+        data, extension = compress(content)
+        file_name = digest + extension
+        tmp_path = os.path.join(partition_dir, file_name + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, os.path.join(partition_dir, file_name))
+
+    record = {'key': key, 'sha256': digest, 'file': file_name, 'size': len(content), 'fetched_at': fetched_at.isoformat()}
+    with open(os.path.join(partition_dir, 'manifest.jsonl'), 'a') as f:
+        f.write(json.dumps(record) + '\n')
+
+    return os.path.join(partition_dir, file_name)
+
+
+def get_archived_days(source: str) -> list:
+    '''Days for which raw responses of a source are archived, in chronological order.'''
+
+    source_dir = os.path.join(get_archive_dir(), source)
+
+    if not os.path.isdir(source_dir):
+        return []
+
+    return sorted(day for day in os.listdir(source_dir) if os.path.exists(os.path.join(source_dir, day, 'manifest.jsonl')))
+
+
+def get_archived_files(source: str, day: str ='latest') -> dict:
+    '''Paths of the archived raw responses of a source on a day, keeping the last one fetched per key.'''
+
+    if day == 'latest':
+        days = get_archived_days(source)
+        if not days:
+            print(f'No archived responses for source {source}.')
+            return {}
+        day = days[-1]
+    else:
+        day = date.fromisoformat(day).isoformat()
+
+    partition_dir = os.path.join(get_archive_dir(), source, day)
+    manifest_path = os.path.join(partition_dir, 'manifest.jsonl')
+
+    if not os.path.exists(manifest_path):
+        print(f'No archived responses for source {source} on {day}.')
+        return {}
+
+    print(f'Replaying archived responses of {source} from {day}...')
+
+    latest_files = {}
+    with open(manifest_path) as f:
+        for line in f:
+            record = json.loads(line)
+            latest_files[record['key']] = record['file']
+
+    return {key: os.path.join(partition_dir, file_name) for key, file_name in latest_files.items()}
@@ -0,0 +1,134 @@
+import os
+import json
+import hashlib
+import argparse
+import psycopg2
+from psycopg2.extras import Json
+from datetime import datetime
+
+from db import get_db_params
+
+
+#Exit code of a script whose stage was skipped, so the DAG can skip the tasks downstream of it
+SKIP_EXIT_CODE = 99
+
+
+def add_force_args(parser: argparse.ArgumentParser):
+    '''Add the command-line option that runs a stage even if its inputs did not change.'''
+
+    parser.add_argument('--force', action='store_true', help='Run even if the inputs are unchanged since the last run')
+
+
+def get_code_version(*paths: str) -> str:
+    '''Hash of the source files a stage's results depend on, so code changes invalidate previous runs.
+
+    Relative paths are taken from the scripts directory, so a stage lists the helper modules it uses by file name.
+    '''
+
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+
+    digest = hashlib.sha256()
+    for path in paths:
+        with open(os.path.join(scripts_dir, path), 'rb') as f:
+            digest.update(f.read())
+
+    return digest.hexdigest()[:16]
+
+
+def query_inputs(queries: dict) -> dict:
+    '''Run cheap aggregate queries describing the source tables of a stage, e.g. row counts and max ids.
+
+    Each query is given by a name and a (sql, params) tuple and must return a single row.
+    '''
+
+    db_conn_params = get_db_params()['db_conn']
+
+    inputs = {}
+    with psycopg2.connect(**db_conn_params) as conn:
+        with conn.cursor() as cur:
+            for name, (query, query_params) in queries.items():
+                cur.execute(query, query_params)
+                inputs[name] = list(cur.fetchone())
+
+    return inputs
+
+
+def compute_fingerprint(inputs: dict) -> str:
+    '''Stable hash of the inputs of a stage.'''
+
+    serialized = json.dumps(inputs, sort_keys=True, default=str)
+
+    return hashlib.sha256(serialized.encode()).hexdigest()
+
+
+def get_last_run(stage: str, shard: str) -> tuple:
+    '''Fingerprint, inputs and completion time of the last successful run of a stage on a shard.'''
+
+    params =            get_db_params()
+    run_state_tbl =     params['run_state']
+    db_conn_params =    params['db_conn']
+
+    select_query = f'''SELECT fingerprint, inputs, completed_at
+                        FROM {run_state_tbl}
+                        WHERE stage = %s AND shard = %s;
+                    '''
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(select_query, (stage, shard))
+                record = cur.fetchone()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+        return None
+
+    return record
+
+
+def inputs_unchanged(stage: str, shard: str, inputs: dict, force: bool =False) -> bool:
+    '''Whether a stage can be skipped because its inputs are the same as in its last successful run.'''
+
+    if force:
+        print(f'Forced run of {stage} for assets {shard}.')
+        return False
+
+    last_run = get_last_run(stage, shard)
+
+    if last_run is None:
+        print(f'No previous run of {stage} for assets {shard}.')
+        return False
+
+    fingerprint, last_inputs, completed_at = last_run
+
+    if fingerprint != compute_fingerprint(inputs):
+        changed = sorted(name for name in inputs if json.dumps(inputs[name], default=str) != json.dumps((last_inputs or {}).get(name), default=str))
+        print(f'Inputs of {stage} changed since last run at {completed_at}: {", ".join(changed) or "format"}.')
+        return False
+
+    print(f'Skipping {stage} for assets {shard}: inputs unchanged since last run at {completed_at} ({json.dumps(inputs, default=str)}).')
+
+    return True
+
+
+def save_run_state(stage: str, shard: str, inputs: dict):
+    '''Record the inputs of a successful run of a stage.'''
+
+    params =            get_db_params()
+    run_state_tbl =     params['run_state']
+    db_conn_params =    params['db_conn']
+
+    upsert_query = f'''INSERT INTO {run_state_tbl} (stage, shard, fingerprint, inputs, completed_at)
+                        VALUES (%s, %s, %s, %s, %s)
+                        ON CONFLICT (stage, shard) DO UPDATE
+                        SET fingerprint = EXCLUDED.fingerprint, inputs = EXCLUDED.inputs, completed_at = EXCLUDED.completed_at;
+    '''
+
+    serializable_inputs = json.loads(json.dumps(inputs, default=str))
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(upsert_query, (stage, shard, compute_fingerprint(inputs), Json(serializable_inputs), datetime.now()))
+                conn.commit()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
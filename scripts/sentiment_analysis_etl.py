@@ -3,12 +3,35 @@ from psycopg2.extras import execute_values
 import pandas as pd
 from transformers import pipeline
 from datetime import datetime
+import argparse
+import sys
 
 from db import get_db_params
+from shards import shard_filter
+from run_state import add_force_args, get_code_version, query_inputs, inputs_unchanged, save_run_state, SKIP_EXIT_CODE
+from instrumentation import instrumented, phase
+from profiling import add_profile_args, profiling_from_args
 
 
-def get_sources() -> pd.DataFrame:
-    '''Retrieve text sources from DB.'''
+SENTIMENT_MODEL = 'ProsusAI/finbert'
+
+
+def get_stage_inputs() -> dict:
+    '''Cheap summary of the sources to analyze and of the model, to detect when there is nothing new.'''
+
+    sources_tbl = get_db_params()['sentiment_sources']
+
+    inputs = query_inputs({
+        'sources': (f'SELECT COUNT(*), MAX(content_id) FROM {sources_tbl}', [])
+    })
+    inputs['model'] = SENTIMENT_MODEL
+    inputs['code'] = get_code_version(__file__, 'shards.py')
+
+    return inputs
+
+
+def get_sources(shard: dict =None, start_date: str =None, end_date: str =None) -> pd.DataFrame:
+    '''Retrieve text sources from DB, optionally restricted to some assets and a publishing date range.'''
 
     print('Extracting sources from database...')
 
@@ -17,20 +40,23 @@ def get_sources() -> pd.DataFrame:
     assets_tbl =        params['assets']
     db_conn_params =    params['db_conn']
 
-    columns = ['s.content_id', 's.published_date', 's.title', 'c.name']
+    columns = ['s.content_id', 's.published_date', 's.title', 's.body', 'c.name']
 
+    shard_condition, shard_params = shard_filter(shard, 's.ticker')
     select_query = f'''SELECT {", ".join(columns)}
                         FROM {sources_tbl} s
                         LEFT JOIN {assets_tbl} c
-                        ON s.ticker = c.ticker;
+                        ON s.ticker = c.ticker
+                        WHERE {shard_condition}
+                        AND s.published_date >= COALESCE(%s::date, '-infinity'::date)
+                        AND s.published_date <= COALESCE(%s::date, 'infinity'::date);
                     '''
-    #TODO filter by published_date
     #TODO handle pseudonyms
 
     try:
         with psycopg2.connect(**db_conn_params) as conn:
             with conn.cursor() as cur:
-                cur.execute(select_query)
+                cur.execute(select_query, shard_params + [start_date, end_date])
                 conn.commit()
                 records = cur.fetchall()
     except psycopg2.Error as e:
@@ -41,19 +67,28 @@ def get_sources() -> pd.DataFrame:
     return sources_df
 
 
-def analyze_sentiment(analysis_df: pd.DataFrame, analysis_timpestamp: datetime) -> pd.DataFrame:
+def load_sentiment_model() -> object:
+    '''Load the pretrained model used to analyze sentiment.'''
+
+    print('Loading sentiment analysis model...')
+
+    return pipeline('sentiment-analysis', model=SENTIMENT_MODEL)
+
+
+def analyze_sentiment(analysis_df: pd.DataFrame, analysis_timpestamp: datetime, sentiment_model: object =None) -> pd.DataFrame:
     '''Analyze the sentiment of each text referring to an asset.'''
     #TODO analyze based on each company, as there may be more than one in the same text
 
     print('Analyzing sentiment of sources...')
 
-    model = 'ProsusAI/finbert'
-    sentiment_model = pipeline('sentiment-analysis', model=model)
+    if sentiment_model is None:
+        sentiment_model = load_sentiment_model()
     
-    texts = analysis_df['s.title']
+    #Title first, as the model only reads the first 512 tokens of a text and longer ones are truncated
+    texts = [title if not body else f'{title}\n{body}' for title, body in zip(analysis_df['s.title'], analysis_df['s.body'])]
     results = []
     for text in texts:
-        res = sentiment_model(text)[0]
+        res = sentiment_model(text, truncation=True)[0]
         results.append(res)
 
     sentiment_score = [1 if result['label'] == 'positive'
@@ -64,7 +99,7 @@ def analyze_sentiment(analysis_df: pd.DataFrame, analysis_timpestamp: datetime)
 
     analysis_df['sentiment_score']      = sentiment_score
     analysis_df['score_confidence']     = score_confidence
-    analysis_df['model_name']           = model
+    analysis_df['model_name']           = SENTIMENT_MODEL
     analysis_df['analyzed_at']          = analysis_timpestamp
 
     return analysis_df
@@ -83,12 +118,12 @@ def transform_data(df: pd.DataFrame) -> list:
     return rows
 
 
-def store_results(rows: list):
+def store_results(rows: list) -> bool:
     '''Insert rows into the database using bulk insert.'''
 
     if not rows:
         print('No new data to insert.')
-        return
+        return True
     
     print('Loading sentiment analysis results into database...')
     
@@ -96,10 +131,14 @@ def store_results(rows: list):
     sentiment_analysis_tbl =    params['sentiment_analysis']
     db_conn_params =            params['db_conn']
 
-    #No 'ON CONFLICT' clause as later results may be better if model is improved
+    #Results of every run are kept, as later ones may be better if the model is improved. Within a run they are
+    #upserted, so a backfill partition retried after storing its results doesn't duplicate them
     insert_query = f'''
                     INSERT INTO {sentiment_analysis_tbl} (source_id, sentiment_score, score_confidence, model_name, analyzed_at)
-                    VALUES %s;
+                    VALUES %s
+                    ON CONFLICT (source_id, model_name, analyzed_at) DO UPDATE
+                    SET sentiment_score = EXCLUDED.sentiment_score,
+                        score_confidence = EXCLUDED.score_confidence;
     '''
 
     try:
@@ -109,27 +148,52 @@ def store_results(rows: list):
                 conn.commit()
     except psycopg2.Error as e:
         print(f'Database error: {e}')
-        return
+        return False
         
     print(f'Insertion successful.')
 
+    return True
+
 
-def run_sentiment_analysis_etl():
+@instrumented('sentiment_analysis_etl')
+def run_sentiment_analysis_etl(force: bool =False) -> bool:
     start_time = datetime.now()
     print(f'Starting Sentiment Analysis ETL at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
 
+    stage_inputs = get_stage_inputs()
+    if inputs_unchanged('sentiment_analysis_etl', 'all', stage_inputs, force):
+        return False
+
     #Extract
-    sources_df = get_sources()
+    with phase('extract') as extract_phase:
+        sources_df = get_sources()
+        extract_phase['rows'] = len(sources_df)
 
     #Transform
-    analysis_df = analyze_sentiment(sources_df, start_time)
-    rows = transform_data(analysis_df)
+    with phase('transform') as transform_phase:
+        analysis_df = analyze_sentiment(sources_df, start_time)
+        rows = transform_data(analysis_df)
+        transform_phase['rows'] = len(rows)
 
     #Load
-    store_results(rows)
+    with phase('load') as load_phase:
+        stored = store_results(rows)
+        load_phase['rows'] = len(rows)
+
+    if stored:
+        save_run_state('sentiment_analysis_etl', 'all', stage_inputs)
 
     print(f'ETL process finished at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
 
+    return True
+
 
 if __name__ == '__main__':
-    run_sentiment_analysis_etl()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Sentiment Analysis ETL')
+    add_force_args(parser)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    profiling_from_args(args)
+
+    if not run_sentiment_analysis_etl(args.force):
+        sys.exit(SKIP_EXIT_CODE)
\ No newline at end of file
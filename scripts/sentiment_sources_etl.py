@@ -7,16 +7,42 @@ import pandas as pd
 import re
 from rapidfuzz import process, fuzz
 from collections.abc import KeysView
+import requests
+import argparse
 
 from db import get_db_params
-
-
-def fetch_rss_news(url: str) -> list:
-    '''Fetch news articles from an RSS feed.'''
-
-    print('Fetching RSS news...')
-
-    feed = feedparser.parse(url)
+from raw_archive import add_replay_args, archive_response, get_archived_files, get_archived_days, decompress
+from streaming import run_pipeline, print_pipeline_stats
+from article_bodies import new_fetcher, fetch_body, print_fetch_stats
+from instrumentation import instrumented, phase, count_bytes
+from profiling import add_profile_args, profiling_from_args
+
+
+def fetch_rss_news(url: str, replay: str =None) -> list:
+    '''Fetch news articles from an RSS feed, or read them from the raw archive if replaying a day.'''
+
+    if replay is None:
+        print('Fetching RSS news...')
+
+        req = requests.get(url, timeout=30)
+        if req.status_code != 200:
+            print(f"Couldn't retrieve RSS feed {url}")
+            return []
+
+        #Keep the raw feed so it can be reprocessed without fetching it again
+        archive_response('rss', url, req.content)
+        raw_feed = req.content
+        count_bytes(len(raw_feed))
+    else:
+        archived_files = get_archived_files('rss', replay)
+        if url not in archived_files:
+            print(f'No archived feed for {url}')
+            return []
+
+        raw_feed = decompress(archived_files[url])
+        count_bytes(len(raw_feed))
+
+    feed = feedparser.parse(raw_feed)
     articles = []
     for entry in feed.entries:
         articles.append({
@@ -39,7 +65,6 @@ def build_org_ticker_dict() -> dict:
     db_conn_params =    params['db_conn']
 
     select_query = f'''SELECT name, pseudonym, ticker FROM {assets_tbl}
-                        WHERE ticker = 'SPY'
                     '''
 
     try:
@@ -89,35 +114,54 @@ def fuzzy_match_org(org: str, relevant_orgs: KeysView, threshold: int =85) -> st
         return match
 
 
+def get_article_body(article: dict) -> str:
+    '''Text of the linked page of an article if it could be fetched, otherwise the summary in the feed.'''
+
+    return article.get('body') or article['summary']
+
+
+def extract_article_orgs(article: dict, relevant_orgs: KeysView, nlp_model: object) -> set:
+    '''Extract the organization names mentioned in the title and body of an article.'''
+
+    title = article['title']
+    body = get_article_body(article)
+
+    return set(extract_orgs(title, relevant_orgs, nlp_model) + extract_orgs(body, relevant_orgs, nlp_model))
+
+
+def build_article_rows(article: dict, orgs: set, ticker_dict: dict, url: str, scraping_timestamp: datetime) -> list:
+    '''Match the organizations mentioned in an article with the assets in DB and return a row per mentioned asset.'''
+
+    rows = []
+
+    for org in orgs:
+        match = fuzzy_match_org(org, ticker_dict.keys())
+        if match is not None:
+            rows.append(('Yahoo Finance', #TODO parameterize
+                         datetime.strptime(article['published'], '%a, %d %b %Y %H:%M:%S %z').date(),
+                         article['title'],
+                         get_article_body(article),
+                         url,
+                         scraping_timestamp,
+                         ticker_dict[match]
+            ))
+
+    return rows
+
+
 def build_asset_mentions_df(articles: list, ticker_dict: dict, nlp_model: object, url: str, scraping_timestamp: datetime) -> pd.DataFrame:
     '''Iterate the scraped articles and return data about the relevant mentioned assets.'''
 
     print('Extracting mentions of assets in news...')
 
     columns = ['source', 'published_date', 'title', 'body', 'url', 'scraped_at', 'ticker']
-    sentiment_sources = pd.DataFrame(columns=columns)
-    
+
+    rows = []
     for article in articles:
-        title = article['title']
-        body = article['summary'] #TODO extract true body via link
-        orgs = set(extract_orgs(title, ticker_dict.keys(), nlp_model) 
-                   + extract_orgs(body, ticker_dict.keys(), nlp_model)
-                )
-        
-        for org in orgs:
-            match = fuzzy_match_org(org, ticker_dict.keys())
-            if match is not None:
-                new_row = ['Yahoo Finance', #TODO parameterize
-                           datetime.strptime(article['published'], '%a, %d %b %Y %H:%M:%S %z').date(),
-                           title,
-                           body, #TODO extract true body via link
-                           url,
-                           scraping_timestamp,
-                           ticker_dict[match]
-                ]
-                sentiment_sources.loc[len(sentiment_sources)] = new_row
-
-    return sentiment_sources
+        orgs = extract_article_orgs(article, ticker_dict.keys(), nlp_model)
+        rows.extend(build_article_rows(article, orgs, ticker_dict, url, scraping_timestamp))
+
+    return pd.DataFrame(rows, columns=columns)
 
 
 def transform_data(df: pd.DataFrame) -> list:
@@ -165,25 +209,84 @@ def load_data(rows: list):
     print(f'Insertion successful.')
 
 
-def run_sentiment_sources_etl():
-    start_time = datetime.now()
-    print(f'Starting News Sentiment ETL at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+def get_rss_urls(tickers: list) -> list:
+    '''RSS feeds of news about each asset.'''
+
+    return [f'https://feeds.finance.yahoo.com/rss/2.0/headline?s={ticker}&region=US&lang=en-US' for ticker in tickers]
 
-    #Extract
-    rss_url = 'https://feeds.finance.yahoo.com/rss/2.0/headline?s=SPY&region=US&lang=en-US'
-    articles = fetch_rss_news(rss_url)
 
-    #Transform
-    org_to_ticker_dict = build_org_ticker_dict()
-    nlp = spacy.load('en_core_web_sm')
-    sources_df = build_asset_mentions_df(articles, org_to_ticker_dict, nlp, rss_url, start_time)
-    rows = transform_data(sources_df)
+@instrumented('sentiment_sources_etl')
+def run_sentiment_sources_etl(replay: str =None, queue_size: int =64, load_batch_size: int =500, body_workers: int =16,
+                              max_per_host: int =4, body_ttl_days: float =7):
+    start_time = datetime.now()
+    print(f'Starting News Sentiment ETL at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
 
-    #Load
-    load_data(rows)
+    with phase('setup'):
+        org_to_ticker_dict = build_org_ticker_dict()
+        nlp = spacy.load('en_core_web_sm')
+        rss_urls = get_rss_urls(sorted(set(org_to_ticker_dict.values())))
+
+    #Feeds and article bodies are replayed from the same day, by default the latest with archived feeds
+    if replay == 'latest':
+        archived_days = get_archived_days('rss')
+        replay = archived_days[-1] if archived_days else replay
+    fetcher = new_fetcher(max_per_host, ttl_days=body_ttl_days, replay=replay)
+
+    #Fetching, NER, matching and loading run concurrently: network, CPU and DB waits overlap
+    def fetch(url: str) -> list:
+        return [(url, article) for article in fetch_rss_news(url, replay)]
+
+    def fetch_article_body(item: tuple) -> list:
+        url, article = item
+        return [(url, {**article, 'body': fetch_body(fetcher, article['link'])})]
+
+    def recognize(item: tuple) -> list:
+        url, article = item
+        return [(url, article, extract_article_orgs(article, org_to_ticker_dict.keys(), nlp))]
+
+    def match(item: tuple) -> list:
+        url, article, orgs = item
+        return build_article_rows(article, orgs, org_to_ticker_dict, url, start_time)
+
+    pending_rows = []
+
+    def load(row: tuple) -> list:
+        pending_rows.append(row)
+        if len(pending_rows) >= load_batch_size:
+            flush()
+        return []
+
+    def flush() -> list:
+        load_data(pending_rows.copy())
+        pending_rows.clear()
+        return []
+
+    stages = [
+        {'name': 'fetch',   'function': fetch, 'workers': 4},
+        {'name': 'body',    'function': fetch_article_body, 'workers': body_workers},
+        {'name': 'ner',     'function': recognize},
+        {'name': 'match',   'function': match},
+        {'name': 'load',    'function': load, 'finish': flush}
+    ]
+    #Extract, transform and load overlap, so they are measured as a single phase
+    with phase('pipeline') as pipeline_phase:
+        stats = run_pipeline(rss_urls, stages, queue_size=queue_size)
+        pipeline_phase['rows'] = stats[-1]['items_in'] #Rows received by the load stage
+    print_pipeline_stats(stats)
+    print_fetch_stats(fetcher)
 
     print(f'ETL process finished at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
 
 
 if __name__ == '__main__':
-    run_sentiment_sources_etl()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='News Sentiment ETL')
+    add_replay_args(parser)
+    add_profile_args(parser)
+    parser.add_argument('--body-workers', type=int, default=16, help='Article pages fetched at once')
+    parser.add_argument('--max-per-host', type=int, default=4, help='Article pages fetched at once from the same host')
+    parser.add_argument('--body-ttl-days', type=float, default=7, help='Days after which a cached article page is fetched again')
+    args = parser.parse_args()
+    profiling_from_args(args)
+
+    run_sentiment_sources_etl(args.replay, body_workers=args.body_workers, max_per_host=args.max_per_host,
+                              body_ttl_days=args.body_ttl_days)
\ No newline at end of file
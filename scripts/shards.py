@@ -0,0 +1,176 @@
+import argparse
+import json
+import psycopg2
+
+from db import get_db_params
+
+
+def add_shard_args(parser: argparse.ArgumentParser):
+    '''Add the command-line options that select the tickers a script works on.'''
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--tickers', type=str, default=None,
+                       help='Comma-separated list of tickers to process, e.g. SPY,QQQ')
+    group.add_argument('--shard', type=str, default=None,
+                       help='Hash bucket of tickers to process, as <index>/<count>, e.g. 0/4')
+
+
+def shard_from_args(args: argparse.Namespace) -> dict:
+    '''Build a shard definition from parsed command-line options. None means all assets.'''
+
+    if args.tickers:
+        tickers = sorted({ticker.strip() for ticker in args.tickers.split(',') if ticker.strip()})
+        return {'tickers': tickers}
+
+    if args.shard:
+        index, count = (int(value) for value in args.shard.split('/'))
+        if not 0 <= index < count:
+            raise ValueError(f'Invalid shard {args.shard}: index must be in [0, count)')
+        return {'bucket': index, 'buckets': count}
+
+    return None
+
+
+def shard_filter(shard: dict, column: str ='ticker') -> tuple:
+    '''Return a SQL condition restricting a ticker column to the shard, and its query parameters.'''
+
+    if shard is None:
+        return 'TRUE', []
+
+    if 'tickers' in shard:
+        return f'{column} = ANY(%s)', [list(shard['tickers'])]
+
+    #hashtext is stable across sessions, so every task agrees on which bucket a ticker belongs to
+    return f'MOD(ABS(HASHTEXT({column})::bigint), %s) = %s', [shard['buckets'], shard['bucket']]
+
+
+def shard_label(shard: dict) -> str:
+    '''Readable and stable identifier of a shard, used in logs and run records.'''
+
+    if shard is None:
+        return 'all'
+
+    if 'tickers' in shard:
+        return ','.join(shard['tickers'])
+
+    return f'{shard["bucket"]}/{shard["buckets"]}'
+
+
+def shard_to_arg(shard: dict) -> str:
+    '''Inverse of shard_from_args: command-line option selecting the shard.'''
+
+    if shard is None:
+        return ''
+
+    if 'tickers' in shard:
+        return f'--tickers={",".join(shard["tickers"])}'
+
+    return f'--shard={shard["bucket"]}/{shard["buckets"]}'
+
+
+def get_all_tickers(shard: dict =None) -> list:
+    '''Read from DB the tickers of all configured assets, optionally only those in a shard.'''
+
+    params =            get_db_params()
+    assets_tbl =        params['assets']
+    db_conn_params =    params['db_conn']
+
+    shard_condition, shard_params = shard_filter(shard)
+    select_query = f'''SELECT ticker FROM {assets_tbl}
+                        WHERE {shard_condition}
+                        ORDER BY ticker;
+                    '''
+
+    #Errors are raised, as an empty list would plan no shards and silently skip every stage
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(select_query, shard_params)
+                records = cur.fetchall()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+        raise
+
+    return [record[0] for record in records]
+
+
+def plan_shards(shard_size: int =10, max_shards: int =16) -> list:
+    '''Split the configured assets into ticker shards of roughly equal size.'''
+
+    tickers = get_all_tickers()
+
+    if not tickers:
+        return []
+
+    num_shards = min(max_shards, -(-len(tickers) // shard_size))
+    return [{'tickers': tickers[i::num_shards]} for i in range(num_shards)]
+
+
+def get_shard_coverage() -> list:
+    '''Latest date reached by each asset at every stage of the pipeline.'''
+
+    params =                    get_db_params()
+    assets_tbl =                params['assets']
+    asset_price_tbl =           params['assets_price']
+    technical_analysis_tbl =    params['technical_analysis']
+    feature_matrix_tbl =        params['feature_matrix']
+    db_conn_params =            params['db_conn']
+
+    select_query = f'''SELECT c.ticker,
+                            (SELECT MAX(p.date) FROM {asset_price_tbl} p WHERE p.ticker = c.ticker),
+                            (SELECT MAX(p.date) FROM {asset_price_tbl} p
+                                JOIN {technical_analysis_tbl} t ON p.price_id = t.asset_price_id
+                                WHERE p.ticker = c.ticker),
+                            (SELECT MAX(m.date) FROM {feature_matrix_tbl} m WHERE m.ticker = c.ticker)
+                        FROM {assets_tbl} c
+                        ORDER BY c.ticker;
+                    '''
+
+    records = []
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(select_query)
+                records = cur.fetchall()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+
+    return records
+
+
+def reduce_shards():
+    '''Report how far every asset got through the sharded stages once all shards are done.'''
+
+    print('Checking coverage of sharded stages...')
+
+    lagging = []
+    for ticker, price_date, metrics_date, matrix_date in get_shard_coverage():
+        print(f'{ticker}: prices up to {price_date}, metrics up to {metrics_date}, feature matrix up to {matrix_date}')
+        if price_date is None or metrics_date != price_date:
+            lagging.append(ticker)
+
+    if lagging:
+        print(f'Assets with missing technical metrics: {", ".join(lagging)}')
+    else:
+        print('All assets are up to date.')
+
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan and check ticker shards of the pipeline')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    plan_parser = subparsers.add_parser('plan', help='Print shards as a JSON list of command-line options')
+    plan_parser.add_argument('--shard-size', type=int, default=10)
+    plan_parser.add_argument('--max-shards', type=int, default=16)
+
+    subparsers.add_parser('reduce', help='Report per-asset progress of the sharded stages')
+
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        shards = plan_shards(args.shard_size, args.max_shards)
+        #Last line of output is read by the DAG
+        print(json.dumps([shard_to_arg(shard) for shard in shards]))
+    else:
+        reduce_shards()
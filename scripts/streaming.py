@@ -0,0 +1,125 @@
+import time
+import queue
+import threading
+
+from profiling import profile_thread
+
+
+_END = object() #Marks the end of the input of a stage
+
+
+def run_pipeline(inputs: list, stages: list, queue_size: int =64) -> list:
+    '''Stream items through stages running concurrently, each one in its own threads and with a bounded input queue.
+
+    Each stage is a dict with a 'name' and a 'function' mapping one item to the list of items it passes to the
+    next stage. Optionally, it has a number of 'workers' and a 'finish' function returning the last items to pass
+    once its input is exhausted. A full queue blocks the stage feeding it, so a slow stage throttles the ones
+    before it instead of letting items pile up in memory.
+
+    Returns statistics of each stage: items processed, busy time and depth of its input queue.
+    '''
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    locks = [threading.Lock() for _ in stages]
+    remaining_workers = [stage.get('workers', 1) for stage in stages]
+    stats = [{'name': stage['name'], 'workers': stage.get('workers', 1), 'items_in': 0, 'items_out': 0, 'errors': 0,
+              'busy_seconds': 0.0, 'max_queue_depth': 0, 'queue_depth_sum': 0}
+             for stage in stages]
+
+    def emit(index: int, items: list):
+        if index + 1 < len(stages):
+            for item in items:
+                queues[index + 1].put(item)
+
+    def work(index: int):
+        stage = stages[index]
+        stage_stats = stats[index]
+
+        while True:
+            item = queues[index].get()
+            if item is _END:
+                break
+
+            depth = queues[index].qsize()
+            start = time.perf_counter()
+            try:
+                outputs = stage['function'](item) or []
+                error = 0
+            except Exception as e:
+                print(f'Error in stage {stage["name"]}: {e}')
+                outputs = []
+                error = 1
+            busy = time.perf_counter() - start
+
+            with locks[index]:
+                stage_stats['items_in'] += 1
+                stage_stats['items_out'] += len(outputs)
+                stage_stats['errors'] += error
+                stage_stats['busy_seconds'] += busy
+                stage_stats['max_queue_depth'] = max(stage_stats['max_queue_depth'], depth)
+                stage_stats['queue_depth_sum'] += depth
+
+            #Time blocked here waiting for room downstream is backpressure, not work, so it is not counted as busy
+            emit(index, outputs)
+
+        with locks[index]:
+            remaining_workers[index] -= 1
+            is_last_worker = remaining_workers[index] == 0
+
+        if is_last_worker:
+            if 'finish' in stage:
+                start = time.perf_counter()
+                try:
+                    outputs = stage['finish']() or []
+                except Exception as e:
+                    print(f'Error finishing stage {stage["name"]}: {e}')
+                    outputs = []
+                    stage_stats['errors'] += 1
+                with locks[index]:
+                    stage_stats['busy_seconds'] += time.perf_counter() - start
+                    stage_stats['items_out'] += len(outputs)
+                emit(index, outputs)
+
+            if index + 1 < len(stages):
+                for _ in range(stages[index + 1].get('workers', 1)):
+                    queues[index + 1].put(_END)
+
+    start = time.perf_counter()
+
+    threads = [threading.Thread(target=profile_thread(work), args=(index,), name=f'{stage["name"]}-{worker}', daemon=True)
+               for index, stage in enumerate(stages)
+               for worker in range(stage.get('workers', 1))]
+    for thread in threads:
+        thread.start()
+
+    for item in inputs:
+        queues[0].put(item)
+    for _ in range(stages[0].get('workers', 1)):
+        queues[0].put(_END)
+
+    for thread in threads:
+        thread.join()
+
+    wall_seconds = time.perf_counter() - start
+
+    for stage_stats in stats:
+        stage_stats['wall_seconds'] = wall_seconds
+        stage_stats['utilization'] = stage_stats['busy_seconds'] / (wall_seconds * stage_stats['workers']) if wall_seconds else 0
+        stage_stats['mean_queue_depth'] = stage_stats['queue_depth_sum'] / stage_stats['items_in'] if stage_stats['items_in'] else 0
+        del stage_stats['queue_depth_sum']
+
+    return stats
+
+
+def print_pipeline_stats(stats: list):
+    '''Print a summary of the stages of a pipeline, pointing out its bottleneck.'''
+
+    print(f'{"Stage":<12}{"In":>8}{"Out":>8}{"Errors":>8}{"Busy (s)":>10}{"Util.":>8}{"Max queue":>11}{"Mean queue":>12}')
+    for stage_stats in stats:
+        print(f'{stage_stats["name"]:<12}{stage_stats["items_in"]:>8}{stage_stats["items_out"]:>8}{stage_stats["errors"]:>8}'
+              f'{stage_stats["busy_seconds"]:>10.2f}{stage_stats["utilization"]:>8.0%}'
+              f'{stage_stats["max_queue_depth"]:>11}{stage_stats["mean_queue_depth"]:>12.1f}')
+
+    if stats:
+        bottleneck = max(stats, key=lambda stage_stats: stage_stats['utilization'])
+        print(f'Bottleneck stage: {bottleneck["name"]} ({bottleneck["utilization"]:.0%} busy)')
@@ -1,13 +1,40 @@
 import pandas as pd
-import pandas_ta as ta
 import psycopg2
 from psycopg2.extras import execute_values
 from datetime import datetime
+import argparse
+import sys
 
 from db import get_db_params
+import indicators
+from shards import add_shard_args, shard_from_args, shard_filter, shard_label
+from run_state import add_force_args, get_code_version, query_inputs, inputs_unchanged, save_run_state, SKIP_EXIT_CODE
+from instrumentation import instrumented, phase
+from profiling import add_profile_args, profiling_from_args
 
 
-def get_asset_data() -> pd.DataFrame:
+#Rows of history needed before a date for its metrics to be exact. EMAs, RSI and ATR depend on every past price
+#with geometrically decaying weights, so each indicator declares how many rows make the rest negligible
+LOOKBACK_ROWS = indicators.get_lookback_rows()
+
+METRIC_COLUMNS = indicators.get_indicator_names()
+
+
+def get_stage_inputs(shard: dict =None) -> dict:
+    '''Cheap summary of the prices the metrics are computed from, to detect when there is nothing new.'''
+
+    asset_price_tbl = get_db_params()['assets_price']
+
+    shard_condition, shard_params = shard_filter(shard)
+    inputs = query_inputs({
+        'prices': (f'SELECT COUNT(*), MAX(price_id), MAX(date) FROM {asset_price_tbl} WHERE {shard_condition}', shard_params)
+    })
+    inputs['code'] = get_code_version(__file__, 'indicators.py', 'shards.py')
+
+    return inputs
+
+
+def get_asset_data(shard: dict =None) -> pd.DataFrame:
     '''Retrieve asset trading data from DB.'''
 
     print('Extracting asset data from database...')
@@ -18,15 +45,16 @@ def get_asset_data() -> pd.DataFrame:
 
     columns = ['price_id', 'ticker', 'date', 'open', 'close', 'high', 'low', 'volume']
 
+    shard_condition, shard_params = shard_filter(shard)
     select_query = f'''SELECT {", ".join(columns)}
                         FROM {asset_price_tbl}
-                        WHERE ticker = 'SPY'
+                        WHERE {shard_condition}
                     '''
     
     try:
         with psycopg2.connect(**db_conn_params) as conn:
             with conn.cursor() as cur:
-                cur.execute(select_query)
+                cur.execute(select_query, shard_params)
                 conn.commit()
                 records = cur.fetchall()
     except psycopg2.Error as e:
@@ -37,43 +65,65 @@ def get_asset_data() -> pd.DataFrame:
     return asset_prices_df
 
 
+def get_asset_data_range(ticker: str, start_date: str, end_date: str, lookback_rows: int =LOOKBACK_ROWS) -> pd.DataFrame:
+    '''Retrieve asset trading data of a ticker within a date range, plus the rows preceding it.'''
+
+    params =            get_db_params()
+    asset_price_tbl =   params['assets_price']
+    db_conn_params =    params['db_conn']
+
+    columns = ['price_id', 'ticker', 'date', 'open', 'close', 'high', 'low', 'volume']
+
+    #Lower bound is the date lookback_rows trading days before start_date, or the first date available
+    select_query = f'''SELECT {", ".join(columns)}
+                        FROM {asset_price_tbl}
+                        WHERE ticker = %(ticker)s
+                        AND date <= %(end_date)s
+                        AND date >= COALESCE((
+                            SELECT date FROM {asset_price_tbl}
+                            WHERE ticker = %(ticker)s AND date < %(start_date)s
+                            ORDER BY date DESC
+                            OFFSET %(offset)s LIMIT 1
+                        ), '-infinity'::date)
+                        ORDER BY date;
+                    '''
+    query_params = {'ticker': ticker, 'start_date': start_date, 'end_date': end_date, 'offset': max(lookback_rows - 1, 0)}
+
+    try:
+        with psycopg2.connect(**db_conn_params) as conn:
+            with conn.cursor() as cur:
+                cur.execute(select_query, query_params)
+                records = cur.fetchall()
+    except psycopg2.Error as e:
+        print(f'Database error: {e}')
+        raise
+
+    return pd.DataFrame(records, columns=columns)
+
+
 def compute_ta_metrics(asset_df: pd.DataFrame, start_time: datetime) -> pd.DataFrame:
     '''Compute technical analysis metrics on past data.'''
 
     print('Computing technical analysis metrics...')
 
-    computed_rows = []
+    metrics = []
 
     for ticker, group in asset_df.groupby('ticker'):
-        group = group.sort_values('date').copy()
-        
-        group['sma_10'] =           group['close'].rolling(10).mean()
-        group['sma_20'] =           group['close'].rolling(20).mean()
-        group['ema_10'] =           group['close'].ewm(span=10).mean()
-        group['ema_20'] =           group['close'].ewm(span=20).mean()
-        group['rsi_14'] =           ta.rsi(group['close'], length=14)
-        group['daily_return'] =     group['close'].pct_change()
-        group['volume_sma_10'] =    group['volume'].rolling(10).mean()
-
-        #Collect id and metrics
-        for _, row in group.dropna().iterrows():
-            computed_rows.append([
-                row['price_id'],
-                row['sma_10'],
-                row['sma_20'],
-                row['ema_10'],
-                row['ema_20'],
-                row['rsi_14'],
-                row['daily_return'],
-                row['volume_sma_10'],
-                start_time
-            ])
-
-    columns = ['asset_price_id', 'sma_10', 'sma_20', 'ema_10', 'ema_20', 
-               'rsi_14', 'daily_return', 'volume_sma_10', 'computed_at']
-    metrics_df = pd.DataFrame(computed_rows, columns=columns)
-
-    return metrics_df
+        group = group.sort_values('date')
+
+        group_metrics = indicators.compute_indicators(group)
+        group_metrics.insert(0, 'asset_price_id', group['price_id'])
+        metrics.append(group_metrics)
+
+    columns = ['asset_price_id'] + METRIC_COLUMNS + ['computed_at']
+    if not metrics:
+        return pd.DataFrame(columns=columns)
+
+    #Only rows with every metric available are kept
+    metrics_df = pd.concat(metrics, ignore_index=True).dropna()
+    metrics_df['computed_at'] = start_time
+
+    return metrics_df[columns]
 
 
 def transform_data(df: pd.DataFrame) -> list:
@@ -81,24 +131,20 @@ def transform_data(df: pd.DataFrame) -> list:
 
     print('Preparing data to save...')
 
-    rows = [
-        (
-            row['asset_price_id'], row['sma_10'], row['sma_20'],
-            row['ema_10'], row['ema_20'], row['rsi_14'],
-            row['daily_return'], row['volume_sma_10'], row['computed_at']
-        )
-        for index, row in df.iterrows()
-    ]
+    columns = ['asset_price_id'] + METRIC_COLUMNS + ['computed_at']
+    values = df[columns].astype(object).to_numpy()
+
+    rows = [tuple(row) for row in values]
 
     return rows
 
 
-def store_results(rows: list):
-    '''Insert rows into the database using bulk insert.'''
+def store_results(rows: list, overwrite: bool =False) -> bool:
+    '''Insert rows into the database using bulk insert. Existing metrics are replaced if overwrite is set.'''
 
     if not rows:
         print('No new data to insert.')
-        return
+        return True
     
     print('Loading technical analysis results into database...')
     
@@ -106,12 +152,17 @@ def store_results(rows: list):
     technical_analysis_tbl =    params['technical_analysis']
     db_conn_params =            params['db_conn']
 
+    if overwrite:
+        conflict_action = 'DO UPDATE SET ' + ', '.join(f'{column} = EXCLUDED.{column}'
+                                                       for column in METRIC_COLUMNS + ['computed_at'])
+    else:
+        conflict_action = 'DO NOTHING'
+
     insert_query = f'''INSERT INTO {technical_analysis_tbl} (
-                        asset_price_id, sma_10, sma_20, ema_10, ema_20,
-                        rsi_14, daily_return, volume_sma_10, computed_at
+                        asset_price_id, {', '.join(METRIC_COLUMNS)}, computed_at
                         )
                         VALUES %s
-                        ON CONFLICT (asset_price_id) DO NOTHING;
+                        ON CONFLICT (asset_price_id) {conflict_action};
     '''
 
     try:
@@ -121,27 +172,53 @@ def store_results(rows: list):
                 conn.commit()
     except psycopg2.Error as e:
         print(f'Database error: {e}')
-        return
+        return False
         
     print(f'Insertion successful.')
 
+    return True
 
-def run_technical_analysis_etl():
+
+@instrumented('technical_analysis_etl')
+def run_technical_analysis_etl(shard: dict =None, force: bool =False) -> bool:
     start_time = datetime.now()
-    print(f'Starting Technical Analysis ETL at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+    print(f'Starting Technical Analysis ETL for assets {shard_label(shard)} at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    stage_inputs = get_stage_inputs(shard)
+    if inputs_unchanged('technical_analysis_etl', shard_label(shard), stage_inputs, force):
+        return False
 
     #Extract
-    asset_df = get_asset_data()
+    with phase('extract') as extract_phase:
+        asset_df = get_asset_data(shard)
+        extract_phase['rows'] = len(asset_df)
 
     #Transform
-    metrics_df = compute_ta_metrics(asset_df, start_time)
-    rows = transform_data(metrics_df)
+    with phase('transform') as transform_phase:
+        metrics_df = compute_ta_metrics(asset_df, start_time)
+        rows = transform_data(metrics_df)
+        transform_phase['rows'] = len(rows)
 
     #Load
-    store_results(rows)
+    with phase('load') as load_phase:
+        stored = store_results(rows)
+        load_phase['rows'] = len(rows)
+
+    if stored:
+        save_run_state('technical_analysis_etl', shard_label(shard), stage_inputs)
 
     print(f'ETL process finished at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
 
+    return True
+
 
 if __name__ == '__main__':
-    run_technical_analysis_etl()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description='Technical Analysis ETL')
+    add_shard_args(parser)
+    add_force_args(parser)
+    add_profile_args(parser)
+    args = parser.parse_args()
+    profiling_from_args(args)
+
+    if not run_technical_analysis_etl(shard_from_args(args), args.force):
+        sys.exit(SKIP_EXIT_CODE)
\ No newline at end of file
@@ -0,0 +1,171 @@
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+import numpy as np
+
+#The scorer needs no Keras: the standalone TensorFlow Lite runtime is used if installed, else the one in TensorFlow
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    Interpreter = None
+
+
+def get_model_path(extension: str ='tflite') -> str:
+    scripts_dir = os.path.dirname(os.path.abspath(__file__))
+    model_dir = os.getenv('MODEL_DIR', os.path.join(os.path.dirname(scripts_dir), 'models'))
+
+    return os.path.join(model_dir, f'lstm_model.{extension}')
+
+
+def load_interpreter(path: str =None, num_threads: int =1) -> object:
+    '''Load an exported TensorFlow Lite model.'''
+
+    interpreter_class = Interpreter
+    if interpreter_class is None:
+        import tensorflow as tf
+        interpreter_class = tf.lite.Interpreter
+
+    interpreter = interpreter_class(model_path=path or get_model_path(), num_threads=num_threads)
+    interpreter.allocate_tensors()
+
+    return interpreter
+
+
+def score(interpreter: object, X: np.ndarray) -> np.ndarray:
+    '''Probability of the next day going up for each sequence, as the Keras model's predict would return.'''
+
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+
+    X = np.ascontiguousarray(X, dtype=input_details['dtype'])
+
+    #Tensors are only reallocated when the batch size changes
+    if tuple(input_details['shape']) != X.shape:
+        interpreter.resize_tensor_input(input_details['index'], X.shape)
+        interpreter.allocate_tensors()
+
+    interpreter.set_tensor(input_details['index'], X)
+    interpreter.invoke()
+
+    return interpreter.get_tensor(output_details['index']).flatten()
+
+
+def get_input_shape(interpreter: object) -> tuple:
+    '''Sequence length and number of features the model expects.'''
+
+    return tuple(interpreter.get_input_details()[0]['shape'][1:])
+
+
+def check_parity(tolerance: float =1e-4, threshold: float =0.5) -> dict:
+    '''Compare the scores of the exported model with those of the Keras model on the test set.'''
+
+    #Only the parity check needs Keras and the training data
+    from model_training import load_feature_matrix, get_train_test_split, load_model
+
+    keras_model = load_model(get_model_path('keras'))
+    interpreter = load_interpreter()
+    sequence_length = get_input_shape(interpreter)[0]
+
+    matrix = load_feature_matrix()
+    _, _, X_test, _, _, _ = get_train_test_split(matrix, sequence_length)
+
+    keras_scores = keras_model.predict(X_test, verbose=0).flatten()
+    tflite_scores = score(interpreter, X_test)
+
+    differences = np.abs(keras_scores - tflite_scores)
+    parity = {
+        'samples':              int(len(X_test)),
+        'max_abs_difference':   float(differences.max()),
+        'mean_abs_difference':  float(differences.mean()),
+        'same_class':           float(np.mean((keras_scores >= threshold) == (tflite_scores >= threshold))),
+        'tolerance':            tolerance
+    }
+    parity['passed'] = parity['max_abs_difference'] <= tolerance
+
+    print(json.dumps(parity, indent=2))
+
+    return parity
+
+
+def measure(backend: str, batch_sizes: list, repetitions: int =50) -> dict:
+    '''Load time, memory and latency per batch of one backend. Run in a fresh process for memory to be comparable.'''
+
+    start = time.perf_counter()
+    if backend == 'tflite':
+        interpreter = load_interpreter()
+        input_shape = get_input_shape(interpreter)
+        predict = lambda X: score(interpreter, X)
+    else:
+        from tensorflow.keras.models import load_model
+        model = load_model(get_model_path('keras'))
+        input_shape = tuple(model.input_shape[1:])
+        predict = lambda X: model.predict_on_batch(X)
+    load_seconds = time.perf_counter() - start
+
+    results = {'backend': backend, 'load_seconds': load_seconds, 'latency_ms': {}}
+
+    rng = np.random.default_rng(0)
+    for batch_size in batch_sizes:
+        X = rng.random((batch_size,) + input_shape, dtype=np.float32)
+        predict(X) #Warm-up
+
+        timings = []
+        for _ in range(repetitions):
+            batch_start = time.perf_counter()
+            predict(X)
+            timings.append((time.perf_counter() - batch_start) * 1000)
+
+        results['latency_ms'][batch_size] = {'p50': float(np.percentile(timings, 50)), 'p99': float(np.percentile(timings, 99))}
+
+    #ru_maxrss is in kilobytes on Linux
+    results['peak_rss_mb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return results
+
+
+def run_benchmark(batch_sizes: list, repetitions: int =50) -> list:
+    '''Measure both backends, each one in its own process.'''
+
+    results = []
+    for backend in ('tflite', 'keras'):
+        command = [sys.executable, os.path.abspath(__file__), 'measure', '--backend', backend,
+                   '--batch-sizes', *map(str, batch_sizes), '--repetitions', str(repetitions)]
+        output = subprocess.run(command, capture_output=True, text=True, check=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    for result in results:
+        latencies = ', '.join(f'batch {size}: p50 {latency["p50"]:.2f} ms, p99 {latency["p99"]:.2f} ms'
+                              for size, latency in result['latency_ms'].items())
+        print(f'{result["backend"]}: load {result["load_seconds"]:.2f}s, peak RSS {result["peak_rss_mb"]:.0f} MB, {latencies}')
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Scoring with the TensorFlow Lite export of the LSTM model')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parity_parser = subparsers.add_parser('parity', help='Compare exported and Keras scores on the test set')
+    parity_parser.add_argument('--tolerance', type=float, default=1e-4,
+                               help='Largest score difference allowed, higher for quantized exports')
+
+    for name, description in (('benchmark', 'Compare load time, memory and latency with Keras'), ('measure', 'Measure one backend, used by benchmark')):
+        benchmark_parser = subparsers.add_parser(name, help=description)
+        benchmark_parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 32, 256])
+        benchmark_parser.add_argument('--repetitions', type=int, default=50)
+        if name == 'measure':
+            benchmark_parser.add_argument('--backend', choices=['tflite', 'keras'], required=True)
+
+    args = parser.parse_args()
+
+    if args.command == 'parity':
+        if not check_parity(args.tolerance)['passed']:
+            sys.exit(1)
+    elif args.command == 'benchmark':
+        run_benchmark(args.batch_sizes, args.repetitions)
+    else:
+        print(json.dumps(measure(args.backend, args.batch_sizes, args.repetitions)))
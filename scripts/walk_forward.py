@@ -0,0 +1,171 @@
+import os
+import json
+import argparse
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+from model_training import (load_feature_matrix, build_time_ordered_sequences, build_LSTM, train_model,
+                            configure_tf_threads, get_model_dir)
+from evaluation import predict_scores, build_evaluation_report, save_report
+
+
+#Set in each worker process by init_fold_worker
+_X = None
+_y = None
+
+
+def walk_forward_folds(num_steps: int, num_folds: int =5, mode: str ='expanding', initial_train_ratio: float =0.5,
+                       gap: int =0) -> list:
+    '''Split time steps in order into folds, each one tested on the block following its training data.
+
+    Time steps are e.g. the distinct dates of the sequences. Those after the initial training ratio are divided into
+    as many test blocks as folds. Each fold is validated on the block right before its test block and trained on
+    everything before it ('expanding') or on a window of fixed length ending there ('sliding'). A gap of time steps
+    can be left between sets, so that overlapping sequences do not leak across them.
+    '''
+
+    if mode not in ('expanding', 'sliding'):
+        raise ValueError(f'Unknown walk-forward mode: {mode}')
+
+    initial_train_end = int(num_steps * initial_train_ratio)
+    block_size = (num_steps - initial_train_end) // num_folds
+    train_size = initial_train_end - block_size - 2 * gap
+
+    if block_size <= 0 or train_size <= 0:
+        raise ValueError(f'Not enough time steps ({num_steps}) for {num_folds} folds')
+
+    folds = []
+    for fold in range(num_folds):
+        test_start = initial_train_end + fold * block_size
+        test_end = test_start + block_size if fold < num_folds - 1 else num_steps
+        val_start = test_start - gap - block_size
+        train_end = val_start - gap
+        train_start = 0 if mode == 'expanding' else train_end - train_size
+
+        folds.append({
+            'fold':     fold,
+            'train':    (train_start, train_end),
+            'val':      (val_start, test_start - gap),
+            'test':     (test_start, test_end)
+        })
+
+    return folds
+
+
+def to_sample_ranges(date_fold: dict, dates: np.ndarray) -> dict:
+    '''Turn a fold over the distinct dates into ranges of the sequences, sorted by date, labeled on those dates.'''
+
+    unique_dates, date_starts = np.unique(dates, return_index=True)
+    bounds = np.append(date_starts, len(dates))
+
+    fold = {'fold': date_fold['fold']}
+    for name in ('train', 'val', 'test'):
+        start, end = date_fold[name]
+        fold[name] = (int(bounds[start]), int(bounds[end]))
+        fold[f'{name}_dates'] = (str(unique_dates[start]), str(unique_dates[end - 1]))
+
+    return fold
+
+
+def init_fold_worker(X: np.ndarray, y: np.ndarray, tf_threads: int):
+    '''Keep the windowed dataset in the worker process, so folds only carry their index ranges.'''
+
+    global _X, _y
+    _X, _y = X, y
+
+    configure_tf_threads(tf_threads)
+
+
+def train_fold(fold: dict, sequence_length: int, epochs: int) -> dict:
+    '''Train and evaluate a model on a fold. Sets are views of the shared windowed array, never copies.'''
+
+    start = datetime.now()
+
+    X_train, y_train = _X[slice(*fold['train'])], _y[slice(*fold['train'])]
+    X_val, y_val = _X[slice(*fold['val'])], _y[slice(*fold['val'])]
+    X_test, y_test = _X[slice(*fold['test'])], _y[slice(*fold['test'])]
+
+    model = build_LSTM(sequence_length=sequence_length, num_features=_X.shape[2])
+    model = train_model(model, X_train, y_train, X_val, y_val, epochs=epochs, verbose=0)
+
+    report = build_evaluation_report(y_val, predict_scores(model, X_val), y_test, predict_scores(model, X_test))
+    report['fold'] = fold['fold']
+    report['ranges'] = {name: fold[name] for name in ('train', 'val', 'test')}
+    report['dates'] = {name: fold[f'{name}_dates'] for name in ('train', 'val', 'test')}
+    report['seconds'] = (datetime.now() - start).total_seconds()
+
+    return report
+
+
+def aggregate_folds(fold_reports: list) -> dict:
+    '''Mean and standard deviation across folds of the main test metrics.'''
+
+    metrics = {
+        'test_accuracy':            [report['test']['best_threshold']['accuracy'] for report in fold_reports],
+        'test_f1':                  [report['test']['best_threshold']['f1'] for report in fold_reports],
+        'test_accuracy_default':    [report['test']['default_threshold']['accuracy'] for report in fold_reports],
+        'test_auc':                 [report['test']['auc'] for report in fold_reports if report['test']['auc'] is not None]
+    }
+
+    return {name: {'mean': float(np.mean(values)), 'std': float(np.std(values))}
+            for name, values in metrics.items() if values}
+
+
+def run_walk_forward(num_folds: int =5, mode: str ='expanding', sequence_length: int =10, epochs: int =300,
+                     workers: int =None, initial_train_ratio: float =0.5) -> dict:
+    start_time = datetime.now()
+    print(f'Starting walk-forward validation at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    matrix = load_feature_matrix()
+
+    #Sequences are windowed once, every fold is a range of this same array. They are sorted by date and folds are
+    #split by date, so that no fold trains on dates later than those it is validated or tested on
+    X, y, dates = build_time_ordered_sequences(matrix, sequence_length)
+    X = X.astype(np.float64)
+    date_folds = walk_forward_folds(len(np.unique(dates)), num_folds, mode, initial_train_ratio, gap=sequence_length)
+    folds = [to_sample_ranges(date_fold, dates) for date_fold in date_folds]
+
+    workers = min(workers or os.cpu_count(), num_folds)
+    tf_threads = max(1, os.cpu_count() // workers)
+    print(f'Training {num_folds} {mode} folds on {workers} processes with {tf_threads} threads each...')
+
+    #TensorFlow is not fork-safe, so workers are spawned
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                             initializer=init_fold_worker, initargs=(X, y, tf_threads)) as executor:
+        fold_reports = list(executor.map(train_fold, folds, [sequence_length] * num_folds, [epochs] * num_folds))
+
+    for report in fold_reports:
+        print(f'Fold {report["fold"]}: train {report["dates"]["train"]}, test {report["dates"]["test"]}, '
+              f'test accuracy {report["test"]["best_threshold"]["accuracy"]:.4f}, test AUC {report["test"]["auc"]}, '
+              f'{report["seconds"]:.0f}s')
+
+    summary = {
+        'mode':             mode,
+        'folds':            fold_reports,
+        'aggregate':        aggregate_folds(fold_reports),
+        'sequence_length':  sequence_length,
+        'epochs':           epochs,
+        'computed_at':      start_time.isoformat()
+    }
+    print('Aggregate metrics:', json.dumps(summary['aggregate'], indent=2))
+
+    save_report(summary, os.path.join(get_model_dir(), 'walk_forward_report.json'))
+
+    print(f'Walk-forward validation finished at {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}')
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Walk-forward validation of the LSTM model')
+    parser.add_argument('--folds', type=int, default=5)
+    parser.add_argument('--mode', choices=['expanding', 'sliding'], default='expanding')
+    parser.add_argument('--sequence-length', type=int, default=10)
+    parser.add_argument('--epochs', type=int, default=300)
+    parser.add_argument('--workers', type=int, default=None, help='Folds trained at once, by default as many as CPUs')
+    parser.add_argument('--initial-train-ratio', type=float, default=0.5)
+    args = parser.parse_args()
+
+    run_walk_forward(args.folds, args.mode, args.sequence_length, args.epochs, args.workers, args.initial_train_ratio)
@@ -13,6 +13,7 @@ CREATE TABLE IF NOT EXISTS analytics.sentiment_analysis
     model_name text COLLATE pg_catalog."default",   -- model used to perform sentiment analysis
     analyzed_at timestamp without time zone,        -- time when the sentiment was analyzed
     CONSTRAINT sentiment_analysis_pkey PRIMARY KEY (id),
+    CONSTRAINT sentiment_analysis_source_id_model_name_analyzed_at_key UNIQUE (source_id, model_name, analyzed_at),
     CONSTRAINT fk_source FOREIGN KEY (source_id)
         REFERENCES inputs.sentiment_sources (content_id) MATCH SIMPLE
         ON UPDATE NO ACTION
@@ -1,6 +1,7 @@
 -- Table: analytics.technical_analysis
 
 -- Stores technical analysis metrics of the asset prices. Metrics are calculated with the closing price.
+-- Generated from the indicator registry in scripts/indicators.py with: python indicators.py ddl
 
 -- DROP TABLE IF EXISTS analytics.technical_analysis;
 
@@ -15,6 +16,12 @@ CREATE TABLE IF NOT EXISTS analytics.technical_analysis
     rsi_14 real,                                -- relative strength index of 14 past data points
     daily_return real,                          -- percentage change in asset price
     volume_sma_10 real,                         -- simple moving average of trading volume of 10 past data points
+    macd real,                                  -- moving average convergence divergence, EMA of 12 minus EMA of 26 data points
+    macd_signal real,                           -- exponential moving average of 9 data points of the MACD
+    macd_histogram real,                        -- MACD minus its signal line
+    bollinger_upper_20 real,                    -- simple moving average of 20 data points plus 2 standard deviations
+    bollinger_lower_20 real,                    -- simple moving average of 20 data points minus 2 standard deviations
+    atr_14 real,                                -- average true range of 14 past data points
     computed_at timestamp without time zone,    -- time when the metric was computed
     CONSTRAINT technical_analysis_pkey PRIMARY KEY (id),
     CONSTRAINT technical_analysis_asset_price_id_key UNIQUE (asset_price_id),
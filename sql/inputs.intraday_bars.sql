@@ -0,0 +1,25 @@
+-- Table: inputs.intraday_bars
+
+-- Stores the intraday price bars of the assets, along with indicators updated as each bar arrives.
+-- Partitioned by month of the bar time; partitions are created by scripts/intraday_etl.py as bars come in.
+
+-- DROP TABLE IF EXISTS inputs.intraday_bars;
+
+CREATE TABLE IF NOT EXISTS inputs.intraday_bars
+(
+    ticker character varying(20) COLLATE pg_catalog."default" NOT NULL, -- ticker string, e.g. 'MSFT'
+    bar_time timestamp without time zone NOT NULL,                      -- start time of the bar
+    interval_minutes smallint NOT NULL,                                 -- length of the bar in minutes
+    open real,                                                          -- price of the asset at the start of the bar
+    high real,                                                          -- max price of the asset during the bar
+    low real,                                                           -- min price of the asset during the bar
+    close real,                                                         -- price of the asset at the end of the bar
+    volume bigint,                                                      -- trading volume
+    sma_20 real,                                                        -- simple moving average of close of 20 past bars
+    ema_20 real,                                                        -- exponential moving average of close of 20 past bars
+    rsi_14 real,                                                        -- relative strength index of 14 past bars
+    CONSTRAINT intraday_bars_pkey PRIMARY KEY (ticker, interval_minutes, bar_time)
+) PARTITION BY RANGE (bar_time);
+
+ALTER TABLE IF EXISTS inputs.intraday_bars
+    OWNER to postgres;
\ No newline at end of file
@@ -0,0 +1,22 @@
+-- Table: modeling.predictions
+
+-- Stores the daily predictions of the model for each asset, made from the latest sequence in the feature matrix.
+
+-- DROP TABLE IF EXISTS modeling.predictions;
+
+CREATE TABLE IF NOT EXISTS modeling.predictions
+(
+    ticker character varying(20) COLLATE pg_catalog."default" NOT NULL, -- ticker string, e.g. 'MSFT'
+    date date NOT NULL,                                                 -- date of the last day of the sequence the prediction is made from
+    score real NOT NULL,                                                -- probability of a price increase given by the model
+    predicted_up boolean NOT NULL,                                      -- whether the score reaches the threshold
+    threshold real NOT NULL,                                            -- decision threshold of the model, chosen on its validation set
+    model_version integer,                                              -- version of the model in its metadata file
+    predicted_at timestamp without time zone,                           -- time when the prediction was made
+    CONSTRAINT predictions_pkey PRIMARY KEY (ticker, date)
+)
+
+TABLESPACE pg_default;
+
+ALTER TABLE IF EXISTS modeling.predictions
+    OWNER to postgres;
\ No newline at end of file
@@ -0,0 +1,35 @@
+-- Table: monitoring.run_metrics
+
+-- Stores the metrics of every phase of each run of the pipeline stages, plus the whole run as phase 'total'.
+-- Written by scripts/instrumentation.py at the end of every run, whether it succeeded, was skipped or failed.
+
+-- DROP TABLE IF EXISTS monitoring.run_metrics;
+
+CREATE SCHEMA IF NOT EXISTS monitoring;
+
+CREATE TABLE IF NOT EXISTS monitoring.run_metrics
+(
+    id serial NOT NULL,                                                 -- id
+    run_id character(32) COLLATE pg_catalog."default" NOT NULL,         -- identifier shared by the phases of a run
+    stage character varying(50) COLLATE pg_catalog."default" NOT NULL,  -- name of the pipeline stage, e.g. 'technical_analysis_etl'
+    shard text COLLATE pg_catalog."default" NOT NULL,                   -- assets the stage was run on, 'all' if not sharded
+    phase character varying(50) COLLATE pg_catalog."default" NOT NULL,  -- phase of the run, e.g. 'extract', or 'total' for the whole run
+    status character varying(10) COLLATE pg_catalog."default" NOT NULL, -- 'succeeded', 'skipped' or 'failed'
+    started_at timestamp without time zone NOT NULL,                    -- time when the phase started
+    seconds double precision,                                           -- wall time of the phase
+    cpu_seconds double precision,                                       -- CPU time of the process during the phase
+    rows bigint,                                                        -- rows produced by the phase, if it reports them
+    db_round_trips integer,                                             -- queries sent to the database
+    db_rows_fetched bigint,                                             -- rows received from the database
+    bytes_fetched bigint,                                               -- bytes of responses fetched from external sources or the raw archive
+    process_peak_memory_mb real,                                        -- peak resident memory of the process since it started, at the end of the phase
+    CONSTRAINT run_metrics_pkey PRIMARY KEY (id)
+)
+
+TABLESPACE pg_default;
+
+CREATE INDEX IF NOT EXISTS run_metrics_stage_started_at_idx
+    ON monitoring.run_metrics USING btree (stage, started_at);
+
+ALTER TABLE IF EXISTS monitoring.run_metrics
+    OWNER to postgres;
\ No newline at end of file
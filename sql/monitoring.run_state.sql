@@ -0,0 +1,23 @@
+-- Table: monitoring.run_state
+
+-- Stores a fingerprint of the inputs of the last successful run of each pipeline stage.
+-- A stage whose inputs have not changed since then is skipped.
+
+-- DROP TABLE IF EXISTS monitoring.run_state;
+
+CREATE SCHEMA IF NOT EXISTS monitoring;
+
+CREATE TABLE IF NOT EXISTS monitoring.run_state
+(
+    stage character varying(50) COLLATE pg_catalog."default" NOT NULL,  -- name of the pipeline stage, e.g. 'technical_analysis_etl'
+    shard text COLLATE pg_catalog."default" NOT NULL,                   -- assets the stage was run on, 'all' if not sharded
+    fingerprint character(64) COLLATE pg_catalog."default" NOT NULL,    -- hash of the stage inputs
+    inputs jsonb,                                                       -- summary of the stage inputs the fingerprint is computed from
+    completed_at timestamp without time zone,                           -- time when the run finished
+    CONSTRAINT run_state_pkey PRIMARY KEY (stage, shard)
+)
+
+TABLESPACE pg_default;
+
+ALTER TABLE IF EXISTS monitoring.run_state
+    OWNER to postgres;
\ No newline at end of file
@@ -0,0 +1,456 @@
+import os
+import re
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import psycopg2
+import numpy as np
+from dotenv import load_dotenv
+from psycopg2 import sql as pgsql
+from psycopg2.extras import execute_values
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+SCRIPTS_DIR = os.path.join(ROOT_DIR, 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
+
+import synthetic_data
+
+
+#Tables of the benchmark database, named as in the sql directory
+TABLES = {
+    'ASSETS_TABLE':             'inputs.assets',
+    'ASSETS_PRICE_TABLE':       'inputs.asset_prices',
+    'SENTIMENT_SOURCES_TABLE':  'inputs.sentiment_sources',
+    'SENTIMENT_ANALYSIS_TABLE': 'analytics.sentiment_analysis',
+    'TECHNICAL_ANALYSIS_TABLE': 'analytics.technical_analysis',
+    'FEATURE_MATRIX_TABLE':     'modeling.feature_matrix',
+    'RUN_STATE_TABLE':          'monitoring.run_state',
+    'PREDICTIONS_TABLE':        'modeling.predictions',
+    'INTRADAY_BARS_TABLE':      'inputs.intraday_bars',
+    'RUN_METRICS_TABLE':        'monitoring.run_metrics'
+}
+
+#Files in sql/ in the order their foreign keys need
+SQL_FILES = ['inputs.assets.sql', 'inputs.asset_prices.sql', 'inputs.sentiment_sources.sql', 'inputs.intraday_bars.sql',
+             'analytics.technical_analysis.sql', 'analytics.sentiment_analysis.sql', 'modeling.feature_matrix.sql',
+             'modeling.predictions.sql', 'monitoring.run_state.sql', 'monitoring.run_metrics.sql']
+
+#Stages in pipeline order and the table whose new rows each one is measured by
+STAGES = {
+    'asset_price_etl':          {'table': 'ASSETS_PRICE_TABLE'},
+    'technical_analysis_etl':   {'table': 'TECHNICAL_ANALYSIS_TABLE'},
+    'sentiment_sources_etl':    {'table': 'SENTIMENT_SOURCES_TABLE'},
+    'sentiment_analysis_etl':   {'table': 'SENTIMENT_ANALYSIS_TABLE'},
+    'feature_matrix_build':     {'table': 'FEATURE_MATRIX_TABLE'},
+    'model_training':           {'table': 'FEATURE_MATRIX_TABLE'} #Rows trained on, it adds none
+}
+
+
+def get_conn_params(database: str =None) -> dict:
+    from db import get_db_params
+
+    conn_params = dict(get_db_params()['db_conn'])
+    if database is not None:
+        conn_params['database'] = database
+
+    return conn_params
+
+
+def create_database(database: str):
+    '''Create the benchmark database if it doesn't exist, connecting to the server's default database.'''
+
+    conn = psycopg2.connect(**get_conn_params('postgres'))
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cur:
+            cur.execute('SELECT 1 FROM pg_database WHERE datname = %s', (database,))
+            if cur.fetchone() is None:
+                print(f'Creating database {database}...')
+                cur.execute(pgsql.SQL('CREATE DATABASE {}').format(pgsql.Identifier(database)))
+    finally:
+        conn.close()
+
+
+def create_tables():
+    '''Drop and recreate the project schemas from the DDL files in sql/.'''
+
+    print('Creating tables...')
+
+    schemas = sorted({table.split('.')[0] for table in TABLES.values()})
+
+    with psycopg2.connect(**get_conn_params()) as conn:
+        with conn.cursor() as cur:
+            for schema in schemas:
+                cur.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE; CREATE SCHEMA {schema};')
+
+            for file_name in SQL_FILES:
+                with open(os.path.join(ROOT_DIR, 'sql', file_name)) as f:
+                    ddl = f.read()
+                #Ownership is left to the user running the benchmark
+                ddl = re.sub(r'ALTER TABLE IF EXISTS \S+\s+OWNER to \w+;', '', ddl)
+                cur.execute(ddl)
+        conn.commit()
+
+
+def serve_article_pages(pages: dict, delay_ms: float =0) -> tuple:
+    '''Serve the pages in a dict by path from a local HTTP server running in the background.
+
+    Each response is delayed to mimic the latency of a real news site. Returns the server and its base URL.
+    '''
+
+    class ArticleHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1' #Keeps connections alive, as news sites do
+
+        def do_GET(self):
+            if delay_ms:
+                time.sleep(delay_ms / 1000)
+
+            page = pages.get(self.path)
+            content = page if page is not None else b'<html><body><p>Page not found</p></body></html>'
+
+            self.send_response(200 if page is not None else 404)
+            self.send_header('Content-Type', 'text/html; charset=utf-8')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ArticleHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def add_article_pages(pages: dict, articles: list):
+    for article in articles:
+        pages[urlsplit(article['link']).path] = synthetic_data.to_article_html(article)
+
+
+def seed_data(num_tickers: int, years: float, num_headlines: int, seed: int =0) -> dict:
+    '''Store synthetic assets in the database, and their prices and news in the raw archive the stages replay.
+
+    Prices, feeds and the bodies of the articles are archived as a live run would archive them, so the extraction
+    stages run on them unchanged, in replay mode, instead of calling the network.
+    '''
+
+    from raw_archive import archive_response
+    from article_bodies import archive_body
+    from sentiment_sources_etl import get_rss_urls
+
+    print(f'Generating {num_tickers} tickers x {years} years of prices and {num_headlines} headlines...')
+
+    assets = synthetic_data.generate_assets(num_tickers, seed)
+    prices = synthetic_data.generate_prices(list(assets['ticker']), years, seed=seed)
+    articles = synthetic_data.generate_headlines(assets, num_headlines, seed=seed)
+
+    with psycopg2.connect(**get_conn_params()) as conn:
+        with conn.cursor() as cur:
+            execute_values(cur, f'INSERT INTO {TABLES["ASSETS_TABLE"]} (ticker, name, pseudonym, type, alphavantage_code) VALUES %s',
+                           list(assets[['ticker', 'name', 'pseudonym', 'type', 'alphavantage_code']].itertuples(index=False, name=None)))
+        conn.commit()
+
+    fetched_at = datetime.now()
+    for ticker, ticker_prices in prices.groupby('ticker'):
+        archive_response('alphavantage', ticker, synthetic_data.to_alphavantage_csv(ticker_prices), fetched_at)
+
+    for ticker, url in zip(assets['ticker'], get_rss_urls(list(assets['ticker']))):
+        archive_response('rss', url, synthetic_data.to_rss(articles[ticker], ticker), fetched_at)
+
+    for article in [article for feed in articles.values() for article in feed]:
+        archive_body(article['link'], 200, '\n'.join(article['paragraphs']), fetched_at)
+
+    return {'tickers': num_tickers, 'years': years, 'price_rows': len(prices), 'headlines': num_headlines, 'seed': seed}
+
+
+def count_rows(table_env: str) -> int:
+    with psycopg2.connect(**get_conn_params()) as conn:
+        with conn.cursor() as cur:
+            cur.execute(f'SELECT COUNT(*) FROM {TABLES[table_env]}')
+            return cur.fetchone()[0]
+
+
+def stub_sentiment_model() -> object:
+    '''Stand-in for the sentiment model, so the stage is timed without downloading or running FinBERT.'''
+
+    labels = ['positive', 'negative', 'neutral']
+
+    return lambda text, **kwargs: [{'label': labels[len(text) % 3], 'score': 0.9}]
+
+
+def run_stage(stage: str, epochs: int, sentiment_model: str) -> dict:
+    '''Run a single stage in this process and measure it. Called in a subprocess per stage by run_benchmark.'''
+
+    rows_before = count_rows(STAGES[stage]['table'])
+    start = time.perf_counter()
+
+    if stage == 'asset_price_etl':
+        from asset_price_etl import run_asset_price_etl
+        run_asset_price_etl(replay='latest', force=True)
+    elif stage == 'technical_analysis_etl':
+        from technical_analysis_etl import run_technical_analysis_etl
+        run_technical_analysis_etl(force=True)
+    elif stage == 'sentiment_sources_etl':
+        from sentiment_sources_etl import run_sentiment_sources_etl
+        run_sentiment_sources_etl(replay='latest')
+    elif stage == 'sentiment_analysis_etl':
+        import sentiment_analysis_etl
+        if sentiment_model == 'stub':
+            sentiment_analysis_etl.load_sentiment_model = stub_sentiment_model
+        else:
+            sentiment_analysis_etl.SENTIMENT_MODEL = sentiment_model
+        sentiment_analysis_etl.run_sentiment_analysis_etl(force=True)
+    elif stage == 'feature_matrix_build':
+        from feature_matrix_build import run_feature_matrix_etl
+        run_feature_matrix_etl(force=True)
+    elif stage == 'model_training':
+        from model_training import run_model_training
+        run_model_training(force=True, epochs=epochs)
+
+    wall_seconds = time.perf_counter() - start
+    rows_after = count_rows(STAGES[stage]['table'])
+    rows = rows_after if stage == 'model_training' else rows_after - rows_before
+
+    #Breakdown of the stage by phase, as measured by its own instrumentation
+    from instrumentation import state
+    phases = state['last_run']['phases'] if state['last_run'] is not None else []
+
+    return {
+        'stage':        stage,
+        'wall_seconds': wall_seconds,
+        'rows':         rows,
+        'rows_per_sec': rows / wall_seconds if wall_seconds > 0 else None,
+        #ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb':  resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'phases':       [{**phase, 'started_at': phase['started_at'].isoformat()} for phase in phases]
+    }
+
+
+def get_git_commit() -> dict:
+    def git(*args: str) -> str:
+        return subprocess.run(['git', *args], cwd=ROOT_DIR, capture_output=True, text=True).stdout.strip()
+
+    return {'commit': git('rev-parse', 'HEAD'), 'dirty': bool(git('status', '--porcelain', '--untracked-files=no'))}
+
+
+def run_benchmark(database: str ='financial_bench', num_tickers: int =20, years: float =5, num_headlines: int =2000,
+                  epochs: int =3, stages: list =None, sentiment_model: str ='stub', seed: int =0, output: str =None) -> dict:
+    '''Seed a disposable database with synthetic data and time every stage on it, each in its own process.'''
+
+    start_time = datetime.now()
+    print(f'Starting benchmark at {start_time.strftime("%Y-%m-%d %H:%M:%S")}')
+
+    archive_dir = tempfile.mkdtemp(prefix='financial_bench_')
+    model_dir = tempfile.mkdtemp(prefix='financial_bench_models_')
+    metrics_dir = tempfile.mkdtemp(prefix='financial_bench_metrics_')
+    article_cache_dir = tempfile.mkdtemp(prefix='financial_bench_articles_')
+
+    #Every stage, including the subprocesses, works on the benchmark database and archive only
+    os.environ.update(TABLES)
+    os.environ['FINANCIAL_DB_NAME'] = database
+    os.environ['RAW_ARCHIVE_DIR'] = archive_dir
+    os.environ['MODEL_DIR'] = model_dir
+    os.environ['METRICS_DIR'] = metrics_dir
+    os.environ['ARTICLE_CACHE_DIR'] = article_cache_dir
+
+    create_database(database)
+    create_tables()
+    data = seed_data(num_tickers, years, num_headlines, seed)
+
+    results = []
+    for stage in stages or list(STAGES):
+        print(f'Running {stage}...')
+        command = [sys.executable, os.path.abspath(__file__), 'stage', stage,
+                   '--epochs', str(epochs), '--sentiment-model', sentiment_model]
+        process = subprocess.run(command, capture_output=True, text=True)
+
+        if process.returncode != 0:
+            print(f'{stage} failed with exit code {process.returncode}')
+            results.append({'stage': stage, 'error': process.stderr.strip()[-2000:]})
+            continue
+
+        result = json.loads(process.stdout.strip().splitlines()[-1])
+        results.append(result)
+        print(f'{stage}: {result["wall_seconds"]:.2f}s, {result["rows"]} rows, '
+              f'{result["rows_per_sec"]:.0f} rows/sec, peak RSS {result["peak_rss_mb"]:.0f} MB')
+
+    report = {
+        'started_at':   start_time.isoformat(),
+        'git':          get_git_commit(),
+        'python':       platform.python_version(),
+        'machine':      {'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'data':         data,
+        'epochs':       epochs,
+        'sentiment_model': sentiment_model,
+        'stages':       results
+    }
+
+    output = output or os.path.join(TESTS_DIR, 'results', f'benchmark_{start_time.strftime("%Y%m%d_%H%M%S")}_{report["git"]["commit"][:8]}.json')
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    print(f'Results written to {output}')
+
+    return report
+
+
+def run_body_benchmark(num_pages: int =1000, workers: int =16, max_per_host: int =4, page_delay_ms: float =20,
+                       missing_ratio: float =0.05, seed: int =0) -> dict:
+    '''Fetch synthetic article pages from a local server twice, first with an empty cache and then with a full one.
+
+    Checks that the main text extracted from each page is exactly its paragraphs, and reports pages per second and
+    cache hit rate of each pass. A share of the links point to missing pages, whose errors are cached too.
+    '''
+
+    from streaming import run_pipeline
+    from article_bodies import new_fetcher, fetch_body, get_fetch_stats, print_fetch_stats
+
+    #Bodies fetched are archived too, which must not add to the project's archive
+    os.environ['ARTICLE_CACHE_DIR'] = tempfile.mkdtemp(prefix='financial_bench_articles_')
+    os.environ['RAW_ARCHIVE_DIR'] = tempfile.mkdtemp(prefix='financial_bench_')
+
+    pages = {}
+    server, base_url = serve_article_pages(pages, page_delay_ms)
+
+    assets = synthetic_data.generate_assets(max(num_pages // 50, 1), seed)
+    articles = [article for feed in synthetic_data.generate_headlines(assets, num_pages, seed=seed, base_url=base_url).values()
+                for article in feed]
+    num_missing = int(len(articles) * missing_ratio)
+    add_article_pages(pages, articles[num_missing:])
+    expected = {article['link']: '\n'.join(article['paragraphs']) if i >= num_missing else None
+                for i, article in enumerate(articles)}
+
+    results = {}
+    for run in ['cold', 'warm']:
+        fetcher = new_fetcher(max_per_host)
+        bodies = {}
+
+        def fetch(link: str) -> list:
+            bodies[link] = fetch_body(fetcher, link)
+            return []
+
+        run_pipeline(list(expected), [{'name': 'body', 'function': fetch, 'workers': workers}])
+
+        print(f'{run.capitalize()} cache:')
+        print_fetch_stats(fetcher)
+        results[run] = get_fetch_stats(fetcher)
+        results[run]['correct_bodies'] = sum(bodies[link] == body for link, body in expected.items()) / len(expected)
+        print(f'{results[run]["correct_bodies"]:.1%} of the bodies extracted as expected.')
+
+    server.shutdown()
+
+    return results
+
+
+def run_backtest_benchmark(num_tickers: int =500, years: float =20, num_thresholds: int =250, leverages: list =None,
+                           costs_bps: list =None, skill: float =0.02, seed: int =0) -> dict:
+    '''Backtest every configuration on synthetic predictions, without a database.
+
+    Reports the time to shape the predictions as date x ticker arrays and to evaluate all configurations, and checks
+    that the best configuration beats random scores, as the synthetic scores carry some signal.
+    '''
+
+    from backtest import to_dense, run_configurations
+
+    leverages = leverages or [0.5, 1.0, 1.5, 2.0]
+    costs_bps = costs_bps if costs_bps is not None else [0.0, 2.0, 5.0, 10.0, 20.0]
+    thresholds = list(np.linspace(0.3, 0.8, num_thresholds))
+
+    predictions = synthetic_data.generate_predictions(num_tickers, years, skill, seed=seed)
+
+    start = time.perf_counter()
+    dates, tickers, scores, returns = to_dense(predictions)
+    dense_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    results = run_configurations(scores, returns, thresholds, leverages, costs_bps)
+    backtest_seconds = time.perf_counter() - start
+
+    #Same returns with random scores, whose best Sharpe ratio is what the search would find by chance
+    random_scores = np.random.default_rng(seed + 1).random(scores.shape)
+    random_results = run_configurations(np.where(np.isnan(scores), np.nan, random_scores), returns, thresholds, [1.0], [0.0])
+
+    summary = {
+        'days':                     len(dates),
+        'tickers':                  len(tickers),
+        'configurations':           len(results),
+        'dense_seconds':            dense_seconds,
+        'backtest_seconds':         backtest_seconds,
+        'configurations_per_sec':   len(results) / backtest_seconds,
+        'best':                     results.sort_values('sharpe', ascending=False).iloc[0].to_dict(),
+        'best_random_sharpe':       float(random_results['sharpe'].max())
+    }
+
+    print(f'{summary["configurations"]} configurations on {summary["days"]} days x {summary["tickers"]} tickers '
+          f'backtested in {backtest_seconds:.2f} s ({summary["configurations_per_sec"]:.0f} per second), '
+          f'after {dense_seconds:.2f} s building the arrays.')
+    print(f'Best Sharpe ratio {summary["best"]["sharpe"]:.2f}, against {summary["best_random_sharpe"]:.2f} with random scores.')
+
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='End-to-end benchmark of the pipeline stages on synthetic data')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Seed the benchmark database and time every stage')
+    run_parser.add_argument('--database', type=str, default='financial_bench',
+                            help='Database to create or reuse, its tables are dropped and recreated')
+    run_parser.add_argument('--tickers', type=int, default=20)
+    run_parser.add_argument('--years', type=float, default=5)
+    run_parser.add_argument('--headlines', type=int, default=2000)
+    run_parser.add_argument('--epochs', type=int, default=3, help='Training epochs of the model')
+    run_parser.add_argument('--stages', nargs='+', choices=list(STAGES), default=None)
+    run_parser.add_argument('--sentiment-model', type=str, default='stub',
+                            help="Hugging Face model for sentiment analysis, or 'stub' for a constant-time stand-in")
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--output', type=str, default=None, help='Results file, by default in tests/results')
+
+    bodies_parser = subparsers.add_parser('bodies', help='Fetch article pages from a local server with a cold and a warm cache')
+    bodies_parser.add_argument('--pages', type=int, default=1000)
+    bodies_parser.add_argument('--workers', type=int, default=16)
+    bodies_parser.add_argument('--max-per-host', type=int, default=4)
+    bodies_parser.add_argument('--page-delay-ms', type=float, default=20, help='Response time of the local news site')
+
+    backtest_parser = subparsers.add_parser('backtest', help='Backtest thousands of configurations on synthetic predictions')
+    backtest_parser.add_argument('--tickers', type=int, default=500)
+    backtest_parser.add_argument('--years', type=float, default=20)
+    backtest_parser.add_argument('--thresholds', type=int, default=250, help='Thresholds between 0.3 and 0.8')
+    backtest_parser.add_argument('--leverages', type=float, nargs='+', default=[0.5, 1.0, 1.5, 2.0])
+    backtest_parser.add_argument('--costs-bps', type=float, nargs='+', default=[0.0, 2.0, 5.0, 10.0, 20.0])
+    backtest_parser.add_argument('--skill', type=float, default=0.02, help='Correlation of the scores with the returns')
+
+    stage_parser = subparsers.add_parser('stage', help='Run and measure a single stage, used by run')
+    stage_parser.add_argument('stage', choices=list(STAGES))
+    stage_parser.add_argument('--epochs', type=int, default=3)
+    stage_parser.add_argument('--sentiment-model', type=str, default='stub')
+
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        load_dotenv()
+        if args.database == os.getenv('FINANCIAL_DB_NAME'):
+            sys.exit(f'Refusing to use the configured project database {args.database} for the benchmark')
+        run_benchmark(args.database, args.tickers, args.years, args.headlines, args.epochs, args.stages,
+                      args.sentiment_model, args.seed, args.output)
+    elif args.command == 'bodies':
+        print(json.dumps(run_body_benchmark(args.pages, args.workers, args.max_per_host, args.page_delay_ms)))
+    elif args.command == 'backtest':
+        print(json.dumps(run_backtest_benchmark(args.tickers, args.years, args.thresholds, args.leverages, args.costs_bps,
+                                                args.skill), default=str))
+    else:
+        print(json.dumps(run_stage(args.stage, args.epochs, args.sentiment_model)))
@@ -0,0 +1,6 @@
+import os
+import sys
+
+#The scripts are run from their own directory and import each other as top-level modules
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+sys.path.insert(0, SCRIPTS_DIR)
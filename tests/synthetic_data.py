@@ -0,0 +1,175 @@
+import numpy as np
+import pandas as pd
+from email.utils import format_datetime
+from datetime import timezone
+from xml.sax.saxutils import escape
+
+
+NAME_PREFIXES = ['North', 'Blue', 'Silver', 'Iron', 'Bright', 'Green', 'Red', 'Summit', 'Harbor', 'Golden',
+                 'Pioneer', 'Atlas', 'Vertex', 'Crescent', 'Granite', 'Maple']
+NAME_SUFFIXES = ['wind', 'field', 'stone', 'gate', 'brook', 'ridge', 'peak', 'light', 'water', 'crest']
+NAME_INDUSTRIES = ['Systems', 'Energy', 'Pharmaceuticals', 'Robotics', 'Financial', 'Motors', 'Foods', 'Networks']
+
+HEADLINE_TEMPLATES = [
+    '{name} shares rise after quarterly earnings beat estimates',
+    '{name} stock falls as revenue guidance disappoints investors',
+    'Analysts upgrade {name} on strong demand outlook',
+    '{name} announces share buyback program',
+    'Regulators open probe into {name} accounting practices',
+    '{name} to acquire smaller rival in all-cash deal',
+    '{name} CEO steps down amid restructuring',
+    '{name} reports record deliveries in the latest quarter'
+]
+
+BODY_TEMPLATES = [
+    'Shares of {name} ({ticker}) moved sharply on {day} as investors weighed the latest news from the company.',
+    'Analysts covering {name} said the results were in line with what the market had been expecting for weeks.',
+    'Trading volume in {ticker} was well above its daily average, according to exchange data compiled after the close.',
+    'Management at {name} told investors that the outlook for the rest of the year remains broadly unchanged.',
+    'Several funds have raised their positions in {name} over the last quarter, regulatory filings showed.'
+]
+
+
+def generate_assets(num_tickers: int, seed: int =0) -> pd.DataFrame:
+    '''Assets with unique tickers and company names, as stored in the assets table.'''
+
+    rng = np.random.default_rng(seed)
+
+    names = set()
+    while len(names) < num_tickers:
+        names.add(f'{rng.choice(NAME_PREFIXES)}{rng.choice(NAME_SUFFIXES)} {rng.choice(NAME_INDUSTRIES)}')
+    names = sorted(names)
+
+    tickers = [f'T{i:04d}' for i in range(num_tickers)]
+
+    return pd.DataFrame({
+        'ticker':               tickers,
+        'name':                 names,
+        'pseudonym':            [name.split()[0] for name in names],
+        'type':                 'stock',
+        'alphavantage_code':    tickers
+    })
+
+
+def generate_prices(tickers: list, years: float, end_date: str =None, seed: int =0) -> pd.DataFrame:
+    '''Daily OHLCV bars of every ticker on business days, following a geometric Brownian motion.'''
+
+    rng = np.random.default_rng(seed)
+
+    end = pd.Timestamp(end_date) if end_date else pd.Timestamp.today().normalize() - pd.offsets.BDay(1)
+    dates = pd.bdate_range(end=end, periods=int(years * 252))
+    num_days = len(dates)
+
+    #All tickers at once: a matrix of days x tickers
+    drift = rng.normal(0.0003, 0.0002, len(tickers))
+    volatility = rng.uniform(0.01, 0.03, len(tickers))
+    log_returns = rng.normal(drift, volatility, (num_days, len(tickers)))
+    close = rng.uniform(20, 500, len(tickers)) * np.exp(np.cumsum(log_returns, axis=0))
+
+    open_ = close * np.exp(rng.normal(0, volatility / 2, close.shape))
+    high = np.maximum(open_, close) * (1 + rng.uniform(0, volatility, close.shape))
+    low = np.minimum(open_, close) * (1 - rng.uniform(0, volatility, close.shape))
+    volume = rng.lognormal(14, 0.5, close.shape).astype(np.int64)
+
+    return pd.DataFrame({
+        'ticker':       np.repeat(np.array(tickers), num_days),
+        'timestamp':    np.tile(dates.strftime('%Y-%m-%d'), len(tickers)),
+        'open':         open_.T.ravel().round(4),
+        'high':         high.T.ravel().round(4),
+        'low':          low.T.ravel().round(4),
+        'close':        close.T.ravel().round(4),
+        'volume':       volume.T.ravel()
+    })
+
+
+def generate_predictions(num_tickers: int, years: float, skill: float =0.05, missing_ratio: float =0.05,
+                         seed: int =0) -> pd.DataFrame:
+    '''Prediction scores of every ticker and day along with the next day return they predict.
+
+    Scores are the probability of a logistic model of the return, where skill is the correlation of the signal with
+    the return, so 0 gives random scores. A share of the rows is left out, as tickers listed or delisted midway.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    dates = pd.bdate_range(end=pd.Timestamp.today().normalize(), periods=int(years * 252))
+    tickers = [f'T{i:04d}' for i in range(num_tickers)]
+
+    volatility = rng.uniform(0.01, 0.03, num_tickers)
+    returns = rng.normal(0.0003, volatility, (len(dates), num_tickers))
+    signal = skill * returns / volatility + np.sqrt(1 - skill**2) * rng.standard_normal(returns.shape)
+    scores = 1 / (1 + np.exp(-signal))
+
+    kept = rng.random(returns.shape) >= missing_ratio
+
+    return pd.DataFrame({
+        'date':             np.repeat(dates.date, num_tickers)[kept.ravel()],
+        'ticker':           np.tile(np.array(tickers), len(dates))[kept.ravel()],
+        'score':            scores[kept],
+        'next_day_return':  returns[kept]
+    })
+
+
+def to_alphavantage_csv(prices: pd.DataFrame) -> bytes:
+    '''Prices of a ticker in the CSV format of Alphavantage's TIME_SERIES_DAILY, newest day first.'''
+
+    columns = ['timestamp', 'open', 'high', 'low', 'close', 'volume']
+
+    return prices.sort_values('timestamp', ascending=False)[columns].to_csv(index=False).encode()
+
+
+def generate_headlines(assets: pd.DataFrame, num_headlines: int, end_date: str =None, days: int =30, seed: int =0,
+                       base_url: str ='https://news.example.com') -> dict:
+    '''News articles mentioning the assets and the text of their linked pages, grouped by the ticker whose feed they appear in.'''
+
+    rng = np.random.default_rng(seed)
+
+    end = pd.Timestamp(end_date) if end_date else pd.Timestamp.today().normalize()
+    seconds = rng.integers(0, days * 86400, num_headlines)
+    asset_indices = rng.integers(0, len(assets), num_headlines)
+    templates = rng.integers(0, len(HEADLINE_TEMPLATES), num_headlines)
+    num_paragraphs = rng.integers(2, len(BODY_TEMPLATES) + 1, num_headlines)
+
+    articles = {ticker: [] for ticker in assets['ticker']}
+    for i in range(num_headlines):
+        asset = assets.iloc[asset_indices[i]]
+        published = (end - pd.Timedelta(seconds=int(seconds[i]))).to_pydatetime().replace(tzinfo=timezone.utc)
+        title = HEADLINE_TEMPLATES[templates[i]].format(name=asset['name'])
+
+        articles[asset['ticker']].append({
+            'title':        f'{title} ({i})', #Unique titles, as the sources table is keyed by title
+            'link':         f'{base_url}/{asset["ticker"].lower()}/{i}',
+            'published':    format_datetime(published),
+            'summary':      f'{asset["name"]} ({asset["ticker"]}) was among the most traded stocks of the session.',
+            'paragraphs':   [template.format(name=asset['name'], ticker=asset['ticker'], day=published.strftime('%A'))
+                             for template in BODY_TEMPLATES[:num_paragraphs[i]]]
+        })
+
+    return articles
+
+
+def to_article_html(article: dict) -> bytes:
+    '''Page of an article as a news site would serve it, with navigation, scripts and a footer around the text.'''
+
+    paragraphs = ''.join(f'<p>{escape(paragraph)}</p>' for paragraph in article['paragraphs'])
+
+    return (f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>{escape(article["title"])}</title>'
+            f'<script>window.analytics = {{"page": "article"}};</script><style>p {{ margin: 0; }}</style></head>'
+            f'<body><header><nav><p>Markets | Stocks | Earnings | Economy | Opinion | Personal finance</p></nav></header>'
+            f'<article><h1>{escape(article["title"])}</h1><p class="byline">By Staff</p>{paragraphs}</article>'
+            f'<aside><p>Most read: ten stocks to watch before the opening bell this week</p></aside>'
+            f'<footer><p>Copyright Synthetic News. All rights reserved. Quotes delayed at least 15 minutes.</p></footer>'
+            f'</body></html>').encode()
+
+
+def to_rss(articles: list, title: str) -> bytes:
+    '''Articles as an RSS 2.0 feed.'''
+
+    items = ''.join(
+        f'<item><title>{escape(article["title"])}</title><link>{escape(article["link"])}</link>'
+        f'<pubDate>{article["published"]}</pubDate><description>{escape(article["summary"])}</description></item>'
+        for article in articles
+    )
+
+    return (f'<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>{escape(title)}</title>'
+            f'<link>https://news.example.com</link><description>Synthetic feed</description>{items}</channel></rss>').encode()
@@ -0,0 +1,36 @@
+import pytest
+
+import article_bodies
+
+
+PAGE = ('<html><body><nav><p>Markets | Stocks | Earnings | Economy | Opinion | Personal finance</p></nav><article>'
+        '<p>Shares of the company rose after it reported better than expected quarterly earnings.</p>'
+        '</article></body></html>')
+
+
+@pytest.fixture
+def archive_dirs(tmp_path, monkeypatch):
+    monkeypatch.setenv('RAW_ARCHIVE_DIR', str(tmp_path / 'raw'))
+    monkeypatch.setenv('ARTICLE_CACHE_DIR', str(tmp_path / 'articles'))
+
+
+def test_replay_reads_archived_bodies_without_fetching(archive_dirs, monkeypatch):
+    pages = {'https://news.example.com/a': (200, PAGE), 'https://news.example.com/missing': (404, '')}
+    monkeypatch.setattr(article_bodies, 'download_page', lambda fetcher, url: pages[url])
+
+    fetcher = article_bodies.new_fetcher()
+    live = {url: article_bodies.fetch_body(fetcher, url) for url in pages}
+    #Served from the cache, and archived again under the day of this run
+    cached = {url: article_bodies.fetch_body(article_bodies.new_fetcher(), url) for url in pages}
+    assert cached == live
+    assert live['https://news.example.com/a'].startswith('Shares of the company')
+
+    def fail_download(fetcher, url):
+        pytest.fail(f'Replays must not fetch {url}')
+
+    monkeypatch.setattr(article_bodies, 'download_page', fail_download)
+
+    fetcher = article_bodies.new_fetcher(replay=fetcher['started_at'].date().isoformat())
+    replayed = {url: article_bodies.fetch_body(fetcher, url) for url in [*pages, 'https://news.example.com/new']}
+
+    assert replayed == {**live, 'https://news.example.com/new': None}
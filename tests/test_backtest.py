@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+
+from backtest import count_at_least, threshold_portfolios
+
+
+THRESHOLDS = np.array([0.0, 0.3, 0.5, 0.55, 0.9, 1.0])
+
+
+def make_scores(seed: int) -> tuple:
+    '''Scores and next day returns of dates x tickers, with missing values, ties and scores equal to thresholds.'''
+
+    rng = np.random.default_rng(seed)
+    num_dates, num_tickers = 60, 25
+
+    #Rounded scores, so many of them tie or fall exactly on a threshold
+    scores = np.round(rng.random((num_dates, num_tickers)), 1)
+    returns = rng.normal(0, 0.02, (num_dates, num_tickers))
+
+    scores[rng.random(scores.shape) < 0.2] = np.nan
+    returns[rng.random(returns.shape) < 0.1] = np.nan
+    #Dates without any score, and without any return
+    scores[10] = np.nan
+    returns[20] = np.nan
+
+    return scores, returns
+
+
+def naive_portfolios(scores: np.ndarray, returns: np.ndarray, thresholds: np.ndarray) -> tuple:
+    '''Gross return and turnover of each day and threshold, from the weights of the held tickers.'''
+
+    gross = np.zeros((len(scores), len(thresholds)))
+    turnover = np.zeros((len(scores), len(thresholds)))
+
+    for j, threshold in enumerate(thresholds):
+        previous_weights = np.zeros(scores.shape[1])
+        for day in range(len(scores)):
+            held = [ticker for ticker in range(scores.shape[1])
+                    if not np.isnan(scores[day, ticker]) and not np.isnan(returns[day, ticker])
+                    and scores[day, ticker] >= threshold]
+
+            weights = np.zeros(scores.shape[1])
+            if held:
+                weights[held] = 1 / len(held)
+                gross[day, j] = np.mean(returns[day, held])
+
+            turnover[day, j] = np.abs(weights - previous_weights).sum()
+            previous_weights = weights
+
+    return gross, turnover
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_count_at_least_matches_comparison(seed):
+    scores, _ = make_scores(seed)
+    values = np.where(np.isnan(scores), -np.inf, scores)
+
+    expected = (values[:, :, np.newaxis] >= THRESHOLDS).sum(axis=1)
+
+    np.testing.assert_array_equal(count_at_least(values, THRESHOLDS), expected)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_threshold_portfolios_match_naive_loop(seed):
+    scores, returns = make_scores(seed)
+
+    portfolios = threshold_portfolios(scores, returns, THRESHOLDS)
+    gross, turnover = naive_portfolios(scores, returns, THRESHOLDS)
+
+    np.testing.assert_allclose(portfolios['gross'], gross, atol=1e-12)
+    np.testing.assert_allclose(portfolios['turnover'], turnover, atol=1e-12)
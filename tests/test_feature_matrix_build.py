@@ -0,0 +1,47 @@
+import numpy as np
+import pandas as pd
+from datetime import date, timedelta
+
+from feature_matrix_build import compute_final_matrix
+
+
+PRICE_COLUMNS = ['a.price_id', 'a.ticker', 'a.date', 'a.open', 'a.close', 'a.high', 'a.low', 'a.volume',
+                 't.sma_10', 't.sma_20', 't.ema_10', 't.ema_20', 't.rsi_14', 't.daily_return', 't.volume_sma_10']
+SENTIMENT_COLUMNS = ['a.source_id', 'a.sentiment_score', 'a.score_confidence', 's.published_date', 's.ticker']
+
+
+def make_prices(tickers: list, num_days: int, seed: int =0) -> pd.DataFrame:
+    rng = np.random.default_rng(seed)
+    rows = []
+    for ticker in tickers:
+        for day in range(num_days):
+            close = float(rng.uniform(50, 150))
+            rows.append([len(rows), ticker, date(2025, 1, 1) + timedelta(days=day), close, close, close, close, 1000,
+                         *[0.0] * 7])
+
+    return pd.DataFrame(rows, columns=PRICE_COLUMNS)
+
+
+def test_labels_use_next_date_whatever_the_row_order():
+    prices = make_prices(['AAA', 'BBB', 'CCC'], 30)
+    #Several sources on a date repeat its price row in the join
+    sentiments = pd.DataFrame([[1, 1, 0.9, date(2025, 1, 5), 'AAA'], [2, -1, 0.95, date(2025, 1, 5), 'AAA'],
+                               [3, 1, 0.9, date(2025, 1, 5), 'AAA'], [4, 1, 0.9, date(2025, 1, 9), 'BBB']],
+                              columns=SENTIMENT_COLUMNS)
+
+    shuffled = prices.sample(frac=1, random_state=0).reset_index(drop=True)
+    matrix = compute_final_matrix({'prices': shuffled, 'sentiments': sentiments})
+
+    expected = prices.sort_values(['a.ticker', 'a.date'])
+    expected = expected.assign(next_close=expected.groupby('a.ticker')['a.close'].shift(-1)).dropna(subset=['next_close'])
+
+    assert len(matrix) == len(expected)
+    assert not matrix.duplicated(['a.ticker', 'a.date']).any()
+
+    merged = matrix.merge(expected[['a.ticker', 'a.date', 'next_close']], on=['a.ticker', 'a.date'],
+                          suffixes=('', '_expected'))
+    np.testing.assert_allclose(merged['next_close'], merged['next_close_expected'])
+    assert (merged['next_day_up'] == (merged['next_close_expected'] > merged['a.close'])).all()
+
+    day = matrix[(matrix['a.ticker'] == 'AAA') & (matrix['a.date'] == date(2025, 1, 5))]
+    assert day['sentiment_score'].iloc[0] == 1 / 3
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+import hyperparameter_search
+from model_training import FEATURES
+
+
+def make_matrix(seed: int =0) -> pd.DataFrame:
+    '''Feature matrix of three tickers, one of them listed after the others.'''
+
+    rng = np.random.default_rng(seed)
+    frames = []
+    for ticker, first_day, num_days in [('AAA', 0, 200), ('BBB', 0, 200), ('CCC', 120, 80)]:
+        frame = pd.DataFrame(rng.random((num_days, len(FEATURES))), columns=FEATURES)
+        frame['m.ticker'] = ticker
+        frame['m.date'] = pd.date_range('2024-01-01', periods=num_days, freq='D') + pd.Timedelta(days=first_day)
+        frame['m.next_day_up'] = rng.random(num_days) > 0.5
+        frames.append(frame)
+
+    return pd.concat(frames, ignore_index=True).sort_values(['m.ticker', 'm.date'], ignore_index=True)
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    '''Worker state of a search on the synthetic matrix, without the thread settings of a real worker.'''
+
+    matrix = make_matrix()
+    monkeypatch.setattr(hyperparameter_search, '_matrix', matrix)
+    monkeypatch.setattr(hyperparameter_search, '_split_dates', hyperparameter_search.get_split_dates(matrix))
+    monkeypatch.setattr(hyperparameter_search, '_splits', {})
+
+
+def test_every_sequence_length_validates_on_the_same_rows(worker):
+    splits = {length: hyperparameter_search.get_split(length)
+              for length in hyperparameter_search.SEARCH_SPACE['sequence_length']}
+
+    _, _, X_reference, y_reference = splits[max(splits)]
+    assert len(y_reference) > 0
+
+    for length, (X_train, _, X_val, y_val) in splits.items():
+        #The last step of a sequence is the row before the one labeling it, whatever the sequence length
+        np.testing.assert_array_equal(X_val[:, -1, :], X_reference[:, -1, :])
+        np.testing.assert_array_equal(y_val, y_reference)
+        assert len(X_train) == len(splits[max(splits)][0])
+
+
+def test_resumed_trial_matches_uninterrupted_trial(worker, tmp_path):
+    trial = {'trial_id': 0, 'units': 8, 'dropout': 0.0, 'learning_rate': 1e-2, 'sequence_length': 5, 'batch_size': 32}
+    for name in ('resumed', 'uninterrupted'):
+        (tmp_path / name).mkdir()
+
+    tf.keras.utils.set_random_seed(0)
+    hyperparameter_search.train_trial(trial, 0, 2, 0, str(tmp_path / 'resumed'))
+    hyperparameter_search.train_trial(trial, 1, 4, 2, str(tmp_path / 'resumed'))
+
+    tf.keras.utils.set_random_seed(0)
+    hyperparameter_search.train_trial(trial, 0, 4, 0, str(tmp_path / 'uninterrupted'))
+
+    resumed_model = tf.keras.models.load_model(tmp_path / 'resumed' / 'trial_0.keras')
+    uninterrupted_model = tf.keras.models.load_model(tmp_path / 'uninterrupted' / 'trial_0.keras')
+    for resumed_weights, uninterrupted_weights in zip(resumed_model.get_weights(), uninterrupted_model.get_weights()):
+        np.testing.assert_allclose(resumed_weights, uninterrupted_weights, atol=1e-5)
+
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import intraday_etl
+
+
+BARS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'intraday_bars.csv')
+
+
+@pytest.fixture
+def state_dir(tmp_path, monkeypatch):
+    monkeypatch.setenv('INTRADAY_STATE_DIR', str(tmp_path))
+
+    return tmp_path
+
+
+def full_history_indicators(bars: pd.DataFrame) -> pd.DataFrame:
+    '''SMA 20, EMA 20 and RSI 14 of every bar recomputed over the whole history of its ticker with pandas.'''
+
+    results = []
+    for ticker, group in bars.sort_values(['ticker', 'timestamp']).groupby('ticker'):
+        close = group['close'].reset_index(drop=True)
+        diff = close.diff().iloc[1:]
+        avg_gain = diff.clip(lower=0).ewm(alpha=1 / 14, min_periods=14).mean()
+        avg_loss = (-diff).clip(lower=0).ewm(alpha=1 / 14, min_periods=14).mean()
+
+        results.append(pd.DataFrame({
+            'ticker':       ticker,
+            'timestamp':    pd.to_datetime(group['timestamp']).to_numpy(),
+            'sma_20':       close.rolling(20).mean(),
+            'ema_20':       close.ewm(span=20).mean(),
+            'rsi_14':       (100 * avg_gain / (avg_gain + avg_loss)).reindex(close.index)
+        }))
+
+    return pd.concat(results, ignore_index=True)
+
+
+def replay(bars: pd.DataFrame) -> pd.DataFrame:
+    '''Replay bars from the state saved by the previous replay, and save the state they leave.'''
+
+    states = intraday_etl.load_state(sorted(bars['ticker'].unique()), '5min')
+    rows, _ = intraday_etl.process_bars(bars, states, 5)
+    intraday_etl.save_state(states, '5min')
+
+    return pd.DataFrame(rows, columns=['ticker', 'timestamp', 'interval_minutes', 'open', 'high', 'low', 'close',
+                                       'volume', 'sma_20', 'ema_20', 'rsi_14'])
+
+
+def test_replayed_bars_match_full_history_indicators(state_dir):
+    bars = intraday_etl.read_bars_file(BARS_FILE)
+    timestamps = sorted(bars['timestamp'].unique())
+
+    #Three runs whose fetches overlap, each resuming from the state saved by the previous one
+    first = replay(bars[bars['timestamp'] <= timestamps[40]])
+    second = replay(bars[(bars['timestamp'] >= timestamps[30]) & (bars['timestamp'] <= timestamps[70])])
+    third = replay(bars[bars['timestamp'] >= timestamps[60]])
+
+    rows = pd.concat([first, second, third], ignore_index=True)
+    assert len(rows) == len(bars)
+    assert not rows.duplicated(['ticker', 'timestamp']).any()
+
+    expected = full_history_indicators(bars)
+    merged = rows.merge(expected, on=['ticker', 'timestamp'], suffixes=('', '_expected'))
+    assert len(merged) == len(bars)
+
+    for name in ('sma_20', 'ema_20', 'rsi_14'):
+        actual = merged[name].astype(float).to_numpy()
+        np.testing.assert_allclose(actual, merged[f'{name}_expected'].to_numpy(), rtol=1e-9, equal_nan=True)
+
+    #One state file per ticker, so shards never overwrite each other's
+    assert sorted(os.listdir(state_dir / '5min')) == ['AAA.json', 'BBB.json']
+
+
+def test_state_of_other_tickers_is_kept(state_dir):
+    bars = intraday_etl.read_bars_file(BARS_FILE)
+
+    replay(bars[bars['ticker'] == 'AAA'])
+    saved = intraday_etl.load_state(['AAA'], '5min')
+    replay(bars[bars['ticker'] == 'BBB'])
+
+    assert intraday_etl.load_state(['AAA'], '5min') == saved
+
+
+def test_runs_without_storing_leave_the_state_untouched(state_dir, monkeypatch):
+    monkeypatch.setattr(intraday_etl, 'load_data', lambda rows: pytest.fail('Bars must not be stored'))
+
+    stats = intraday_etl.run_intraday_etl(bars_file=BARS_FILE, store=False)
+
+    assert stats['new_bars'] == 200
+    assert not os.path.exists(state_dir / '5min')
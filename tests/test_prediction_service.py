@@ -0,0 +1,105 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('httpx')
+
+from fastapi.testclient import TestClient
+
+import prediction_service
+
+
+SEQUENCE_LENGTH = 5
+NUM_FEATURES = 3
+TICKERS = [f'T{i:03d}' for i in range(100)]
+
+
+class StubModel:
+    '''Scores each sequence with the first feature of its last step, and records the size of every batch.'''
+
+    def __init__(self):
+        self.batch_sizes = []
+
+    def __call__(self, X, training=False):
+        self.batch_sizes.append(len(X))
+        return X[:, -1, :1]
+
+
+def expected_score(ticker: str) -> float:
+    return float(np.float32((TICKERS.index(ticker) + 1) / 1000))
+
+
+@pytest.fixture
+def service(monkeypatch):
+    '''Client of the service with a stub model and in-memory sequences, one distinct score per ticker.'''
+
+    model = StubModel()
+    X = np.zeros((len(TICKERS), SEQUENCE_LENGTH, NUM_FEATURES), dtype=np.float32)
+    X[:, -1, 0] = [(i + 1) / 1000 for i in range(len(TICKERS))]
+
+    monkeypatch.setattr(prediction_service, 'load_model', lambda path: model)
+    monkeypatch.setattr(prediction_service, 'load_model_metadata',
+                        lambda: {'version': 'test', 'sequence_length': SEQUENCE_LENGTH, 'best_threshold': 0.05})
+    monkeypatch.setattr(prediction_service, 'load_latest_sequences',
+                        lambda sequence_length: (np.array(TICKERS), np.array([date(2025, 6, 30)] * len(TICKERS)), X))
+    monkeypatch.setitem(prediction_service.config, 'max_batch_size', 64)
+    monkeypatch.setitem(prediction_service.config, 'max_wait_ms', 50)
+
+    with TestClient(prediction_service.app) as client:
+        yield client, model
+
+
+def test_batched_requests_get_their_own_scores(service):
+    client, model = service
+
+    response = client.post('/predict', json={'tickers': TICKERS})
+
+    assert response.status_code == 200
+    predictions = response.json()
+    assert [prediction['ticker'] for prediction in predictions] == TICKERS
+    for prediction in predictions:
+        assert prediction['score'] == pytest.approx(expected_score(prediction['ticker']))
+        assert prediction['next_day_up'] == (prediction['score'] >= 0.05)
+
+    #Requests queued together are scored in batches of at most the maximum size
+    assert model.batch_sizes == [64, 36]
+
+
+def test_concurrent_requests_get_their_own_scores(service):
+    client, model = service
+
+    tickers = TICKERS[::-1] * 2
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        responses = list(executor.map(lambda ticker: client.get(f'/predict/{ticker}'), tickers))
+
+    for ticker, response in zip(tickers, responses):
+        assert response.status_code == 200
+        assert response.json()['ticker'] == ticker
+        assert response.json()['score'] == pytest.approx(expected_score(ticker))
+
+    #Requests arriving within the maximum wait of each other are scored together
+    assert sum(model.batch_sizes) == len(tickers)
+    assert 1 < max(model.batch_sizes) <= 64
+
+
+def test_lone_request_is_scored_after_the_maximum_wait(service):
+    client, model = service
+
+    start = time.perf_counter()
+    response = client.get(f'/predict/{TICKERS[0]}')
+    elapsed = time.perf_counter() - start
+
+    assert response.status_code == 200
+    assert model.batch_sizes == [1]
+    assert elapsed >= 0.05
+
+
+def test_unknown_ticker_is_not_found(service):
+    client, model = service
+
+    assert client.get('/predict/UNKNOWN').status_code == 404
+    assert model.batch_sizes == []
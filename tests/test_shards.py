@@ -0,0 +1,100 @@
+import argparse
+
+import psycopg2
+import pytest
+
+import shards
+from db import get_db_params
+
+
+TICKERS = [f'T{i:03d}' for i in range(37)]
+
+
+def parse_shard_args(argv: list) -> dict:
+    parser = argparse.ArgumentParser()
+    shards.add_shard_args(parser)
+
+    return shards.shard_from_args(parser.parse_args(argv))
+
+
+def test_shard_filter_of_all_assets():
+    assert shards.shard_filter(None) == ('TRUE', [])
+
+
+def test_shard_filter_of_tickers():
+    condition, params = shards.shard_filter({'tickers': ['QQQ', 'SPY']}, column='m.ticker')
+
+    assert condition == 'm.ticker = ANY(%s)'
+    assert params == [['QQQ', 'SPY']]
+
+
+def test_shard_filter_of_buckets_selects_each_bucket_once():
+    conditions = [shards.shard_filter({'bucket': bucket, 'buckets': 4}) for bucket in range(4)]
+
+    #Same hash expression for every bucket, each selecting a different remainder
+    assert len({condition for condition, _ in conditions}) == 1
+    assert [params for _, params in conditions] == [[4, bucket] for bucket in range(4)]
+
+
+@pytest.mark.parametrize('argv', [['--tickers=SPY,QQQ'], ['--shard=2/4'], []])
+def test_shard_args_round_trip(argv):
+    shard = parse_shard_args(argv)
+
+    assert parse_shard_args([shards.shard_to_arg(shard)] if shard else []) == shard
+
+
+def test_invalid_shard_is_rejected():
+    with pytest.raises(ValueError):
+        parse_shard_args(['--shard=4/4'])
+
+
+@pytest.mark.parametrize('shard_size, max_shards', [(10, 16), (5, 3), (100, 16), (1, 100)])
+def test_plan_shards_are_disjoint_and_cover_every_ticker(monkeypatch, shard_size, max_shards):
+    monkeypatch.setattr(shards, 'get_all_tickers', lambda shard=None: TICKERS)
+
+    planned = shards.plan_shards(shard_size, max_shards)
+    planned_tickers = [ticker for shard in planned for ticker in shard['tickers']]
+
+    assert sorted(planned_tickers) == TICKERS
+    assert len(planned) <= max_shards
+    assert all(shard['tickers'] for shard in planned)
+    #Shards are balanced
+    sizes = [len(shard['tickers']) for shard in planned]
+    assert max(sizes) - min(sizes) <= 1
+
+
+def test_plan_shards_without_assets(monkeypatch):
+    monkeypatch.setattr(shards, 'get_all_tickers', lambda shard=None: [])
+
+    assert shards.plan_shards() == []
+
+
+def test_plan_shards_fails_on_database_errors(monkeypatch):
+    def connect(**kwargs):
+        raise psycopg2.OperationalError('connection refused')
+
+    monkeypatch.setattr(shards.psycopg2, 'connect', connect)
+
+    with pytest.raises(psycopg2.Error):
+        shards.plan_shards()
+
+
+def test_hash_buckets_partition_tickers():
+    '''Evaluates the bucket conditions in PostgreSQL, as hashtext only exists there. Skipped without a database.'''
+
+    try:
+        conn = psycopg2.connect(**get_db_params()['db_conn'], connect_timeout=3)
+    except psycopg2.Error as e:
+        pytest.skip(f'No database to test against: {e}')
+
+    buckets = 4
+    selected = []
+    with conn:
+        with conn.cursor() as cur:
+            for bucket in range(buckets):
+                condition, params = shards.shard_filter({'bucket': bucket, 'buckets': buckets})
+                cur.execute(f'SELECT ticker FROM unnest(%s::text[]) AS ticker WHERE {condition}', [TICKERS] + params)
+                selected.append([record[0] for record in cur.fetchall()])
+    conn.close()
+
+    assert sorted(ticker for bucket in selected for ticker in bucket) == TICKERS
@@ -0,0 +1,63 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+import model_training
+from tflite_scorer import load_interpreter, score, get_input_shape
+
+
+SEQUENCE_LENGTH = 10
+NUM_FEATURES = len(model_training.FEATURES)
+
+
+@pytest.fixture(scope='module')
+def small_model():
+    '''LSTM of the production architecture, smaller and trained for an epoch on random data.'''
+
+    rng = np.random.default_rng(0)
+    X = rng.random((256, SEQUENCE_LENGTH, NUM_FEATURES))
+    y = rng.random(256) > 0.5
+
+    model = model_training.build_LSTM(SEQUENCE_LENGTH, NUM_FEATURES, units=8)
+    model.fit(X, y, epochs=1, batch_size=64, verbose=0)
+
+    return model
+
+
+def sample_sequences(batch_size: int) -> np.ndarray:
+    return np.random.default_rng(batch_size).random((batch_size, SEQUENCE_LENGTH, NUM_FEATURES), dtype=np.float32)
+
+
+@pytest.mark.parametrize('quantization, tolerance', [(None, 1e-4), ('float16', 1e-2), ('int8', 5e-2)])
+def test_tflite_scores_match_keras(small_model, tmp_path, quantization, tolerance):
+    path = str(tmp_path / 'lstm_model.tflite')
+    model_training.export_tflite(small_model, path, quantization)
+
+    interpreter = load_interpreter(path)
+    assert get_input_shape(interpreter) == (SEQUENCE_LENGTH, NUM_FEATURES)
+
+    #Batch sizes change between calls, as the scorer resizes its input
+    for batch_size in (1, 32, 7):
+        X = sample_sequences(batch_size)
+        keras_scores = small_model.predict(X, verbose=0).flatten()
+
+        np.testing.assert_allclose(score(interpreter, X), keras_scores, atol=tolerance)
+
+
+def test_failed_export_fails_save_and_keeps_saved_model(small_model, tmp_path, monkeypatch):
+    monkeypatch.setenv('MODEL_DIR', str(tmp_path))
+    model_training.save_model(small_model)
+    saved_files = {name: os.path.getmtime(tmp_path / name) for name in ('lstm_model.keras', 'lstm_model.tflite')}
+
+    def fail_export(*args, **kwargs):
+        raise RuntimeError('conversion failed')
+
+    monkeypatch.setattr(model_training, 'export_tflite', fail_export)
+
+    with pytest.raises(RuntimeError):
+        model_training.save_model(small_model)
+
+    assert {name: os.path.getmtime(tmp_path / name) for name in saved_files} == saved_files